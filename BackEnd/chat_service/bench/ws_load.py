@@ -0,0 +1,268 @@
+"""
+Đo tải endpoint websocket /api/chatbot_service/ws/{chat_id}.
+
+Chạy chat_service ngay trong tiến trình (uvicorn), thay bộ xác thực token bằng bản giả
+và dùng FakeProvider nên không cần identity_service hay OpenAI; vẫn cần PostgreSQL và Redis thật.
+
+    cd BackEnd/chat_service
+    python -m bench.ws_load --clients 50 --messages 5 --tokens-per-sec 80 --output result.json
+
+Kết quả là JSON (phân vị p50/p95/p99 tính bằng ms) để so sánh giữa các commit.
+Client và server chạy chung một event loop nên event_loop_lag_ms gồm cả tải của client.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import math
+import asyncio
+import argparse
+import subprocess
+from typing import Any, Dict, List, Optional
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test websocket chat_service")
+    parser.add_argument("--clients", type=int, default=20, help="Số socket đồng thời")
+    parser.add_argument("--messages", type=int, default=3, help="Số sendMessage mỗi client")
+    parser.add_argument("--message-interval", type=float, default=0.5, help="Nghỉ (giây) giữa hai tin nhắn của một client")
+    parser.add_argument("--typing-per-message", type=int, default=2, help="Số sự kiện typing gửi trước mỗi tin nhắn")
+    parser.add_argument("--typing-interval", type=float, default=0.1, help="Khoảng cách (giây) giữa các sự kiện typing")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="Thời gian (giây) để mở hết các socket")
+    parser.add_argument("--tokens-per-sec", type=float, default=50, help="FAKE_LLM_TOKENS_PER_SEC")
+    parser.add_argument("--ttft-ms", type=int, default=300, help="FAKE_LLM_TTFT_MS")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="FAKE_LLM_ERROR_RATE")
+    parser.add_argument("--response-tokens", type=int, default=200, help="FAKE_LLM_RESPONSE_TOKENS")
+    parser.add_argument("--reply-timeout", type=float, default=60, help="Thời gian tối đa (giây) chờ DONE")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--user-id-base", type=int, default=900000, help="user_id đầu tiên dùng cho client giả lập")
+    parser.add_argument("--repeat-prompts", action="store_true", help="Mọi client gửi cùng nội dung (để đo cache phản hồi)")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file (mặc định in ra stdout)")
+    return parser.parse_args()
+
+
+def configure_env(args):
+    # Phải đặt trước khi import app vì các module đọc cấu hình lúc import
+    os.environ.setdefault("LLM_PROVIDER", "fake")
+    os.environ["FAKE_LLM_TOKENS_PER_SEC"] = str(args.tokens_per_sec)
+    os.environ["FAKE_LLM_TTFT_MS"] = str(args.ttft_ms)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_LLM_RESPONSE_TOKENS"] = str(args.response_tokens)
+
+
+def percentiles(samples: List[float]) -> Dict[str, Any]:
+    """Thống kê (ms) của danh sách mẫu tính bằng giây."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p: float) -> float:
+        # Nearest-rank
+        index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50": pick(50),
+        "p95": pick(95),
+        "p99": pick(99),
+        "max": round(ordered[-1] * 1000, 2),
+    }
+
+
+class Metrics:
+    def __init__(self):
+        self.connect: List[float] = []
+        self.first_frame: List[float] = []
+        # Thời gian chờ token đầu tiên sau khi trừ pre-flight do server báo về
+        self.model_first_frame: List[float] = []
+        self.preflight: List[float] = []
+        self.frame_gap: List[float] = []
+        self.reply: List[float] = []
+        self.frames = 0
+        self.replies = 0
+        self.errors: Dict[str, int] = {}
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class LoopLagMonitor:
+    """Đo độ trễ của event loop: mỗi lần ngủ `interval` giây, phần vượt quá là lag."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_client(index: int, chat_id: uuid.UUID, user_id: int, args, metrics: Metrics):
+    import websockets
+
+    await asyncio.sleep(args.ramp_up * index / max(args.clients, 1))
+    url = f"ws://127.0.0.1:{args.port}/api/chatbot_service/ws/{chat_id}?token=bench-{user_id}"
+    started = time.perf_counter()
+    try:
+        ws = await websockets.connect(url, max_size=None)
+    except Exception:
+        metrics.error("connect")
+        return
+    metrics.connect.append(time.perf_counter() - started)
+    try:
+        for n in range(args.messages):
+            for _ in range(args.typing_per_message):
+                await ws.send(json.dumps({"action": "typing"}))
+                await asyncio.sleep(args.typing_interval)
+            content = "Giải thích decorator trong Python" if args.repeat_prompts else f"Giải thích decorator trong Python (client {index}, câu {n})"
+            sent = time.perf_counter()
+            await ws.send(json.dumps({"action": "sendMessage", "content": content}))
+            last_frame = None
+            preflight = 0.0
+            deadline = sent + args.reply_timeout
+            while True:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    # Dừng client: frame trễ của câu này sẽ bị tính nhầm cho câu sau nếu gửi tiếp
+                    metrics.error("reply_timeout")
+                    return
+                payload = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+                now = time.perf_counter()
+                if payload.get("event") == "DONE":
+                    metrics.reply.append(now - sent)
+                    metrics.replies += 1
+                    break
+                if payload.get("role") == "user" and "preflight_ms" in payload:
+                    preflight = payload["preflight_ms"] / 1000
+                    metrics.preflight.append(preflight)
+                elif payload.get("role") == "assistant":
+                    metrics.frames += 1
+                    if last_frame is None:
+                        metrics.first_frame.append(now - sent)
+                        metrics.model_first_frame.append(now - sent - preflight)
+                    else:
+                        metrics.frame_gap.append(now - last_frame)
+                    last_frame = now
+                elif payload.get("type") == "violation":
+                    metrics.error("violation")
+                    break
+            await asyncio.sleep(args.message_interval)
+    except asyncio.TimeoutError:
+        metrics.error("reply_timeout")
+    except Exception:
+        metrics.error("socket")
+    finally:
+        await ws.close()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+async def main(args) -> Dict[str, Any]:
+    import uvicorn
+    from sqlalchemy import event
+    import routers.chat as chat_router
+    from main import app
+    from db_config import AsyncSessionLocal, async_engine
+    from crud import create_chat_session, delete_chat_session
+    from schemas import ChatSessionCreate
+
+    async def fake_validate_token(websocket):
+        token = websocket.query_params.get("token", "")
+        user_id = int(token.rsplit("-", 1)[-1])
+        return {"user_id": user_id, "username": f"bench{user_id}", "role": "User"}
+
+    # Bỏ qua identity_service: token dạng "bench-{user_id}"
+    chat_router.validate_token_from_query = fake_validate_token
+
+    queries = {"count": 0}
+
+    def count_query(*_):
+        queries["count"] += 1
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_query)
+
+    users = [args.user_id_base + i for i in range(args.clients)]
+    chats: List[uuid.UUID] = []
+    async with AsyncSessionLocal() as db:
+        for user_id in users:
+            chat = await create_chat_session(db, ChatSessionCreate(user_id=user_id, title="New Chat"))
+            chats.append(chat.id)
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning", lifespan="on"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            raise RuntimeError("Không khởi động được uvicorn")
+        await asyncio.sleep(0.05)
+
+    metrics = Metrics()
+    lag = LoopLagMonitor()
+    queries["count"] = 0
+    lag.start()
+    started = time.perf_counter()
+    await asyncio.gather(*[run_client(i, chats[i], users[i], args, metrics) for i in range(args.clients)])
+    elapsed = time.perf_counter() - started
+    await lag.stop()
+    db_queries = queries["count"]
+
+    server.should_exit = True
+    await server_task
+    async with AsyncSessionLocal() as db:
+        for chat_id in chats:
+            await delete_chat_session(db, chat_id)
+    await async_engine.dispose()
+
+    return {
+        "commit": git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "env": {k: os.environ.get(k) for k in ("LLM_PROVIDER", "WS_BACKEND", "MESSAGE_SINK_MODE", "STREAM_COALESCE_POLICY", "RESPONSE_CACHE_ENABLED")},
+        "duration_s": round(elapsed, 3),
+        "replies": metrics.replies,
+        "replies_per_sec": round(metrics.replies / elapsed, 2) if elapsed else 0.0,
+        "frames": metrics.frames,
+        "errors": metrics.errors,
+        "connect_ms": percentiles(metrics.connect),
+        "preflight_ms": percentiles(metrics.preflight),
+        "time_to_first_frame_ms": percentiles(metrics.first_frame),
+        "model_time_to_first_frame_ms": percentiles(metrics.model_first_frame),
+        "inter_frame_gap_ms": percentiles(metrics.frame_gap),
+        "reply_ms": percentiles(metrics.reply),
+        "db_queries": db_queries,
+        "db_queries_per_reply": round(db_queries / metrics.replies, 2) if metrics.replies else None,
+        "event_loop_lag_ms": percentiles(lag.samples),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_env(args)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = asyncio.run(main(args))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
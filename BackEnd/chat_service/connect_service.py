@@ -1,8 +1,12 @@
 import httpx
 import os
+import asyncio
+from typing import Dict, List
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status, WebSocket
 from fastapi.security import OAuth2PasswordBearer
+from service.token_verifier import token_verifier
+from http_client import internal_http, decode_response
 load_dotenv()
 token_url = os.getenv("LOGIN")
 USER_SERVICE_URL = os.getenv('USER_SERVICE_URL')
@@ -10,73 +14,87 @@ IDENTITY_URL = os.getenv("IDENTITY_SERVICE_URL")
 EMAIL_URL = os.getenv("EMAIL_SERVICE_URL")
 SERVICE_KEY = os.getenv("SERVICE_KEY")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{token_url}")
-TIMEOUT = 10.0
+# "remote" (mặc định): gọi identity_service /validate-token mỗi request;
+# "local": tự kiểm tra JWT + Redis blacklist + user còn tồn tại (xem service/token_verifier.py)
+AUTH_MODE = os.getenv("AUTH_MODE", "remote").lower()
+if AUTH_MODE == "local" and (not os.getenv("SECRET_KEY") or token_verifier.revocation is None):
+    # Thiếu DB blacklist thì token đã đăng xuất vẫn dùng được tới khi hết hạn: không cho khởi động
+    raise RuntimeError("AUTH_MODE=local cần SECRET_KEY và AUTH_REVOCATION_REDIS_DB (REDIS_DB của identity_service)")
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    if AUTH_MODE == "local":
+        return await token_verifier.verify(token)
     headers = {
         "Authorization": f"Bearer {token}",
     }
-    timeout = httpx.Timeout(TIMEOUT, connect=5.0)
-    async with httpx.AsyncClient(follow_redirects=True, timeout=timeout) as client:
-        try:
-            response = await client.get(f"{IDENTITY_URL}validate-token", headers=headers)
-            if response.status_code != 200:
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token không tồn tại!!!")
-            try:
-                data = response.json()
-            except ValueError:
-                raise HTTPException(status_code=500, detail="Phản hồi JSON không hợp lệ từ dịch vụ xác thực mã thông báo!!!")
-            return {
-                "user_id": data.get("user_id"),
-                "username": data.get("username"),
-                "role": data.get("role"),
-            }
-        except httpx.ReadTimeout:
-            raise HTTPException(status_code=503, detail="Dịch vụ xác thực không phản hồi (timeout)")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Lỗi khi gửi yêu cầu đến dịch vụ xác thực: {repr(e)}")
+    try:
+        response = await internal_http.get(f"{IDENTITY_URL}validate-token", headers=headers)
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=503, detail="Dịch vụ xác thực không phản hồi (timeout)")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi khi gửi yêu cầu đến dịch vụ xác thực: {repr(e)}")
+    if response.status_code != 200:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token không tồn tại!!!")
+    data = decode_response(response)
+    if data is None:
+        raise HTTPException(status_code=500, detail="Phản hồi JSON không hợp lệ từ dịch vụ xác thực mã thông báo!!!")
+    return {
+        "user_id": data.get("user_id"),
+        "username": data.get("username"),
+        "role": data.get("role"),
+    }
 # Lấy thông tin user từ User Service
 async def get_user(user_id: int):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f'{USER_SERVICE_URL}user/{user_id}')
-            if response.status_code == 200:
-                return response.json()
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Lỗi khi nạp user: {repr(e)}")
+    try:
+        response = await internal_http.get(f'{USER_SERVICE_URL}user/{user_id}')
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi khi nạp user: {repr(e)}")
+    return decode_response(response)
+# Lấy thông tin nhiều user trong một lần gọi User Service
+async def get_users_batch(user_ids: List[int]) -> Dict[int, dict]:
+    if not user_ids:
+        return {}
+    try:
+        # Endpoint batch chỉ đọc nên được phép thử lại như GET
+        headers = {"X-API-Key": SERVICE_KEY}
+        response = await internal_http.post(f'{USER_SERVICE_URL}users/batch', json={"user_ids": list(user_ids)}, headers=headers, idempotent=True)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi khi nạp danh sách user: {repr(e)}")
+    if response.status_code == 200:
+        return {u["id"]: u for u in (decode_response(response) or {}).get("users", [])}
+    if response.status_code not in (404, 405):
+        raise HTTPException(status_code=response.status_code, detail="Không thể nạp danh sách user")
+    # User Service chưa có endpoint batch: gọi song song từng user
+    users = await asyncio.gather(*[get_user(user_id) for user_id in user_ids], return_exceptions=True)
+    return {user_id: info for user_id, info in zip(user_ids, users) if isinstance(info, dict)}
 async def validate_token_from_query(websocket: WebSocket):
     token = websocket.query_params.get("token")
     if not token:
         raise HTTPException(status_code=401, detail="Thiếu token trong query")
+    if AUTH_MODE == "local":
+        return await token_verifier.verify(token)
 
     headers = {"Authorization": f"Bearer {token}"}
-    timeout = httpx.Timeout(TIMEOUT, connect=5.0)
-
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        try:
-            response = await client.get(f"{IDENTITY_URL}validate-token", headers=headers)
-            if response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Token không hợp lệ hoặc đã hết hạn")
-            return response.json()
-
-        except httpx.ReadTimeout:
-            raise HTTPException(status_code=504, detail="Dịch vụ xác thực không phản hồi (timeout)")
-
-        except httpx.RequestError as e:
-            # Log lỗi tại đây nếu cần
-            raise HTTPException(status_code=503, detail="Không thể kết nối tới dịch vụ xác thực")
+    try:
+        response = await internal_http.get(f"{IDENTITY_URL}validate-token", headers=headers)
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Dịch vụ xác thực không phản hồi (timeout)")
+    except httpx.RequestError:
+        raise HTTPException(status_code=503, detail="Không thể kết nối tới dịch vụ xác thực")
+    data = decode_response(response)
+    if data is None:
+        raise HTTPException(status_code=401, detail="Token không hợp lệ hoặc đã hết hạn")
+    return data
 
 async def send_violation_lock_email(recipient: str, username: str, duration: str):
-    async with httpx.AsyncClient() as client:
-        data = {
-            "recipient": recipient,
-            "username": username,
-            "duration": duration
-        }
-        try:
-            response = await client.post(f"{EMAIL_URL}/send-user-lock-notification", json=data)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise HTTPException(status_code=response.status_code, detail="Gửi email không thành công")
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Lỗi khi gửi yêu cầu đến dịch vụ email: {repr(e)}")
\ No newline at end of file
+    data = {
+        "recipient": recipient,
+        "username": username,
+        "duration": duration
+    }
+    try:
+        response = await internal_http.post(f"{EMAIL_URL}/send-user-lock-notification", json=data)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi khi gửi yêu cầu đến dịch vụ email: {repr(e)}")
+    if response.status_code == 200:
+        return decode_response(response)
+    raise HTTPException(status_code=response.status_code, detail="Gửi email không thành công")
@@ -1,149 +1,317 @@
 import datetime
 import uuid
-from fastapi import HTTPException, logger, status
+import logging
+from fastapi import HTTPException, status
+from sqlalchemy import select, delete, func, text, or_, and_, cast, literal, literal_column, REAL
 from sqlalchemy.exc import SQLAlchemyError
 from db_config import db_dependency
 from models import ChatSession, ChatHistory, Image
 from schemas import ChatSessionCreate, ChatSessionUpdate, ChatSessionOut, AddMessage, ChatHistoryOut, MessageOut, ImageCreate, ImageOut
-from typing import List 
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def to_db_datetime(value: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    """Cột DateTime không có timezone: quy đổi thời điểm có timezone về UTC naive (asyncpg không tự chuyển)."""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
 
 # tạo mới một phiên chat mới
-def create_chat_session(db: db_dependency, chat_session: ChatSessionCreate) -> ChatSessionOut:
+async def create_chat_session(db: db_dependency, chat_session: ChatSessionCreate) -> ChatSessionOut:
     db_chat_session = ChatSession(id=uuid.uuid4(), user_id=chat_session.user_id, title=chat_session.title)
     db.add(db_chat_session)
-    db.commit()
-    db.refresh(db_chat_session)
+    await db.commit()
+    await db.refresh(db_chat_session)
     return ChatSessionOut.from_orm(db_chat_session)
 # Hàm để thêm tin nhắn vào phiên chat
-def add_message_to_chat(db: db_dependency, message_data: AddMessage) -> MessageOut:
+async def add_message_to_chat(db: db_dependency, message_data: AddMessage) -> MessageOut:
     db_message = ChatHistory(
-        id=uuid.uuid4(), 
-        chat_id=message_data.chat_id, 
-        role=message_data.role, 
+        id=uuid.uuid4(),
+        chat_id=message_data.chat_id,
+        role=message_data.role,
         content=message_data.content,
-        created_at=message_data.timestamp if message_data.timestamp else None
+        created_at=to_db_datetime(message_data.timestamp) if message_data.timestamp else None
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    await db.commit()
+    await db.refresh(db_message)
     return MessageOut.from_orm(db_message)
+# Hàm để lấy một phiên chat theo id
+async def get_chat_session(db: db_dependency, chat_id: uuid.UUID, user_id: Optional[int] = None) -> Optional[ChatSession]:
+    query = select(ChatSession).where(ChatSession.id == chat_id)
+    if user_id is not None:
+        query = query.where(ChatSession.user_id == user_id)
+    result = await db.execute(query)
+    return result.scalars().first()
 # Hàm để lấy tất cả các phiên chat của người dùng
-def get_chat_sessions(db: db_dependency, user_id: int) -> List[ChatSessionOut]:
-    chat_sessions = db.query(ChatSession).filter(ChatSession.user_id == user_id).order_by(ChatSession.created_at.desc()).all()
-    return [ChatSessionOut.from_orm(chat_session) for chat_session in chat_sessions]
+async def get_chat_sessions(db: db_dependency, user_id: int) -> List[ChatSessionOut]:
+    result = await db.execute(
+        select(ChatSession).where(ChatSession.user_id == user_id).order_by(ChatSession.created_at.desc())
+    )
+    return [ChatSessionOut.from_orm(chat_session) for chat_session in result.scalars().all()]
 # Hàm để lấy tất cả các tin nhắn trong một phiên chat
-def get_chat_history(db: db_dependency, chat_id: uuid.UUID) -> ChatHistoryOut:
+async def get_chat_history(db: db_dependency, chat_id: uuid.UUID) -> ChatHistoryOut:
     try:
-        chat_session = db.query(ChatSession).filter(ChatSession.id == chat_id).first()
+        chat_session = await get_chat_session(db, chat_id)
         if not chat_session:
             return None
-        messages = db.query(ChatHistory).filter(ChatHistory.chat_id == chat_id).order_by(ChatHistory.created_at.asc()).all()
+        result = await db.execute(
+            select(ChatHistory).where(ChatHistory.chat_id == chat_id).order_by(ChatHistory.created_at.asc())
+        )
         chat_session_out = ChatSessionOut.from_orm(chat_session)
-        messages_out = [MessageOut.from_orm(message) for message in messages]
+        messages_out = [MessageOut.from_orm(message) for message in result.scalars().all()]
         return ChatHistoryOut(chat_session=chat_session_out, messages=messages_out)
     except Exception as e:
         logger.error(f"Lỗi trong get_chat_history với chat_id={chat_id}: {e}", exc_info=True)
         raise
+# Hàm để lấy N tin nhắn gần nhất (theo thứ tự thời gian tăng dần)
+async def get_recent_messages(db: db_dependency, chat_id: uuid.UUID, limit: int = 40) -> List[ChatHistory]:
+    result = await db.execute(
+        select(ChatHistory)
+        .where(ChatHistory.chat_id == chat_id)
+        .order_by(ChatHistory.created_at.desc())
+        .limit(limit)
+    )
+    return list(reversed(result.scalars().all()))
+# Hàm để lấy một trang user có chat kèm các phiên chat và số tin nhắn, trong một câu truy vấn
+async def get_chat_users_page(db: db_dependency, page: int, limit: int) -> Tuple[int, List[Tuple[int, List[Dict[str, Any]]]]]:
+    distinct_users = select(ChatSession.user_id).distinct().subquery()
+    # count(*) OVER () được tính trước OFFSET/LIMIT nên cho luôn tổng số user
+    page_users = (
+        select(distinct_users.c.user_id, func.count().over().label("total"))
+        .order_by(distinct_users.c.user_id)
+        .offset((page - 1) * limit)
+        .limit(limit)
+        .cte("page_users")
+    )
+    message_counts = (
+        select(ChatHistory.chat_id, func.count(ChatHistory.id).label("message_count"))
+        .join(ChatSession, ChatSession.id == ChatHistory.chat_id)
+        .where(ChatSession.user_id.in_(select(page_users.c.user_id)))
+        .group_by(ChatHistory.chat_id)
+        .cte("message_counts")
+    )
+    result = await db.execute(
+        select(
+            page_users.c.user_id,
+            page_users.c.total,
+            ChatSession.id,
+            ChatSession.title,
+            ChatSession.created_at,
+            func.coalesce(message_counts.c.message_count, 0).label("message_count"),
+        )
+        .select_from(page_users)
+        .join(ChatSession, ChatSession.user_id == page_users.c.user_id)
+        .outerjoin(message_counts, message_counts.c.chat_id == ChatSession.id)
+        .order_by(page_users.c.user_id, ChatSession.created_at.desc())
+    )
+    rows = result.all()
+    if not rows:
+        # Trang vượt quá số user: vẫn trả về tổng số
+        total = await db.scalar(select(func.count(distinct_users.c.user_id)))
+        return total or 0, []
+    users: Dict[int, List[Dict[str, Any]]] = {}
+    for row in rows:
+        users.setdefault(row.user_id, []).append({
+            "chat_id": str(row.id),
+            "title": row.title,
+            "created_at": row.created_at,
+            "message_count": row.message_count,
+        })
+    return rows[0].total, list(users.items())
 
 # Hàm để cập nhật tiêu đề của một phiên chat
-def update_chat_session(db: db_dependency, chat_id: uuid.UUID, chat_session_update: ChatSessionUpdate) -> ChatSessionOut:
-    db_chat_session = db.query(ChatSession).filter(ChatSession.id == chat_id).first()
+async def update_chat_session(db: db_dependency, chat_id: uuid.UUID, chat_session_update: ChatSessionUpdate) -> ChatSessionOut:
+    db_chat_session = await get_chat_session(db, chat_id)
     if not db_chat_session:
         return None
     if chat_session_update.title:
         db_chat_session.title = chat_session_update.title
-    db.commit()
-    db.refresh(db_chat_session)
+    await db.commit()
+    await db.refresh(db_chat_session)
     return ChatSessionOut.from_orm(db_chat_session)
 # Hàm để xóa một phiên chat
-def delete_chat_session(db: db_dependency, chat_id: uuid.UUID) -> bool:
-    db_chat_session = db.query(ChatSession).filter(ChatSession.id == chat_id).first()
+async def delete_chat_session(db: db_dependency, chat_id: uuid.UUID) -> bool:
+    db_chat_session = await get_chat_session(db, chat_id)
     if not db_chat_session:
         return False
-    db.delete(db_chat_session)
-    db.commit()
+    await db.delete(db_chat_session)
+    await db.commit()
     return True
 # Hàm để xóa một tin nhắn trong một phiên chat
-def delete_message(db: db_dependency, message_id: uuid.UUID) -> bool:
-    db_message = db.query(ChatHistory).filter(ChatHistory.id == message_id).first()
+async def delete_message(db: db_dependency, message_id: uuid.UUID) -> bool:
+    db_message = await db.get(ChatHistory, message_id)
     if not db_message:
         return False
-    db.delete(db_message)
-    db.commit()
+    await db.delete(db_message)
+    await db.commit()
     return True
 # Hàm để xóa tất cả các tin nhắn trong một phiên chat
-def delete_all_messages(db: db_dependency, chat_id: uuid.UUID) -> bool:
-    db_messages = db.query(ChatHistory).filter(ChatHistory.chat_id == chat_id).all()
-    if not db_messages:
-        return False
-    for message in db_messages:
-        db.delete(message)
-    db.commit()
-    return True
-def save_messages_to_db(db: db_dependency, chat_id: uuid.UUID, role: str, content: str):
+async def delete_all_messages(db: db_dependency, chat_id: uuid.UUID) -> bool:
+    result = await db.execute(delete(ChatHistory).where(ChatHistory.chat_id == chat_id))
+    await db.commit()
+    return result.rowcount > 0
+async def save_messages_to_db(db: db_dependency, chat_id: uuid.UUID, role: str, content: str):
     message = ChatHistory(
         chat_id=chat_id,
         role=role,
         content=content,
-        created_at=datetime.utcnow()
+        created_at=datetime.datetime.utcnow()
     )
     db.add(message)
-    db.commit()
-    db.refresh(message)
+    await db.commit()
+    await db.refresh(message)
     return message
 
-def create_image(db, image: ImageCreate) -> ImageOut:
+async def create_image(db, image: ImageCreate) -> ImageOut:
     db_image = Image(**image.model_dump())
     try:
         db.add(db_image)
-        db.commit()
-        db.refresh(db_image)
+        await db.commit()
+        await db.refresh(db_image)
         return ImageOut.model_validate(db_image)
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Lỗi khi lưu ảnh: {str(e)}"
         )
 
-def get_images_by_user(db, user_id: int) -> List[ImageOut]:
-    images = (
-        db.query(Image)
-        .filter(Image.user_id == user_id)
+async def get_images_by_user(db, user_id: int) -> List[ImageOut]:
+    result = await db.execute(
+        select(Image)
+        .where(Image.user_id == user_id)
         .order_by(Image.created_at.desc())
-        .all()
     )
-    return [ImageOut.model_validate(img) for img in images]
+    return [ImageOut.model_validate(img) for img in result.scalars().all()]
+
+async def _get_image(db, image_id: int, user_id: Optional[int]) -> Optional[Image]:
+    query = select(Image).where(Image.id == image_id)
+    if user_id is not None:
+        query = query.where(Image.user_id == user_id)
+    result = await db.execute(query)
+    return result.scalars().first()
 
-def update_image_description(db, image_id: int, user_id: int, new_description: str) -> ImageOut:
-    img = db.query(Image).filter(Image.id == image_id, Image.user_id == user_id).first()
+async def update_image_description(db, image_id: int, user_id: int, new_description: str) -> ImageOut:
+    img = await _get_image(db, image_id, user_id)
     if not img:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Không tìm thấy ảnh hoặc không có quyền sửa"
         )
     img.description = new_description
-    db.commit()
-    db.refresh(img)
+    await db.commit()
+    await db.refresh(img)
     return ImageOut.model_validate(img)
 
-def delete_image(db, image_id: int, user_id: int) -> ImageOut:
-    img = db.query(Image).filter(Image.id == image_id, Image.user_id == user_id).first()
+async def delete_image(db, image_id: int, user_id: int) -> ImageOut:
+    img = await _get_image(db, image_id, user_id)
     if not img:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Không tìm thấy ảnh hoặc không có quyền xóa"
         )
-    db.delete(img)
-    db.commit()
-    return ImageOut.model_validate(img)
+    image_out = ImageOut.model_validate(img)
+    await db.delete(img)
+    await db.commit()
+    return image_out
 
-def get_all_images(db) -> List[ImageOut]:
-    images = db.query(Image).order_by(Image.created_at.desc()).all()
-    return [ImageOut.model_validate(img) for img in images]
+async def get_all_images(db) -> List[ImageOut]:
+    result = await db.execute(select(Image).order_by(Image.created_at.desc()))
+    return [ImageOut.model_validate(img) for img in result.scalars().all()]
 
-def get_image_by_id(db, image_id: int) -> ImageOut:
-    img = db.query(Image).filter(Image.id == image_id).first()
+# Tên file (phần sau dấu "/" cuối) của url ảnh; hằng số viết thẳng vào SQL (không bind) để
+# biểu thức trùng với index ix_images_file_name và planner dùng được index
+IMAGE_FILE_NAME_SQL = "regexp_replace(url, '^.*/', '')"
+IMAGE_FILE_INDEX_DDL = f"CREATE INDEX IF NOT EXISTS ix_images_file_name ON images ({IMAGE_FILE_NAME_SQL})"
+
+def _image_file_name():
+    return func.regexp_replace(Image.url, literal_column("'^.*/'"), literal_column("''"))
+
+async def count_images_by_file(db, filename: str) -> int:
+    """Số ảnh còn trỏ tới file (ảnh lưu theo hash nên nhiều bản ghi có thể dùng chung một file)."""
+    return await db.scalar(select(func.count(Image.id)).where(_image_file_name() == filename))
+
+async def get_image_by_id(db, image_id: int) -> ImageOut:
+    img = await _get_image(db, image_id, None)
     if not img:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Không tìm thấy ảnh hoặc ảnh không tồn tại.")
     return ImageOut.model_validate(img)
+
+# ========== Tìm kiếm ảnh (admin) ==========
+# pg_trgm + unaccent: tìm theo chuỗi con/độ tương tự, không phân biệt dấu tiếng Việt.
+# unaccent() không IMMUTABLE nên cần hàm bọc để dùng trong index biểu thức.
+IMAGE_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE OR REPLACE FUNCTION immutable_unaccent(text) RETURNS text "
+    "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT "
+    "AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$",
+    "CREATE INDEX IF NOT EXISTS ix_images_description_trgm ON images "
+    "USING gin (immutable_unaccent(lower(description)) gin_trgm_ops)",
+)
+# Khóa advisory (theo transaction) để nhiều worker/instance khởi động cùng lúc không chạy DDL
+# song song - CREATE EXTENSION/FUNCTION IF NOT EXISTS vẫn có thể lỗi unique_violation khi đua nhau
+IMAGE_SEARCH_DDL_LOCK = 0x1A6E5EA7
+image_search_indexed = False
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def ensure_image_file_index(engine):
+    """Tạo index theo tên file cho count_images_by_file; lỗi thì truy vấn vẫn chạy (quét bảng)."""
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": IMAGE_SEARCH_DDL_LOCK})
+            await conn.execute(text(IMAGE_FILE_INDEX_DDL))
+    except SQLAlchemyError as e:
+        logger.warning(f"Không thể tạo index tên file ảnh: {e}")
+
+async def ensure_image_search_index(engine):
+    """Tạo extension/hàm/index cho tìm kiếm ảnh; không đủ quyền thì dùng ILIKE như cũ."""
+    global image_search_indexed
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": IMAGE_SEARCH_DDL_LOCK})
+            for statement in IMAGE_SEARCH_DDL:
+                await conn.execute(text(statement))
+        image_search_indexed = True
+    except SQLAlchemyError as e:
+        image_search_indexed = False
+        logger.warning(f"Không thể tạo index tìm kiếm ảnh (dùng ILIKE): {e}")
+
+async def search_images(
+    db, q: str, user_id: Optional[int], limit: int,
+    cursor: Optional[Tuple[float, int]] = None,
+) -> Tuple[List[ImageOut], Optional[Tuple[float, int]]]:
+    """
+    Tìm ảnh theo mô tả, xếp hạng theo word_similarity rồi id giảm dần; phân trang keyset
+    bằng cursor (rank, id) của dòng cuối trang trước. Trả về (ảnh, cursor trang sau hoặc None).
+    """
+    q = " ".join((q or "").split())
+    if q and image_search_indexed:
+        haystack = func.immutable_unaccent(func.lower(Image.description))
+        needle = func.immutable_unaccent(func.lower(literal(q)))
+        # Mẫu LIKE dựng bằng toán tử || (immutable) để planner dùng được index trigram
+        pattern = literal("%").op("||")(func.immutable_unaccent(func.lower(literal(_escape_like(q))))).op("||")(literal("%"))
+        rank = func.word_similarity(needle, haystack)
+        condition = or_(haystack.like(pattern, escape="\\"), needle.op("<%")(haystack))
+    else:
+        rank = cast(literal(0.0), REAL)
+        condition = Image.description.ilike(f"%{_escape_like(q)}%", escape="\\") if q else None
+    query = select(Image, rank.label("rank"))
+    if condition is not None:
+        query = query.where(condition)
+    if user_id:
+        query = query.where(Image.user_id == user_id)
+    if cursor is not None:
+        last_rank, last_id = cursor
+        last_rank = cast(literal(last_rank), REAL)
+        query = query.where(or_(rank < last_rank, and_(rank == last_rank, Image.id < last_id)))
+    rows = (await db.execute(query.order_by(rank.desc(), Image.id.desc()).limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (float(rows[-1].rank), rows[-1].Image.id)
+    return [ImageOut.model_validate(row.Image) for row in rows], next_cursor
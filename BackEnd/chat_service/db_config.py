@@ -2,19 +2,36 @@ import os
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base  
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.declarative import declarative_base
 from typing import Annotated
-from sqlalchemy.orm import Session
 from fastapi import Depends
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
+
+def _to_async_url(url: str) -> str:
+    """Chuyển DATABASE_URL (psycopg2) sang driver asyncpg."""
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _to_async_url(DATABASE_URL)
+
+# Engine đồng bộ: chỉ dùng cho script và create_all lúc khởi động
 engine = create_engine(DATABASE_URL)
 SessionLocal  = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Engine asyncio: dùng cho toàn bộ route và websocket
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
-db_dependency = Annotated[Session, Depends(get_db)]
\ No newline at end of file
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
@@ -1,8 +1,16 @@
 from fastapi import FastAPI
-from routers import chat, baned_keyword, image, violation_log
-from db_config import Base, engine
+from routers import chat, baned_keyword, image, image_files, violation_log
+from db_config import Base, engine, async_engine
+from service.message_sink import message_sink
+from service.violation_sink import violation_sink
+from http_client import internal_http
+from service.image_jobs import image_jobs
+from service.title_worker import title_worker
+from service.language import language_detector
+from service.context_builder import summary_store
+from service.llm_provider import llm_provider
+from crud import ensure_image_search_index, ensure_image_file_index
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 Base.metadata.create_all(bind=engine)
 app = FastAPI(title="ChatBot Service API")
 # Gắn router
@@ -10,7 +18,7 @@ app.include_router(chat.router)
 app.include_router(baned_keyword.router)
 app.include_router(image.router)
 app.include_router(violation_log.router)
-app.mount("/static/images", StaticFiles(directory="upload/images"), name="images")
+app.include_router(image_files.router)
 # Cấu hình CORS
 app.add_middleware(
     CORSMiddleware,
@@ -18,7 +26,31 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+@app.on_event("startup")
+async def startup_event():
+    await ensure_image_search_index(async_engine)
+    await ensure_image_file_index(async_engine)
+    message_sink.start()
+    violation_sink.start()
+    await internal_http.start()
+    image_jobs.start()
+    title_worker.start()
+    await language_detector.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await image_jobs.stop()
+    await title_worker.stop()
+    await summary_store.close()
+    await chat.manager.close()
+    await message_sink.stop()
+    await violation_sink.stop()
+    await async_engine.dispose()
+    await internal_http.close()
+    await llm_provider.close()
+
 @app.get("/api/chatbot_service/")
 async def root():
     return {"message": "Welcome to ChatBot Service!"}
\ No newline at end of file
@@ -1,33 +1,45 @@
+import logging
 from typing import List
+from sqlalchemy import select
 from fastapi import APIRouter, Depends, HTTPException, status
 from db_config import db_dependency
 from schemas import BannedKeywordCreate, BannedKeywordOut
 from models import BannedKeywords
 from connect_service import get_current_user
+from service.cache import refresh_keywords_cache
 
+logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/chatbot_service", tags=["baned_keywords"])
 
+async def _invalidate_keyword_matcher():
+    """Tăng version từ khóa trên Redis để mọi worker dựng lại bộ so khớp."""
+    try:
+        await refresh_keywords_cache()
+    except Exception as e:
+        logger.warning(f"Không thể làm mới cache từ khóa bị cấm: {e}")
+
 @router.post("/banned_keywords", response_model=BannedKeywordOut, status_code=status.HTTP_201_CREATED)
 async def create_banned_keyword(request: BannedKeywordCreate, db: db_dependency, current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này!!!")
     
     keyword = request.keyword.strip().lower()
-    existing_keyword = db.query(BannedKeywords).filter(BannedKeywords.keyword == keyword).first()
+    existing_keyword = await db.scalar(select(BannedKeywords).where(BannedKeywords.keyword == keyword))
     if existing_keyword:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Từ khóa đã tồn tại")
     
     new_keyword = BannedKeywords(keyword=keyword)
     db.add(new_keyword)
-    db.commit()
-    db.refresh(new_keyword)
+    await db.commit()
+    await db.refresh(new_keyword)
+    await _invalidate_keyword_matcher()
     
     return new_keyword  # Trả về object phù hợp với BannedKeywordOut
 
 
 @router.get("/banned_keywords", response_model=List[BannedKeywordOut])
 async def get_banned_keywords(db: db_dependency, current_user: dict = Depends(get_current_user)):
-    keywords = db.query(BannedKeywords).all()
+    keywords = (await db.scalars(select(BannedKeywords))).all()
     return keywords  # Trả về list đối tượng phù hợp với List[BannedKeywordOut]
 
 
@@ -36,17 +48,18 @@ async def delete_banned_keyword(keyword_id: int, db: db_dependency, current_user
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này!!!")
     
-    keyword = db.query(BannedKeywords).filter(BannedKeywords.id == keyword_id).first()
+    keyword = await db.get(BannedKeywords, keyword_id)
     if not keyword:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Từ khóa không tồn tại")
     
-    db.delete(keyword)
-    db.commit()
+    await db.delete(keyword)
+    await db.commit()
+    await _invalidate_keyword_matcher()
     
     return keyword  # Trả về object vừa xóa, phù hợp BannedKeywordOut
 
 @router.get("/banned_keyword/public", response_model=List[BannedKeywordOut])
 async def get_banned_keywords_public(db: db_dependency):
     """Lấy danh sách từ khóa bị cấm công khai (không cần authentication)"""
-    keywords = db.query(BannedKeywords).all()
+    keywords = (await db.scalars(select(BannedKeywords))).all()
     return keywords  # Trả về list đối tượng phù hợp với List[BannedKeywordOut]
\ No newline at end of file
@@ -5,101 +5,58 @@ import openai
 import os
 import logging
 import datetime
-from sqlalchemy import func
+from sqlalchemy import func, select
 from crud import *
 from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 from jose import JWTError
 from fastapi import APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session, joinedload
-from db_config import SessionLocal, db_dependency
+from sqlalchemy.orm import selectinload
+from db_config import AsyncSessionLocal, db_dependency
 from schemas import ChatSessionUpdate, ChatSessionOut, ChatHistoryOut, AllChatUsersResponse, UserDetailOut, SessionWithMessageOut
 from starlette.websockets import WebSocketState
 from models import ChatSession, ChatHistory
-from connect_service import get_current_user, validate_token_from_query, get_user
-from sockets.connection_manager import ConnectionManager
+from connect_service import get_current_user, validate_token_from_query, get_user, get_users_batch
+from http_client import extract_user_data
+from sockets.connection_manager import manager
 from sockets.ws_helpers import handle_send_message, handle_typing, now_vn
 from service.prompts import SYSTEM_MESSAGE
 from service.violation_handler import get_user_strike_count, is_user_banned_from_chat
+from service.context_cache import context_cache
+from service.message_sink import message_sink
+from service.response_cache import response_cache
 router = APIRouter(prefix="/api/chatbot_service",tags=["chatbot"])
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 VN_TIMEZONE = datetime.timezone(datetime.timedelta(hours=7))
 timestamp = datetime.datetime.now(VN_TIMEZONE)
-manager = ConnectionManager()
 logger = logging.getLogger("chatbot.websocket")
 #ADMIN
+@router.get("/response-cache/stats")
+async def get_response_cache_stats(user=Depends(get_current_user)):
+    if not user["role"] == "Admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này")
+    return await response_cache.summary()
+
 @router.get("/all-chat-users", response_model=AllChatUsersResponse)
 async def get_all_chat_with_users(db: db_dependency, page: int=1, limit:int=10, user=Depends(get_current_user)):
     if not user["role"] == "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này")
-    total_users = db.query(ChatSession.user_id).distinct().count()
-
-    # Lấy danh sách user_id phân trang
-    user_ids = (
-        db.query(ChatSession.user_id)
-        .distinct()
-        .offset((page - 1) * limit)
-        .limit(limit)
-        .all()
-    )
-    user_ids = [row[0] for row in user_ids]
-    async def fetch_user(user_id):
-        try:
-            info = await get_user(user_id)
-            # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-            if isinstance(info, dict):
-                if "user" in info:
-                    user_data = info["user"]
-                else:
-                    user_data = info
-            else:
-                if hasattr(info, 'model_dump'):
-                    user_data = info.model_dump()
-                elif hasattr(info, 'dict'):
-                    user_data = info.dict()
-                else:
-                    user_data = {}
-            
-            if not isinstance(user_data, dict):
-                user_data = {}
-            
-            return {
-                "user_id": user_id,
-                "username": user_data.get("username"),
-                "email": user_data.get("email")
-            }
-        except Exception:
-            return {
-                "user_id": user_id,
-                "username": None,
-                "email": None
-            }
-    user_infos = await asyncio.gather(*[fetch_user(user_id) for user_id in user_ids])
+    # Một truy vấn cho cả trang (user, phiên chat, số tin nhắn) + một lần gọi User Service
+    total_users, page_users = await get_chat_users_page(db, page, limit)
+    try:
+        user_infos = await get_users_batch([user_id for user_id, _ in page_users])
+    except Exception as e:
+        logger.warning(f"Không thể nạp thông tin user cho trang admin: {e}")
+        user_infos = {}
     results = []
-    for user_info in user_infos:
-        sessions = (
-            db.query(ChatSession)
-            .filter(ChatSession.user_id == user_info["user_id"])
-            .order_by(ChatSession.created_at.desc())
-            .all()
-        )
-        session_data = []
-        for s in sessions:
-            msg_count = (
-                db.query(func.count(ChatHistory.id))
-                .filter(ChatHistory.chat_id == s.id)
-                .scalar()
-            )
-            session_data.append({
-                "chat_id": str(s.id),
-                "title": s.title,
-                "created_at": s.created_at,
-                "message_count": msg_count
-            })
+    for user_id, sessions in page_users:
+        user_data = extract_user_data(user_infos.get(user_id)) or {}
         results.append({
-            **user_info,
-            "sessions": session_data
+            "user_id": user_id,
+            "username": user_data.get("username"),
+            "email": user_data.get("email"),
+            "sessions": sessions
         })
     return {
         "data": results,
@@ -117,31 +74,17 @@ async def get_chat_of_user_id(db: db_dependency, user_id: int,user=Depends(get_c
     if not user_response:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại.")
     
-    # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-    if isinstance(user_response, dict):
-        if "user" in user_response:
-            user_data = user_response["user"]
-        else:
-            user_data = user_response
-    else:
-        if hasattr(user_response, 'model_dump'):
-            user_data = user_response.model_dump()
-        elif hasattr(user_response, 'dict'):
-            user_data = user_response.dict()
-        else:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại.")
-    
-    if not isinstance(user_data, dict):
+    user_data = extract_user_data(user_response)
+    if user_data is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại.")
     
     # Lấy tất cả session của user + load luôn messages
-    sessions = (
-        db.query(ChatSession)
-        .options(joinedload(ChatSession.chat_history))
-        .filter(ChatSession.user_id == user_id)
+    sessions = (await db.scalars(
+        select(ChatSession)
+        .options(selectinload(ChatSession.chat_history))
+        .where(ChatSession.user_id == user_id)
         .order_by(ChatSession.created_at.desc())
-        .all()
-    )
+    )).all()
     return UserDetailOut(
         user_id=user_id,
         username = user_data["username"],
@@ -163,8 +106,7 @@ async def get_chat_of_user_id(db: db_dependency, user_id: int,user=Depends(get_c
 @router.get("/chat", response_model=List[ChatSessionOut])
 async def get_chats_by_user_id(db: db_dependency, user=Depends(get_current_user)):
     try:
-        chats = db.query(ChatSession).filter(ChatSession.user_id == user["user_id"]).order_by(ChatSession.created_at.desc()).all()
-        return chats
+        return await get_chat_sessions(db, user["user_id"])
     except Exception as e:
         raise HTTPException(status_code=500, detail="Lỗi server khi lấy danh sách chat")
 
@@ -195,7 +137,9 @@ async def check_user_violations(user_id: int, db: db_dependency):
 @router.get("/chat/{chat_id}", response_model=ChatHistoryOut)
 async def get_chat(chat_id: uuid.UUID, db: db_dependency, user=Depends(get_current_user)):
     try:
-        chat = get_chat_history(db, chat_id)
+        # Đảm bảo các tin nhắn còn trong hàng ghi của worker này đã xuống DB
+        await message_sink.flush()
+        chat = await get_chat_history(db, chat_id)
         if not chat:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat không tồn tại")
         if chat.chat_session.user_id != user["user_id"]:
@@ -238,7 +182,7 @@ async def create_chat(chat_session: ChatSessionCreate, db: db_dependency, user=D
             user_id=user_id,
             title=chat_session.title or "New Chat"
         )
-        return create_chat_session(db, chat_data)
+        return await create_chat_session(db, chat_data)
     except HTTPException:
         raise
     except Exception as e:
@@ -246,12 +190,12 @@ async def create_chat(chat_session: ChatSessionCreate, db: db_dependency, user=D
 @router.put("/chat/{chat_id}", response_model=ChatSessionOut)
 async def update_chat(chat_id: uuid.UUID, chat_update: ChatSessionUpdate, db: db_dependency, user=Depends(get_current_user)):
     try:
-        chat = get_chat_history(db, chat_id)
+        chat = await get_chat_history(db, chat_id)
         if not chat:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat không tồn tại")
         if chat.chat_session.user_id != user["user_id"]:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Chat không thuộc về bạn")
-        return update_chat_session(db, chat_id, chat_update)
+        return await update_chat_session(db, chat_id, chat_update)
     except HTTPException:
         raise
     except Exception as e:
@@ -260,14 +204,15 @@ async def update_chat(chat_id: uuid.UUID, chat_update: ChatSessionUpdate, db: db
 @router.delete("/chat/{chat_id}")
 async def delete_chat(chat_id: uuid.UUID, db: db_dependency, user=Depends(get_current_user)):
     try:
-        chat = get_chat_history(db, chat_id)
+        chat = await get_chat_history(db, chat_id)
         if not chat:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat không tồn tại")
         if chat.chat_session.user_id != user["user_id"]:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Chat không thuộc về bạn")
-        delete_all_messages(db, chat_id)
-        delete_chat_session(db, chat_id)
-        db.commit()
+        await message_sink.flush()
+        await delete_all_messages(db, chat_id)
+        await delete_chat_session(db, chat_id)
+        await context_cache.invalidate(chat_id)
         return {"detail": "Chat đã được xóa"}
     except Exception as e:
         raise HTTPException(status_code=500, detail="Lỗi server khi xóa chat")
@@ -275,14 +220,15 @@ async def delete_chat(chat_id: uuid.UUID, db: db_dependency, user=Depends(get_cu
 @router.delete("/message/{message_id}")
 async def delete_one_message(message_id: uuid.UUID, db: db_dependency, user=Depends(get_current_user)):
     try:
-        msg = db.query(ChatHistory).filter(ChatHistory.id == message_id).first()
+        await message_sink.flush()
+        msg = await db.get(ChatHistory, message_id)
         if not msg:
             raise HTTPException(status_code=404, detail="Tin nhắn không tồn tại")
-        chat = db.query(ChatSession).filter(ChatSession.id == msg.chat_id).first()
+        chat = await get_chat_session(db, msg.chat_id)
         if chat.user_id != user["user_id"]:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Tin nhắn không thuộc về bạn")
-        delete_message(db, message_id)
-        db.commit()
+        await delete_message(db, message_id)
+        await context_cache.invalidate(msg.chat_id)
         return {"detail": "Tin nhắn đã được xóa"}
     except HTTPException:
         raise
@@ -292,7 +238,6 @@ async def delete_one_message(message_id: uuid.UUID, db: db_dependency, user=Depe
 # --------------------- WebSocket ---------------------
 @router.websocket("/ws/{chat_id}")
 async def websocket_endpoint(websocket: WebSocket, chat_id: uuid.UUID):
-    db: Session = SessionLocal()
     user_id: Optional[int] = None
     try:
         # Xác thực
@@ -302,16 +247,18 @@ async def websocket_endpoint(websocket: WebSocket, chat_id: uuid.UUID):
                 await websocket.close(code=1008)
                 return
             user_id = int(user_data.get("user_id") or user_data.get("sub"))
-        except JWTError:
-            await websocket.close(code=1008)
-            return
-        # Kiểm tra quyền sở hữu
-        chat_session = db.query(ChatSession).filter(
-            ChatSession.id == chat_id, ChatSession.user_id == user_id
-        ).first()
-        if not chat_session:
+        except (JWTError, HTTPException):
+            # validate_token_from_query raise HTTPException khi thiếu/sai token: đóng 1008 thay vì lỗi 1011
             await websocket.close(code=1008)
             return
+        # Kiểm tra quyền sở hữu (session ngắn, không giữ kết nối DB suốt vòng đời socket)
+        async with AsyncSessionLocal() as db:
+            chat_session = await get_chat_session(db, chat_id, user_id)
+            if not chat_session:
+                await websocket.close(code=1008)
+                return
+            # Nạp sẵn context hội thoại một lần khi kết nối
+            await context_cache.warm(chat_id, db)
         # Kết nối
         await websocket.accept()
         await manager.connect(websocket, chat_id, user_id)
@@ -334,46 +281,42 @@ async def websocket_endpoint(websocket: WebSocket, chat_id: uuid.UUID):
             # Gửi tin nhắn bình thường
             if action != "sendMessage" or not content:
                 continue
-            # Tạo context từ lịch sử
-            chat_log: List[Dict[str, Any]] = [
-                {"role": "system", "content": SYSTEM_MESSAGE}
-            ]
-            try:
-                messages = (
-                    db.query(ChatHistory)
-                    .filter(ChatHistory.chat_id == chat_id)
-                    .order_by(ChatHistory.created_at.desc())
-                    .limit(40)
-                    .all()
+            async with AsyncSessionLocal() as db:
+                # Tạo context từ cache (chỉ truy vấn DB khi cache miss)
+                chat_log: List[Dict[str, Any]] = [
+                    {"role": "system", "content": SYSTEM_MESSAGE}
+                ]
+                try:
+                    chat_log.extend(await context_cache.get(chat_id, db))
+                except Exception as e:
+                    logger.error(f"Lỗi khi tải lịch sử chat {chat_id}: {e}")
+                    await manager.send_personal(websocket, {
+                        "role": "system",
+                        "content": "Không thể tải lịch sử trò chuyện.",
+                        "timestamp": now_vn().isoformat()
+                    })
+                    continue
+                # Gọi AI xử lý (stream qua websocket)
+                await handle_send_message(
+                    websocket, db, chat_id, chat_log, chat_session, user_id, content, user_data
                 )
-                for m in reversed(messages):
-                    chat_log.append({"role": m.role, "content": m.content})
-            except Exception as e:
-                logger.error(f"Lỗi khi tải lịch sử chat {chat_id}: {e}")
-                await websocket.send_json({
-                    "role": "system",
-                    "content": "Không thể tải lịch sử trò chuyện.",
-                    "timestamp": now_vn().isoformat()
-                })
-                continue
-            # Gọi AI xử lý (stream qua websocket)
-            await handle_send_message(
-                websocket, db, chat_id, chat_log, chat_session, user_id, content, user_data
-            )
     except Exception as e:
         logger.exception("Fatal websocket error: %s", e)
         if websocket.client_state == WebSocketState.CONNECTED:
-            await websocket.send_json({
+            await manager.send_personal(websocket, {
                 "role": "system",
                 "content": "Đã xảy ra lỗi. Vui lòng thử lại.",
                 "timestamp": now_vn().isoformat(),
             })
     finally:
+        # Ghi nốt các tin nhắn còn trong hàng đợi khi socket đóng
         with contextlib.suppress(Exception):
-            if websocket.client_state == WebSocketState.CONNECTED:
-                await websocket.close()
+            await message_sink.flush()
+        # Gỡ khỏi registry trước để hàng đợi gửi kịp đẩy nốt message cuối rồi mới đóng socket
         with contextlib.suppress(Exception):
             if user_id is not None:
                 await manager.disconnect(websocket, chat_id, user_id)
-        db.close()
+        with contextlib.suppress(Exception):
+            if websocket.client_state == WebSocketState.CONNECTED:
+                await websocket.close()
         logger.info(f"WebSocket closed for user {user_id} chat {chat_id}")
@@ -0,0 +1,112 @@
+import os
+import re
+import asyncio
+import logging
+from typing import Optional, Tuple
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse
+from service.image_store import image_store, immutable_etag, media_type
+
+# ==========================
+# Setup
+# ==========================
+logger = logging.getLogger(__name__)
+# Giữ nguyên đường dẫn cũ của StaticFiles để URL đã lưu trong DB vẫn dùng được
+router = APIRouter(prefix="/static/images", tags=["Image files"])
+
+# Ảnh đặt tên theo hash không bao giờ đổi nội dung: cho phép cache vĩnh viễn
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# Ảnh cũ (tên UUID) vẫn phải kiểm tra lại định kỳ
+LEGACY_CACHE = "public, max-age=3600"
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # So khớp yếu theo RFC 9110 cho If-None-Match: bỏ tiền tố W/
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag in tags
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Trả về (start, end) bao gồm hai đầu; None nếu header không phải một khoảng đơn (nhiều khoảng,
+    đơn vị khác, sai cú pháp) - khi đó bỏ qua Range và trả cả file như RFC 9110 cho phép.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        # bytes=-N: N byte cuối
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    return start, end
+
+
+def _read_slice(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+@router.api_route("/{filename}", methods=["GET", "HEAD"])
+async def serve_image(filename: str, request: Request):
+    """
+    Phục vụ file ảnh với ETag mạnh, Cache-Control immutable cho tên file theo hash,
+    If-None-Match (304), Range (206) và chọn biến thể AVIF/WebP theo Accept.
+    Không truy vấn DB: mọi thông tin suy ra từ tên file và hệ thống file.
+    """
+    if filename != os.path.basename(filename) or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Không tìm thấy ảnh")
+
+    served = image_store.negotiate(filename, request.headers.get("accept", ""))
+    path = image_store.path(served)
+    substituted = False
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
+        # URL bản thu nhỏ được suy ra từ tên file nên có thể chưa tồn tại: trả ảnh gốc thay thế
+        original = await asyncio.to_thread(image_store.original_for, served)
+        if original is None:
+            raise HTTPException(status_code=404, detail="Không tìm thấy ảnh")
+        served, path, substituted = original, image_store.path(original), True
+        stat = await asyncio.to_thread(os.stat, path)
+
+    # Ảnh thay thế không được cache vĩnh viễn vì bản thu nhỏ có thể được tạo sau
+    etag = None if substituted else immutable_etag(served)
+    headers = {"Accept-Ranges": "bytes", "Vary": "Accept"}
+    if etag:
+        headers["Cache-Control"] = IMMUTABLE_CACHE
+    else:
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        headers["Cache-Control"] = LEGACY_CACHE
+    headers["ETag"] = etag
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    size = stat.st_size
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = _parse_range(range_header, size)
+    if byte_range is not None:
+        if byte_range[0] >= size or byte_range[0] > byte_range[1]:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        start, end = byte_range
+        length = end - start + 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(length)
+        body = b"" if request.method == "HEAD" else await asyncio.to_thread(_read_slice, path, start, length)
+        return Response(content=body, status_code=206, media_type=media_type(served), headers=headers)
+
+    return FileResponse(path, media_type=media_type(served), headers=headers, stat_result=stat)
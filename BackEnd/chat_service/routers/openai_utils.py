@@ -1,28 +1,56 @@
-from openai import AsyncOpenAI
 import os
 import re
 import logging
-from langdetect import detect
 from dotenv import load_dotenv
+from service.prompts import SUMMARY_PROMPT
+from service.response_cache import response_cache
+from service.llm_provider import llm_provider
+from service.language import language_detector
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 MODEL_RESPONSE = os.getenv("MODEL_AI")
 MODEL_TITLE = os.getenv("MODEL_TITLE")
+MODEL_SUMMARY = os.getenv("MODEL_SUMMARY") or MODEL_TITLE
 
-# Gọi OpenAI API để lấy phản hồi từ mô hình (stream)
+RESPONSE_TEMPERATURE = 0.7
+RESPONSE_MAX_TOKENS = 1500
+
+# Gọi mô hình (qua LLM_PROVIDER) để lấy phản hồi dạng stream, mỗi phần tử là một đoạn text
 async def generate_response(chatlog):
-    return await client.chat.completions.create(
-        model=MODEL_RESPONSE,
-        messages=chatlog,
-        temperature=0.7,
-        max_tokens=1500,
-        stream=True
+    # Context ngắn có thể đã có phản hồi trong cache (khi RESPONSE_CACHE_ENABLED)
+    cache_key = response_cache.key_for(chatlog, MODEL_RESPONSE, RESPONSE_TEMPERATURE)
+    if cache_key:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return response_cache.replay(cached)
+    stream = llm_provider.stream_chat(chatlog, MODEL_RESPONSE, RESPONSE_TEMPERATURE, RESPONSE_MAX_TOKENS)
+    if cache_key:
+        return response_cache.record(cache_key, stream)
+    return stream
+
+async def generate_summary(previous_summary: str, messages: list[dict], max_tokens: int = 400) -> str:
+    """Gộp các lượt hội thoại cũ vào bản tóm tắt hiện có (tóm tắt tăng dần)."""
+    transcript = "\n".join(f"{m.get('role')}: {m.get('content', '')}" for m in messages)
+    prompt = SUMMARY_PROMPT.format(
+        previous_summary=previous_summary or "(chưa có)",
+        transcript=transcript,
+        max_words=max_tokens // 2,
     )
-
-async def generate_title(messages: list[dict]) -> str:
+    summary = await llm_provider.complete([{"role": "user", "content": prompt}], MODEL_SUMMARY, 0.2, max_tokens)
+    return summary.strip()
+
+def heuristic_title(text: str, max_words: int = 6, max_chars: int = 40) -> str:
+    """Tiêu đề rút ra trực tiếp từ câu hỏi (không gọi mô hình), dùng khi gọi mô hình thất bại."""
+    line = next((l.strip() for l in (text or "").splitlines() if l.strip()), "")
+    words = re.sub(r"[^\w\s'-]", " ", line).split()[:max_words]
+    title = " ".join(words)
+    if len(title) > max_chars:
+        title = title[:max_chars].rsplit(" ", 1)[0] or title[:max_chars]
+    return title[:1].upper() + title[1:]
+
+async def generate_title(messages: list[dict], user_id: int = None) -> str:
     """
     Generate a natural ChatGPT-style conversation title (vi/en).
     - No word-splitting
@@ -51,11 +79,8 @@ async def generate_title(messages: list[dict]) -> str:
     context = user_message.split("\n")[0].strip()
     context = context[:200]
 
-    # Detect language
-    try:
-        lang = detect(context)
-    except Exception:
-        lang = "vi"
+    # Detect language (nhánh nhanh vi/en, câu mơ hồ dùng ngôn ngữ quen dùng của user)
+    lang = await language_detector.detect_for_user(context, user_id)
 
     if lang.startswith("vi"):
         default_title = DEFAULT_TITLE_VI
@@ -86,14 +111,7 @@ async def generate_title(messages: list[dict]) -> str:
         )
 
     try:
-        response = await client.chat.completions.create(
-            model=MODEL_TITLE,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.4,
-            max_tokens=20,
-        )
-
-        title = response.choices[0].message.content.strip()
+        title = (await llm_provider.complete([{"role": "user", "content": prompt}], MODEL_TITLE, 0.4, 20)).strip()
 
         # Clean nhẹ – KHÔNG phá nghĩa
         title = title.replace("\n", " ").strip()
@@ -103,9 +121,11 @@ async def generate_title(messages: list[dict]) -> str:
         if len(title) > 40:
             title = title[:40].rstrip()
 
-        return title if len(title) >= 3 else default_title
-
+        if len(title) >= 3:
+            return title
     except Exception as e:
         logger.error(f"generate_title error: {e}")
-        return default_title
+    # Mô hình lỗi hoặc trả về rỗng: lấy tiêu đề từ chính câu hỏi
+    fallback = heuristic_title(context)
+    return fallback if len(fallback) >= 3 else default_title
 
@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from db_config import db_dependency, SessionLocal
+from sqlalchemy import select, func
+from db_config import db_dependency, AsyncSessionLocal
 from models import ViolationLog
 from schemas import ViolationLogCreate, ViolationLogOut
 from connect_service import get_current_user
@@ -12,8 +13,8 @@ router = APIRouter(prefix="/api/chatbot_service", tags=["violation_log"])
 async def get_violation_log(db: db_dependency, page: int=1, limit: int=10, current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này!!!")
-    violation_log = db.query(ViolationLog).order_by(ViolationLog.id.desc()).offset((page - 1)*limit).limit(limit).all()
-    total_violation_log = db.query(ViolationLog).count()
+    violation_log = (await db.scalars(select(ViolationLog).order_by(ViolationLog.id.desc()).offset((page - 1)*limit).limit(limit))).all()
+    total_violation_log = await db.scalar(select(func.count(ViolationLog.id)))
     violation_log_list = [ViolationLogOut.from_orm(v).model_dump() for v in violation_log]
     return {
         "detail": "Danh sách vi phạm",
@@ -26,11 +27,11 @@ async def get_violation_log(db: db_dependency, page: int=1, limit: int=10, curre
 async def delete_violation_log(violation_log_id: int, db: db_dependency, current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này!!!")
-    violation_log = db.query(ViolationLog).filter(ViolationLog.id == violation_log_id).first()
+    violation_log = await db.get(ViolationLog, violation_log_id)
     if not violation_log:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Vi phạm không tồn tại!!!")
-    db.delete(violation_log)
-    db.commit()
+    await db.delete(violation_log)
+    await db.commit()
     return {
         "detail": "Vi phạm đã được xóa thành công"
     }
@@ -41,26 +42,24 @@ async def test_create_violation_log(current_user: dict = Depends(get_current_use
     if current_user["role"] != "Admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bạn không có quyền truy cập vào tài nguyên này!!!")
     
-    test_db = SessionLocal()
     try:
-        # Test lưu vi phạm
-        test_user_id = current_user["user_id"]
-        test_message = "Test violation message"
-        test_level = 1
-        
-        violation = await log_violation_to_db(test_user_id, test_message, test_level, test_db)
-        
-        logger.info(f"Test: Đã tạo violation log với ID: {violation.id}")
-        
-        return {
-            "detail": "Test violation log đã được tạo thành công",
-            "violation_id": violation.id,
-            "user_id": violation.user_id,
-            "level": violation.level,
-            "message": violation.message
-        }
+        async with AsyncSessionLocal() as test_db:
+            # Test lưu vi phạm
+            test_user_id = current_user["user_id"]
+            test_message = "Test violation message"
+            test_level = 1
+
+            violation = await log_violation_to_db(test_user_id, test_message, test_level, test_db)
+
+            logger.info(f"Test: Đã tạo violation log với ID: {violation.id}")
+
+            return {
+                "detail": "Test violation log đã được tạo thành công",
+                "violation_id": violation.id,
+                "user_id": violation.user_id,
+                "level": violation.level,
+                "message": violation.message
+            }
     except Exception as e:
         logger.error(f"Test: Lỗi khi tạo violation log: {e}", exc_info=True)
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Lỗi khi tạo test violation log: {str(e)}")
-    finally:
-        test_db.close()
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Lỗi khi tạo test violation log: {str(e)}")
\ No newline at end of file
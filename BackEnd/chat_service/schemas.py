@@ -1,7 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, computed_field
 from typing import Optional, List
 from datetime import datetime
 from uuid import UUID
+from utils.image_names import rendition_url
 
 # ========== Chat Session ==========
 
@@ -100,9 +101,27 @@ class ImageOut(BaseModel):
     description: Optional[str] = None
     created_at: datetime
 
+    # Bản thu nhỏ WebP cho lưới ảnh, suy ra từ tên file (không I/O); ảnh cũ thì trả về URL gốc
+    @computed_field
+    @property
+    def thumbnail_url(self) -> str:
+        return rendition_url(self.url, "thumb")
+
+    @computed_field
+    @property
+    def medium_url(self) -> str:
+        return rendition_url(self.url, "medium")
+
     model_config = {
         "from_attributes": True
     }
+class ImageJobOut(BaseModel):
+    job_id: str
+    status: str  # queued | running | done | failed
+    image: Optional[ImageOut] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+
 class UpdateImageDescription(BaseModel):
     description: str
 
@@ -0,0 +1,107 @@
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_Item = Tuple[Optional[Dict[str, Any]], asyncio.Future]
+
+
+class BatchWriter:
+    """
+    Khung chung cho việc ghi DB theo lô ở nền: một task duy nhất lấy dòng từ hàng đợi có giới hạn
+    (đầy thì người gọi phải chờ - backpressure), gom tối đa `batch_size` dòng hoặc chờ `flush_ms`
+    rồi gọi `_write` một lần cho cả lô. Lớp con chỉ cần cài đặt `_write`.
+    """
+
+    name = "batch_writer"
+
+    def __init__(self, flush_ms: int, batch_size: int, queue_size: int):
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = batch_size
+        self.queue: "asyncio.Queue[_Item]" = asyncio.Queue(maxsize=queue_size)
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"rows": 0, "batches": 0, "failed": 0}
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def enqueue(self, row: Dict[str, Any]) -> asyncio.Future:
+        """Đưa một dòng vào hàng ghi; future trả về True/False khi lô chứa dòng đó đã ghi xong."""
+        self.start()
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, done))
+        return done
+
+    async def flush(self):
+        """Chờ tới khi mọi dòng đã đưa vào hàng trước lời gọi này được ghi xuống DB."""
+        if self._worker is None or self._worker.done():
+            return
+        done = asyncio.get_running_loop().create_future()
+        # Marker đi theo thứ tự FIFO nên khi nó được xử lý, mọi dòng trước nó đã được ghi
+        await self.queue.put((None, done))
+        await done
+
+    async def stop(self):
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except BaseException:
+                pass
+            self._worker = None
+
+    async def _collect(self, first: _Item) -> Tuple[List[_Item], List[asyncio.Future]]:
+        batch: List[_Item] = []
+        markers: List[asyncio.Future] = []
+        item = first
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while True:
+            if item[0] is None:
+                markers.append(item[1])
+                break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            try:
+                item = self.queue.get_nowait()
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return batch, markers
+
+    async def _run(self):
+        while True:
+            batch, markers = await self._collect(await self.queue.get())
+            if batch:
+                started = time.perf_counter()
+                try:
+                    results = await self._write([row for row, _ in batch])
+                except Exception as e:
+                    logger.error(f"[{self.name}] Ghi lô {len(batch)} dòng thất bại: {e}", exc_info=True)
+                    results = [False] * len(batch)
+                for (_, done), ok in zip(batch, results):
+                    if not done.done():
+                        done.set_result(ok)
+                self.stats["batches"] += 1
+                self.stats["rows"] += sum(results)
+                self.stats["failed"] += len(results) - sum(results)
+                logger.debug(f"[{self.name}] Ghi {len(batch)} dòng trong {(time.perf_counter() - started) * 1000:.1f}ms")
+            for done in markers:
+                if not done.done():
+                    done.set_result(True)
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> List[bool]:
+        """Ghi một lô; trả về kết quả từng dòng theo đúng thứ tự."""
+        raise NotImplementedError
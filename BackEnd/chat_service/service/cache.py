@@ -1,29 +1,101 @@
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
 from service.redis_client import redis_client
-from db_config import SessionLocal, db_dependency
+from service.keyword_matcher import KeywordMatcher
+from sqlalchemy import select
+from db_config import AsyncSessionLocal
 from models import BannedKeywords
 
+logger = logging.getLogger(__name__)
+
 BANNED_KEYWORDS_KEY = "banned_keywords"
+BANNED_KEYWORDS_VERSION_KEY = "banned_keywords:version"
 BANNED_KEYWORDS_TTL = 3600  # TTL 1 giờ
+# Khoảng thời gian tối thiểu (giây) giữa hai lần kiểm tra version trên Redis
+BANNED_KEYWORDS_CHECK_INTERVAL = float(os.getenv("BANNED_KEYWORDS_CHECK_INTERVAL", "2"))
+
+
+class _MatcherState:
+    """Bộ so khớp đang dùng trong tiến trình cùng version đã dựng nó."""
+
+    def __init__(self):
+        self.matcher: Optional[KeywordMatcher] = None
+        self.version: Optional[str] = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+
+
+_state = _MatcherState()
+
+
+async def _load_keywords_from_db() -> List[str]:
+    async with AsyncSessionLocal() as db:
+        keywords = await db.scalars(select(BannedKeywords.keyword))
+        return list(keywords)
+
+
+async def _store_keywords(keywords: List[str]):
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(BANNED_KEYWORDS_KEY)
+    if keywords:
+        pipe.sadd(BANNED_KEYWORDS_KEY, *keywords)
+        pipe.expire(BANNED_KEYWORDS_KEY, BANNED_KEYWORDS_TTL)
+    await pipe.execute()
 
-async def load_keywords_from_cache():
-    """Lấy danh sách từ khóa vi phạm trực tiếp từ DB"""
-    db = SessionLocal()
+
+async def load_keywords_from_cache() -> List[str]:
+    """Lấy danh sách từ khóa vi phạm từ Redis, nếu cache trống thì nạp lại từ DB"""
+    try:
+        keywords = await redis_client.smembers(BANNED_KEYWORDS_KEY)
+        if keywords:
+            return list(keywords)
+    except Exception as e:
+        logger.warning(f"Không thể đọc từ khóa bị cấm từ Redis: {e}")
+    keywords = await _load_keywords_from_db()
     try:
-        # Lấy tất cả keyword từ bảng BannedKeywords
-        keywords = db.query(BannedKeywords.keyword).all()
-        # db.query trả về list tuple, nên chuyển sang list str
-        return [k[0] for k in keywords]
-    finally:
-        db.close()
+        await _store_keywords(keywords)
+    except Exception as e:
+        logger.warning(f"Không thể lưu từ khóa bị cấm vào Redis: {e}")
+    return keywords
+
 
 async def refresh_keywords_cache():
-    db = SessionLocal()
+    """Nạp lại từ khóa từ DB vào Redis và tăng version để mọi worker dựng lại bộ so khớp"""
+    keywords = await _load_keywords_from_db()
+    await _store_keywords(keywords)
+    version = await redis_client.incr(BANNED_KEYWORDS_VERSION_KEY)
+    logger.info(f"Đã làm mới cache từ khóa bị cấm: {len(keywords)} từ khóa, version={version}")
+
+
+async def get_keyword_matcher() -> KeywordMatcher:
+    """
+    Trả về bộ so khớp từ khóa đã biên dịch sẵn trong bộ nhớ tiến trình.
+    Chỉ dựng lại khi version trên Redis thay đổi; version được kiểm tra tối đa
+    mỗi BANNED_KEYWORDS_CHECK_INTERVAL giây nên phần lớn tin nhắn không tốn round trip nào.
+    """
+    now = time.monotonic()
+    if _state.matcher is not None and now - _state.checked_at < BANNED_KEYWORDS_CHECK_INTERVAL:
+        return _state.matcher
     try:
-        await redis_client.delete(BANNED_KEYWORDS_KEY)
-        keywords = db.query(BannedKeywords.keyword).all()
-        keywords = [k[0] for k in keywords]  # convert từ tuple sang str
-        if keywords:
-            await redis_client.sadd(BANNED_KEYWORDS_KEY, *keywords)
-            await redis_client.expire(BANNED_KEYWORDS_KEY, BANNED_KEYWORDS_TTL)
-    finally:
-        db.close()
+        version = await redis_client.get(BANNED_KEYWORDS_VERSION_KEY) or "0"
+    except Exception as e:
+        logger.warning(f"Không thể đọc version từ khóa bị cấm từ Redis: {e}")
+        version = _state.version
+    return await _ensure_matcher(version, now)
+
+
+async def _ensure_matcher(version: Optional[str], now: float) -> KeywordMatcher:
+    if _state.matcher is not None and version == _state.version:
+        _state.checked_at = now
+        return _state.matcher
+    async with _state.lock:
+        if _state.matcher is None or version != _state.version:
+            keywords = await load_keywords_from_cache()
+            _state.matcher = KeywordMatcher(keywords)
+            _state.version = version
+            logger.info(f"Đã dựng bộ so khớp từ khóa bị cấm: {len(_state.matcher)} từ khóa, version={version}")
+        _state.checked_at = now
+    return _state.matcher
@@ -0,0 +1,196 @@
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+import logging
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set
+from service.redis_client import redis_client
+from service.prompts import SUMMARY_CONTEXT_PREFIX
+from service.context_cache import CHAT_CONTEXT_MAX_MESSAGES
+from routers.openai_utils import generate_summary
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken là tùy chọn, thiếu thì ước lượng theo số ký tự
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Ngân sách token cho toàn bộ prompt gửi lên mô hình (system + tóm tắt + lịch sử)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# Số token dành sẵn cho bản tóm tắt các lượt cũ
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "400"))
+CONTEXT_SUMMARY_TTL = int(os.getenv("CONTEXT_SUMMARY_TTL", str(7 * 86400)))
+# Khi cửa sổ lịch sử của context_cache đã đầy: gộp vào bản tóm tắt ngay khi tin nhắn chưa tóm tắt
+# cũ nhất cách vị trí bị đẩy ra khỏi cửa sổ chưa tới N tin nhắn (mỗi đợt gộp khoảng 2N tin nhắn),
+# để không lượt nào rời cửa sổ mà chưa được tóm tắt
+CONTEXT_SUMMARY_FOLD_AHEAD = int(os.getenv("CONTEXT_SUMMARY_FOLD_AHEAD", "6"))
+# Token cộng thêm cho mỗi message (role, phân cách) theo định dạng chat của OpenAI
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _load_encoding():
+    if tiktoken is None:
+        return None
+    model = os.getenv("MODEL_AI") or ""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+_encoding = _load_encoding()
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Đếm token bằng tokenizer cục bộ (tiktoken); thiếu tiktoken thì ước lượng ~3 ký tự/token."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 3 + 1
+
+
+def count_message_tokens(message: Dict[str, Any]) -> int:
+    return count_tokens(message.get("content") or "") + _MESSAGE_OVERHEAD_TOKENS
+
+
+def _fingerprint(message: Dict[str, Any]) -> str:
+    raw = f"{message.get('role')}\x00{message.get('content') or ''}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class RollingSummaryStore:
+    """
+    Bản tóm tắt các lượt hội thoại cũ của từng chat, lưu trên Redis.
+    Bản ghi gồm nội dung tóm tắt và fingerprint của tin nhắn cuối cùng đã được gộp,
+    nhờ đó lần sau chỉ cần gộp thêm các tin nhắn mới bị đẩy ra khỏi ngân sách.
+    """
+
+    def __init__(self, ttl: int, max_tokens: int):
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def _key(chat_id: str) -> str:
+        return f"chat_summary:{chat_id}"
+
+    async def load(self, chat_id: str) -> Dict[str, Any]:
+        try:
+            raw = await redis_client.get(self._key(chat_id))
+            if raw:
+                return json.loads(raw)
+        except Exception as e:
+            logger.warning(f"Không thể đọc bản tóm tắt chat {chat_id}: {e}")
+        return {}
+
+    def schedule_refresh(self, chat_id: str, state: Dict[str, Any], pending: List[Dict[str, Any]]):
+        """Gộp các tin nhắn mới vào bản tóm tắt ở nền; mỗi chat chỉ chạy một lần tại một thời điểm."""
+        if not pending or chat_id in self._refreshing:
+            return
+        self._refreshing.add(chat_id)
+        task = asyncio.create_task(self._refresh(chat_id, state.get("summary", ""), pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, chat_id: str, previous_summary: str, pending: List[Dict[str, Any]]):
+        try:
+            summary = await generate_summary(previous_summary, pending, max_tokens=self.max_tokens)
+            if not summary:
+                return
+            record = {"summary": summary, "last": _fingerprint(pending[-1])}
+            await redis_client.set(self._key(chat_id), json.dumps(record, ensure_ascii=False), ex=self.ttl)
+            logger.info(f"[context] Đã cập nhật bản tóm tắt chat {chat_id}: gộp thêm {len(pending)} tin nhắn")
+        except Exception as e:
+            logger.warning(f"[context] Không thể tạo bản tóm tắt chat {chat_id}: {e}")
+        finally:
+            self._refreshing.discard(chat_id)
+
+    async def close(self):
+        """Hủy các lần gộp tóm tắt đang chạy (gọi khi shutdown)."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._refreshing.clear()
+
+
+summary_store = RollingSummaryStore(ttl=CONTEXT_SUMMARY_TTL, max_tokens=CONTEXT_SUMMARY_MAX_TOKENS)
+
+
+def _covered_until(history: List[Dict[str, Any]], last_fingerprint: Optional[str]) -> int:
+    """Vị trí ngay sau tin nhắn cuối cùng đã được gộp vào bản tóm tắt (0 nếu nó không còn trong lịch sử)."""
+    if last_fingerprint:
+        for i in range(len(history) - 1, -1, -1):
+            if _fingerprint(history[i]) == last_fingerprint:
+                return i + 1
+    return 0
+
+
+async def build_context(
+    chat_id: uuid.UUID,
+    chat_log: List[Dict[str, Any]],
+    budget: int = CONTEXT_TOKEN_BUDGET,
+) -> List[Dict[str, Any]]:
+    """
+    Dựng context gửi cho mô hình trong ngân sách token:
+    - Giữ system prompt, lấp lịch sử từ mới đến cũ cho tới khi hết ngân sách.
+    - Các lượt cũ bị loại được thay bằng bản tóm tắt đã cache; phần chưa tóm tắt được gộp ở nền.
+    - Khi cửa sổ lịch sử đã đầy, các tin nhắn sắp rời cửa sổ cũng được gộp trước vào bản tóm tắt.
+    Tin nhắn mới nhất luôn được giữ lại dù vượt ngân sách.
+    """
+    system = [m for m in chat_log[:1] if m.get("role") == "system"]
+    history = chat_log[len(system):]
+
+    system_tokens = sum(count_message_tokens(m) for m in system)
+    history_tokens = [count_message_tokens(m) for m in history]
+    full_tokens = system_tokens + sum(history_tokens)
+    window_full = len(history) >= CHAT_CONTEXT_MAX_MESSAGES
+    if full_tokens <= budget and not window_full:
+        logger.debug(f"[context] chat {chat_id}: {full_tokens} tokens, nằm trong ngân sách {budget}")
+        return list(chat_log)
+
+    kept_from = 0
+    if full_tokens > budget:
+        remaining = budget - system_tokens - CONTEXT_SUMMARY_MAX_TOKENS - _MESSAGE_OVERHEAD_TOKENS
+        used = 0
+        kept_from = len(history)
+        for i in range(len(history) - 1, -1, -1):
+            if kept_from < len(history) and used + history_tokens[i] > remaining:
+                break
+            used += history_tokens[i]
+            kept_from = i
+
+    key = str(chat_id)
+    state = await summary_store.load(key)
+    covered = _covered_until(history, state.get("last"))
+    fold_until = kept_from
+    if window_full:
+        # Tin nhắn chưa tóm tắt cũ nhất sắp rời cửa sổ lịch sử: gộp trước một đợt khi nó vẫn còn
+        # trong context_cache (mỗi lượt chat đẩy ra 2 tin nhắn)
+        if covered < CONTEXT_SUMMARY_FOLD_AHEAD:
+            fold_until = max(fold_until, len(history) - max(CHAT_CONTEXT_MAX_MESSAGES - 2 * CONTEXT_SUMMARY_FOLD_AHEAD, 1))
+        # Phần đã nằm trong bản tóm tắt không cần gửi lại nguyên văn
+        kept_from = max(kept_from, covered)
+    summary_store.schedule_refresh(key, state, history[covered:fold_until])
+    kept = history[kept_from:]
+    dropped = history[:kept_from]
+
+    context = list(system)
+    summary = state.get("summary")
+    if summary:
+        context.append({"role": "system", "content": SUMMARY_CONTEXT_PREFIX + summary})
+    context.extend(kept)
+
+    sent_tokens = sum(count_message_tokens(m) for m in context)
+    logger.info(
+        f"[context] chat {chat_id}: gửi {sent_tokens}/{full_tokens} tokens, tiết kiệm {full_tokens - sent_tokens} tokens "
+        f"({len(dropped)} tin nhắn cũ {'được tóm tắt' if summary else 'bị lược bỏ'})"
+    )
+    return context
@@ -0,0 +1,139 @@
+import os
+import json
+import uuid
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+from service.redis_client import redis_client
+from db_config import db_dependency
+from crud import get_recent_messages
+
+logger = logging.getLogger(__name__)
+
+CHAT_CONTEXT_MAX_MESSAGES = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", "40"))
+CHAT_CONTEXT_MAX_CHATS = int(os.getenv("CHAT_CONTEXT_MAX_CHATS", "1000"))
+CHAT_CONTEXT_REDIS = os.getenv("CHAT_CONTEXT_REDIS", "false").lower() in ("1", "true", "yes")
+CHAT_CONTEXT_REDIS_TTL = int(os.getenv("CHAT_CONTEXT_REDIS_TTL", "3600"))
+# Phần tử đánh dấu "đã nạp" ở đầu Redis list: chat chưa có tin nhắn vẫn có list để append (RPUSHX)
+# ghi vào; bị LTRIM cắt khi list đầy, lúc đó list đã không rỗng nên không cần nữa
+_LOADED_MARKER = ""
+
+# Context trong bộ nhớ tiến trình không được đồng bộ giữa các worker
+if os.getenv("WS_BACKEND", "memory").lower() == "redis" and not CHAT_CONTEXT_REDIS:
+    logger.warning("WS_BACKEND=redis nhưng CHAT_CONTEXT_REDIS tắt: context chat chỉ đúng khi chạy một worker")
+
+
+class ChatContextCache:
+    """
+    Cache ngữ cảnh hội thoại theo từng chat (N tin nhắn gần nhất), có hai chế độ:
+    - CHAT_CONTEXT_REDIS bật: Redis list có TTL là nguồn duy nhất, mọi worker đọc/ghi cùng một
+      list nên tin nhắn từ worker khác và việc xóa tin nhắn đều được thấy ngay. Miss thì nạp từ DB.
+    - CHAT_CONTEXT_REDIS tắt: deque trong bộ nhớ tiến trình (LRU theo số chat), không được đồng bộ
+      hay vô hiệu hóa giữa các worker nên CHỈ ĐÚNG khi chạy một worker.
+    """
+
+    def __init__(self, max_messages: int, max_chats: int, use_redis: bool, redis_ttl: int):
+        self.max_messages = max_messages
+        self.max_chats = max_chats
+        self.use_redis = use_redis
+        self.redis_ttl = redis_ttl
+        self._contexts: "OrderedDict[str, Deque[Dict[str, str]]]" = OrderedDict()
+
+    @staticmethod
+    def _redis_key(chat_id: str) -> str:
+        return f"chat_context:{chat_id}"
+
+    def _remember(self, chat_id: str, messages: List[Dict[str, str]]) -> Deque[Dict[str, str]]:
+        context = deque(messages, maxlen=self.max_messages)
+        self._contexts[chat_id] = context
+        self._contexts.move_to_end(chat_id)
+        while len(self._contexts) > self.max_chats:
+            self._contexts.popitem(last=False)
+        return context
+
+    async def _load_from_redis(self, chat_id: str) -> Optional[List[Dict[str, str]]]:
+        if not self.use_redis:
+            return None
+        try:
+            raw = await redis_client.lrange(self._redis_key(chat_id), 0, -1)
+        except Exception as e:
+            logger.warning(f"Không thể đọc context chat {chat_id} từ Redis: {e}")
+            return None
+        if not raw:
+            return None
+        return [json.loads(item) for item in raw if item != _LOADED_MARKER]
+
+    async def _mirror(self, chat_id: str, messages: List[Dict[str, str]]):
+        if not self.use_redis:
+            return
+        key = self._redis_key(chat_id)
+        try:
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.delete(key)
+            pipe.rpush(key, _LOADED_MARKER, *[json.dumps(m, ensure_ascii=False) for m in messages])
+            pipe.expire(key, self.redis_ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Không thể mirror context chat {chat_id} sang Redis: {e}")
+
+    async def get(self, chat_id: uuid.UUID, db: db_dependency) -> List[Dict[str, str]]:
+        """Trả về bản sao danh sách tin nhắn gần nhất (cũ -> mới) của chat."""
+        key = str(chat_id)
+        if not self.use_redis:
+            context = self._contexts.get(key)
+            if context is not None:
+                self._contexts.move_to_end(key)
+                return list(context)
+
+        messages = await self._load_from_redis(key)
+        if messages is None:
+            rows = await get_recent_messages(db, chat_id, limit=self.max_messages)
+            messages = [{"role": m.role, "content": m.content} for m in rows]
+            await self._mirror(key, messages)
+            logger.debug(f"Nạp context chat {chat_id} từ DB: {len(messages)} tin nhắn")
+        if self.use_redis:
+            return messages
+        return list(self._remember(key, messages))
+
+    async def warm(self, chat_id: uuid.UUID, db: db_dependency):
+        """Nạp sẵn context khi websocket kết nối."""
+        await self.get(chat_id, db)
+
+    async def append(self, chat_id: uuid.UUID, role: str, content: str):
+        """Thêm tin nhắn vừa được lưu vào context (không làm gì nếu chat chưa được nạp)."""
+        key = str(chat_id)
+        message = {"role": role, "content": content}
+        if not self.use_redis:
+            context = self._contexts.get(key)
+            if context is not None:
+                context.append(message)
+            return
+        redis_key = self._redis_key(key)
+        try:
+            # RPUSHX: chỉ ghi khi list đã được nạp (kể cả chat rỗng, nhờ _LOADED_MARKER), tránh tạo list thiếu lịch sử
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.rpushx(redis_key, json.dumps(message, ensure_ascii=False))
+            pipe.ltrim(redis_key, -self.max_messages, -1)
+            pipe.expire(redis_key, self.redis_ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Không thể cập nhật context chat {chat_id} trên Redis: {e}")
+
+    async def invalidate(self, chat_id: uuid.UUID):
+        """Xóa context khi lịch sử bị sửa (xóa tin nhắn / xóa chat)."""
+        key = str(chat_id)
+        self._contexts.pop(key, None)
+        if not self.use_redis:
+            return
+        try:
+            await redis_client.delete(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"Không thể xóa context chat {chat_id} trên Redis: {e}")
+
+
+context_cache = ChatContextCache(
+    max_messages=CHAT_CONTEXT_MAX_MESSAGES,
+    max_chats=CHAT_CONTEXT_MAX_CHATS,
+    use_redis=CHAT_CONTEXT_REDIS,
+    redis_ttl=CHAT_CONTEXT_REDIS_TTL,
+)
@@ -0,0 +1,175 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from fastapi import HTTPException, status
+from db_config import AsyncSessionLocal
+from crud import create_image
+from schemas import ImageCreate
+from service.redis_client import redis_client
+from service.llm_provider import llm_provider, LLMError
+from service.image_store import image_store
+
+logger = logging.getLogger(__name__)
+
+# Số worker gọi mô hình tạo ảnh song song trong một tiến trình và giới hạn hàng đợi
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", "4"))
+IMAGE_JOB_QUEUE_SIZE = int(os.getenv("IMAGE_JOB_QUEUE_SIZE", "100"))
+# Số job (đang chờ + đang chạy) tối đa của một user
+IMAGE_JOB_PER_USER = int(os.getenv("IMAGE_JOB_PER_USER", "2"))
+# Thời gian giữ trạng thái job trên Redis (giây)
+IMAGE_JOB_TTL = int(os.getenv("IMAGE_JOB_TTL", "3600"))
+# Thời gian tối đa cho một lần gọi tạo ảnh (giây)
+IMAGE_JOB_TIMEOUT = float(os.getenv("IMAGE_JOB_TIMEOUT", "180"))
+
+_JOB_KEY = "image_job:{}"
+_ACTIVE_KEY = "image_jobs:active:{}"
+
+
+class ImageJobQueue:
+    """
+    Tạo ảnh dưới dạng job nền: submit trả về job_id ngay, một nhóm worker cố định gọi provider
+    (async) rồi lưu file + DB; trạng thái job nằm trên Redis để client hỏi lại (polling).
+    Số job đồng thời của mỗi user được đếm trên Redis nên giới hạn đúng cả khi chạy nhiều instance.
+    """
+
+    def __init__(self, workers: int, queue_size: int, per_user: int, ttl: int, timeout: float):
+        self.workers = workers
+        self.per_user = per_user
+        self.ttl = ttl
+        self.timeout = timeout
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"submitted": 0, "done": 0, "failed": 0}
+
+    def start(self):
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except BaseException:
+                pass
+        self._tasks = []
+        # Job còn trong hàng đợi sẽ không được chạy nữa
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            await self._finish(job, {"status": "failed", "status_code": 503, "error": "Dịch vụ đang khởi động lại, vui lòng thử lại."})
+
+    async def _set(self, job_id: str, fields: Dict[str, Any]):
+        key = _JOB_KEY.format(job_id)
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(key, mapping={k: v if isinstance(v, str) else json.dumps(v) for k, v in fields.items()})
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def submit(self, user_id: int, prompt: str, base_url: str) -> str:
+        """Đưa yêu cầu tạo ảnh vào hàng đợi; 429 nếu user đã đủ số job hoặc hàng đợi đầy."""
+        active_key = _ACTIVE_KEY.format(user_id)
+        active = await redis_client.incr(active_key)
+        # Hết hạn phòng khi tiến trình chết giữa chừng và không kịp giảm bộ đếm
+        await redis_client.expire(active_key, int(self.timeout) * 2 + 60)
+        if active > self.per_user:
+            await redis_client.decr(active_key)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"Bạn chỉ có thể tạo tối đa {self.per_user} ảnh cùng lúc. Vui lòng chờ ảnh trước hoàn tất."
+            )
+        job = {"job_id": uuid.uuid4().hex, "user_id": user_id, "prompt": prompt, "base_url": base_url}
+        try:
+            await self._set(job["job_id"], {"status": "queued", "user_id": str(user_id)})
+            self.start()
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            await redis_client.decr(active_key)
+            await redis_client.delete(_JOB_KEY.format(job["job_id"]))
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Hệ thống đang bận tạo ảnh, vui lòng thử lại sau.")
+        except Exception:
+            await redis_client.decr(active_key)
+            raise
+        self.stats["submitted"] += 1
+        return job["job_id"]
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        data = await redis_client.hgetall(_JOB_KEY.format(job_id))
+        if not data:
+            return None
+        job = {"job_id": job_id, "status": data["status"], "user_id": int(data["user_id"])}
+        if "image" in data:
+            job["image"] = json.loads(data["image"])
+        if "error" in data:
+            job["error"] = data["error"]
+            job["status_code"] = int(data.get("status_code", 500))
+        return job
+
+    async def _finish(self, job: Dict[str, Any], fields: Dict[str, Any]):
+        self.stats["done" if fields["status"] == "done" else "failed"] += 1
+        try:
+            await self._set(job["job_id"], fields)
+        finally:
+            await redis_client.decr(_ACTIVE_KEY.format(job["user_id"]))
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._set(job["job_id"], {"status": "running"})
+                image = await self._generate(job)
+                await self._finish(job, {"status": "done", "image": image})
+                logger.info(f"Tạo ảnh thành công cho user_id={job['user_id']}: {job['prompt']}")
+            except asyncio.CancelledError:
+                await self._finish(job, {"status": "failed", "status_code": 503, "error": "Dịch vụ đang khởi động lại, vui lòng thử lại."})
+                raise
+            except HTTPException as e:
+                await self._finish(job, {"status": "failed", "status_code": e.status_code, "error": str(e.detail)})
+            except Exception as e:
+                logger.exception(f"Lỗi không xác định khi tạo ảnh (job {job['job_id']}): {e}")
+                await self._finish(job, {"status": "failed", "status_code": 500, "error": f"Lỗi khi tạo ảnh: {str(e)}"})
+            finally:
+                self.queue.task_done()
+
+    async def _generate(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = job["prompt"]
+        try:
+            image_bytes = await asyncio.wait_for(llm_provider.generate_image(prompt, size="1024x1024"), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Tạo ảnh quá thời gian cho phép, vui lòng thử lại.")
+        except LLMError as oe:
+            err_str = str(oe)
+            logger.error(f"Lỗi OpenAI: {err_str}")
+            if "moderation_blocked" in err_str or "safety_violations" in err_str:
+                raise HTTPException(status_code=400, detail="Prompt bị hệ thống an toàn OpenAI từ chối.")
+            raise HTTPException(status_code=502, detail=f"Lỗi OpenAI: {err_str}")
+
+        filename, created = await image_store.save(image_bytes)
+
+        img_data = ImageCreate(
+            user_id=job["user_id"],
+            url=f"{job['base_url']}/static/images/{filename}",
+            description=prompt
+        )
+        try:
+            async with AsyncSessionLocal() as db:
+                saved = await create_image(db, img_data)
+        except Exception:
+            # Chỉ xóa file nếu chính job này vừa tạo ra nó
+            if created:
+                await image_store.delete(filename)
+            raise
+        return saved.model_dump(mode="json")
+
+
+image_jobs = ImageJobQueue(
+    workers=IMAGE_JOB_WORKERS,
+    queue_size=IMAGE_JOB_QUEUE_SIZE,
+    per_user=IMAGE_JOB_PER_USER,
+    ttl=IMAGE_JOB_TTL,
+    timeout=IMAGE_JOB_TIMEOUT,
+)
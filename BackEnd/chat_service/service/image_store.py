@@ -0,0 +1,156 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+import tempfile
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+from utils.image_names import is_hashed_name, rendition_name
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image as PILImage
+    PILImage.init()
+except ImportError:  # Pillow là tùy chọn: không có thì chỉ lưu ảnh gốc
+    PILImage = None
+
+UPLOAD_DIR = "upload/images"
+# Cạnh dài nhất (px) của từng bản thu nhỏ WebP sinh lúc lưu ảnh
+RENDITIONS: Dict[str, int] = {
+    "thumb": int(os.getenv("IMAGE_THUMB_SIZE", "256")),
+    "medium": int(os.getenv("IMAGE_MEDIUM_SIZE", "512")),
+}
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+# Định dạng thay thế cùng kích thước cho ảnh gốc, chọn theo header Accept (ưu tiên từ trên xuống)
+VARIANT_FORMATS = (("image/avif", "avif", "AVIF"), ("image/webp", "webp", "WEBP"))
+MEDIA_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+_IMMUTABLE_NAME = re.compile(r"^([0-9a-f]{64})(?:_[a-z]+)?\.([a-z]+)$")
+_RENDITION_NAME = re.compile(r"^([0-9a-f]{64})_[a-z]+\.webp$")
+_ORIGINAL_EXTS = ("png", "jpg", "jpeg", "webp")
+
+
+def immutable_etag(filename: str) -> Optional[str]:
+    """ETag mạnh suy ra từ tên file đặt theo hash (nội dung không bao giờ đổi), None với ảnh cũ."""
+    if not _IMMUTABLE_NAME.match(filename):
+        return None
+    return f'"{filename}"'
+
+
+def media_type(filename: str) -> str:
+    return MEDIA_TYPES.get(filename.rsplit(".", 1)[-1].lower(), "application/octet-stream")
+
+
+class ImageStore:
+    """
+    Lưu ảnh theo hash nội dung (sha256): cùng nội dung chỉ lưu một lần, tên file không đổi nên
+    có thể cache vĩnh viễn. Việc ghi file và sinh bản thu nhỏ WebP chạy trong thread riêng
+    để không chặn event loop.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.root, os.path.basename(filename))
+
+    def _write_atomic(self, filename: str, data: bytes):
+        path = self.path(filename)
+        # Tên tạm duy nhất cho mỗi lần ghi: nhiều thread (to_thread) có thể cùng ghi một file theo hash
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            # mkstemp tạo file 0600; giữ quyền đọc như file ghi bằng open() trước đây
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _render(self, filename: str, data: bytes):
+        if PILImage is None:
+            return
+        digest = filename.split(".", 1)[0]
+        with PILImage.open(BytesIO(data)) as source:
+            source = source.convert("RGBA") if source.mode in ("P", "LA") else source
+            for _, ext, fmt in VARIANT_FORMATS:
+                name = f"{digest}.{ext}"
+                if name == filename or fmt not in PILImage.SAVE or os.path.exists(self.path(name)):
+                    continue
+                out = BytesIO()
+                source.save(out, fmt, quality=IMAGE_WEBP_QUALITY)
+                self._write_atomic(name, out.getvalue())
+            for rendition, size in RENDITIONS.items():
+                name = rendition_name(filename, rendition)
+                if os.path.exists(self.path(name)):
+                    continue
+                image = source.copy()
+                image.thumbnail((size, size))
+                out = BytesIO()
+                image.save(out, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+                self._write_atomic(name, out.getvalue())
+
+    def _save(self, data: bytes, ext: str) -> Tuple[str, bool]:
+        filename = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        created = not os.path.exists(self.path(filename))
+        if created:
+            self._write_atomic(filename, data)
+        try:
+            self._render(filename, data)
+        except Exception as e:
+            logger.warning(f"Không thể tạo bản thu nhỏ cho {filename}: {e}")
+        return filename, created
+
+    async def save(self, data: bytes, ext: str = "png") -> Tuple[str, bool]:
+        """Lưu ảnh, trả về (tên file, True nếu file mới được tạo)."""
+        return await asyncio.to_thread(self._save, data, ext)
+
+    def _delete(self, filename: str):
+        names = [filename] + [n for n in (rendition_name(filename, r) for r in RENDITIONS) if n]
+        if is_hashed_name(filename):
+            digest = filename.split(".", 1)[0]
+            names += [f"{digest}.{ext}" for _, ext, _ in VARIANT_FORMATS if f"{digest}.{ext}" != filename]
+        for name in names:
+            path = self.path(name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def delete(self, filename: str):
+        """Xóa file gốc cùng các bản thu nhỏ."""
+        await asyncio.to_thread(self._delete, filename)
+
+    def negotiate(self, filename: str, accept: str) -> str:
+        """Chọn biến thể AVIF/WebP của ảnh gốc nếu client chấp nhận và file đã có sẵn."""
+        if not is_hashed_name(filename):
+            return filename
+        accept = (accept or "").lower()
+        digest = filename.split(".", 1)[0]
+        for mime, ext, _ in VARIANT_FORMATS:
+            name = f"{digest}.{ext}"
+            if mime in accept and (name == filename or os.path.exists(self.path(name))):
+                return name
+        return filename
+
+    def original_for(self, filename: str) -> Optional[str]:
+        """Ảnh gốc của một bản thu nhỏ chưa được tạo (thiếu Pillow hoặc lỗi khi render), nếu có."""
+        match = _RENDITION_NAME.match(filename)
+        if not match:
+            return None
+        for ext in _ORIGINAL_EXTS:
+            name = f"{match.group(1)}.{ext}"
+            if os.path.exists(self.path(name)):
+                return name
+        return None
+
+
+image_store = ImageStore(UPLOAD_DIR)
@@ -0,0 +1,71 @@
+import re
+from typing import Dict, Iterable, Optional
+
+# Ký tự đánh dấu kết thúc một từ khóa trong trie
+_END = ""
+
+
+def _build_trie(keywords: Iterable[str]) -> Dict[str, dict]:
+    trie: Dict[str, dict] = {}
+    for keyword in keywords:
+        node = trie
+        for ch in keyword:
+            node = node.setdefault(ch, {})
+        node[_END] = {}
+    return trie
+
+
+def _trie_to_pattern(node: Dict[str, dict]) -> Optional[str]:
+    """
+    Chuyển trie thành regex: các từ khóa chung tiền tố được gộp lại,
+    nên tại mỗi vị trí regex chỉ rẽ nhánh theo ký tự kế tiếp thay vì thử lần lượt từng từ khóa.
+    """
+    is_end = _END in node
+    children = sorted(ch for ch in node if ch != _END)
+    if not children:
+        return None
+
+    branches = []
+    leaves = []
+    for ch in children:
+        sub = _trie_to_pattern(node[ch])
+        if sub is None:
+            leaves.append(re.escape(ch))
+        else:
+            branches.append(re.escape(ch) + sub)
+    if leaves:
+        branches.append(leaves[0] if len(leaves) == 1 else "[" + "".join(leaves) + "]")
+
+    if is_end:
+        # Từ khóa ngắn hơn kết thúc tại đây, phần còn lại là tùy chọn
+        return "(?:" + "|".join(branches) + ")?"
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")"
+
+
+class KeywordMatcher:
+    """
+    Bộ so khớp từ khóa bị cấm được biên dịch một lần thành một regex duy nhất.
+    Giữ nguyên quy tắc word boundary cũ (r'\\b' + keyword + r'\\b') cho mọi từ khóa,
+    ví dụ: "class" không bị coi là chứa "ass".
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        normalized = sorted({k.strip().lower() for k in keywords if k and k.strip()})
+        self.keywords = normalized
+        body = _trie_to_pattern(_build_trie(normalized)) if normalized else None
+        self._regex = re.compile(r"\b(?:" + body + r")\b") if body else None
+
+    def __len__(self) -> int:
+        return len(self.keywords)
+
+    def find(self, message: str) -> Optional[str]:
+        """Trả về từ khóa bị cấm đầu tiên xuất hiện trong message, hoặc None."""
+        if self._regex is None or not message:
+            return None
+        match = self._regex.search(message.lower())
+        return match.group(0) if match else None
+
+    def contains(self, message: str) -> bool:
+        return self.find(message) is not None
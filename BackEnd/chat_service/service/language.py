@@ -0,0 +1,157 @@
+import re
+import asyncio
+import logging
+import unicodedata
+from typing import Optional
+from service.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+try:
+    from langdetect import DetectorFactory, detect as _full_detect
+    # langdetect mặc định ngẫu nhiên: cố định seed để cùng một câu luôn cho cùng kết quả
+    DetectorFactory.seed = 0
+except ImportError:  # langdetect là tùy chọn: không có thì chỉ dùng nhánh nhanh + memo theo user
+    _full_detect = None
+
+# Thời gian giữ thống kê ngôn ngữ của user trên Redis (giây)
+USER_LANGUAGE_TTL = 30 * 86400
+DEFAULT_LANGUAGE = "vi"
+_USER_KEY = "user_lang:{}"
+
+# Dấu (dạng tổ hợp sau NFD) hầu như chỉ tiếng Việt dùng: hỏi, nặng, móc (ơ, ư), trăng (ă); cộng chữ đ
+_VI_ONLY_MARKS = frozenset("\u0309\u0323\u031b\u0306đ")
+# Dấu tiếng Việt dùng chung với các ngôn ngữ Latin khác: huyền, sắc, ngã, mũ (â, ê, ô)
+_VI_SHARED_MARKS = frozenset("\u0300\u0301\u0303\u0302")
+# Từ thường gặp khi gõ tiếng Việt không dấu / tiếng Anh, dùng khi câu chỉ có ký tự ASCII
+_VI_ASCII_WORDS = frozenset(
+    "la cua va khong co cho toi ban minh lam sao nao gi nhu duoc nhung voi trong mot cac nay "
+    "thi roi da dang se bi hay giup em anh chi ve tai vi neu khi nhieu hon cach viet hoc".split()
+)
+_EN_WORDS = frozenset(
+    "the is are was were and or to of in on for with what how why when where which who "
+    "can could should would do does did i you it this that my your please explain write make "
+    "about from be have has not a an".split()
+)
+_WORD = re.compile(r"[^\W\d_]+")
+# Số chữ cái tối thiểu để tin kết quả nhánh nhanh
+_MIN_LETTERS = 8
+
+
+def _quick_detect(text: str) -> Optional[str]:
+    """
+    Phân biệt vi/en bằng thống kê ký tự: có dấu riêng của tiếng Việt với mật độ đủ cao là "vi"; câu chỉ có
+    ký tự ASCII thì so số từ phổ biến của mỗi ngôn ngữ. Trả về None khi không đủ chắc chắn.
+    """
+    letters = vi_only = shared = non_latin = 0
+    for ch in unicodedata.normalize("NFD", text.lower()):
+        if ch in _VI_ONLY_MARKS:
+            vi_only += 1
+        elif ch in _VI_SHARED_MARKS:
+            shared += 1
+        elif ch.isalpha():
+            letters += 1
+            if ord(ch) > 0x24F:
+                non_latin += 1
+    if letters < _MIN_LETTERS:
+        return None
+    if non_latin > letters / 2:
+        # Chữ không phải Latin (Nhật, Hàn, Nga...): để bộ phát hiện đầy đủ xử lý
+        return None
+    if vi_only and (vi_only + shared) / letters >= 0.05:
+        return "vi"
+    if vi_only or shared:
+        # Có dấu nhưng không đặc trưng (tiếng Pháp, Tây Ban Nha...) hoặc quá thưa
+        return None
+    words = _WORD.findall(text.lower())
+    vi_hits = sum(w in _VI_ASCII_WORDS for w in words)
+    en_hits = sum(w in _EN_WORDS for w in words)
+    if en_hits >= 2 and en_hits >= 2 * vi_hits:
+        return "en"
+    if vi_hits >= 2 and vi_hits >= 2 * en_hits:
+        return "vi"
+    return None
+
+
+class LanguageDetector:
+    """
+    Phát hiện ngôn ngữ cho việc chọn prompt: nhánh nhanh vi/en theo thống kê dấu và lớp ký tự
+    (micro giây), chỉ gọi langdetect khi không chắc chắn. Ngôn ngữ chủ đạo của mỗi user được
+    đếm trên Redis để dùng thay langdetect cho câu ngắn/mơ hồ của user đó.
+    """
+
+    def __init__(self, user_ttl: int, default: str):
+        self.user_ttl = user_ttl
+        self.default = default
+        self.stats = {"quick": 0, "memo": 0, "full": 0}
+
+    def warm(self):
+        """Nạp trước profile của langdetect (vốn được nạp lười ở lần gọi đầu tiên)."""
+        if _full_detect is None:
+            return
+        try:
+            _full_detect("warm up the language profiles")
+        except Exception as e:
+            logger.warning(f"Không thể khởi động langdetect: {e}")
+
+    async def start(self):
+        await asyncio.to_thread(self.warm)
+
+    def detect(self, text: str) -> str:
+        """Phát hiện ngôn ngữ không dùng memo (đồng bộ)."""
+        lang = _quick_detect(text or "")
+        if lang:
+            self.stats["quick"] += 1
+            return lang
+        return self._full(text)
+
+    def _full(self, text: str) -> str:
+        if _full_detect is None or not (text or "").strip():
+            return self.default
+        self.stats["full"] += 1
+        try:
+            return _full_detect(text)
+        except Exception:
+            return self.default
+
+    async def user_language(self, user_id: int) -> Optional[str]:
+        """Ngôn ngữ user dùng nhiều nhất, None nếu chưa có thống kê."""
+        try:
+            counts = await redis_client.hgetall(_USER_KEY.format(user_id))
+        except Exception as e:
+            logger.debug(f"Không thể đọc ngôn ngữ của user {user_id} từ Redis: {e}")
+            return None
+        if not counts:
+            return None
+        return max(counts.items(), key=lambda item: int(item[1]))[0]
+
+    async def _remember(self, user_id: int, lang: str):
+        key = _USER_KEY.format(user_id)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hincrby(key, lang, 1)
+            pipe.expire(key, self.user_ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.debug(f"Không thể lưu ngôn ngữ của user {user_id} vào Redis: {e}")
+
+    async def detect_for_user(self, text: str, user_id: Optional[int] = None) -> str:
+        """
+        Phát hiện ngôn ngữ có xét thói quen của user: kết quả chắc chắn của nhánh nhanh được ghi
+        vào thống kê của user; khi không chắc thì dùng ngôn ngữ chủ đạo của user trước khi gọi langdetect.
+        """
+        lang = _quick_detect(text or "")
+        if lang:
+            self.stats["quick"] += 1
+            if user_id is not None:
+                await self._remember(user_id, lang)
+            return lang
+        if user_id is not None:
+            memo = await self.user_language(user_id)
+            if memo:
+                self.stats["memo"] += 1
+                return memo
+        return await asyncio.to_thread(self._full, text)
+
+
+language_detector = LanguageDetector(user_ttl=USER_LANGUAGE_TTL, default=DEFAULT_LANGUAGE)
@@ -0,0 +1,271 @@
+import os
+import base64
+import struct
+import random
+import asyncio
+import hashlib
+import logging
+import zlib
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+import httpx
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# "openai" (mặc định) | "fake": backend giả lập chạy cục bộ, không cần mạng, dùng cho đo tải
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai").lower()
+MODEL_MODERATION = os.getenv("MODEL_MODERATION", "omni-moderation-latest")
+MODEL_IMAGE = os.getenv("MODEL_IMAGE", "gpt-image-1")
+
+# Cấu hình backend giả lập
+FAKE_LLM_TOKENS_PER_SEC = float(os.getenv("FAKE_LLM_TOKENS_PER_SEC", "50"))
+FAKE_LLM_TTFT_MS = int(os.getenv("FAKE_LLM_TTFT_MS", "300"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_RESPONSE_TOKENS = int(os.getenv("FAKE_LLM_RESPONSE_TOKENS", "200"))
+
+
+class LLMError(Exception):
+    """Lỗi từ nhà cung cấp mô hình (đã quy về một kiểu chung cho mọi provider)."""
+
+
+class StreamFinish:
+    """Phần tử cuối cùng provider yield ra để báo lý do kết thúc stream."""
+
+    def __init__(self, reason: Optional[str]):
+        self.reason = reason
+
+
+class ChatStream:
+    """
+    Stream phản hồi chat: chỉ trả ra các đoạn text; `finish_reason` ("stop", "length",
+    "content_filter"...) có giá trị sau khi stream kết thúc.
+    """
+
+    def __init__(self, chunks: AsyncIterator[Union[str, StreamFinish]]):
+        self._chunks = chunks
+        self.finish_reason: Optional[str] = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            item = await self._chunks.__anext__()
+            if isinstance(item, StreamFinish):
+                self.finish_reason = item.reason
+                continue
+            return item
+
+    async def aclose(self):
+        await self._chunks.aclose()
+
+
+class LLMProvider:
+    """Giao diện chung cho mọi nhà cung cấp mô hình. Lỗi của provider được quy về LLMError."""
+
+    name = "base"
+
+    def stream_chat(self, messages: List[Dict[str, Any]], model: str, temperature: float, max_tokens: int) -> ChatStream:
+        """Stream phản hồi chat, yield từng đoạn text; lý do kết thúc nằm ở ChatStream.finish_reason."""
+        raise NotImplementedError
+
+    async def complete(self, messages: List[Dict[str, Any]], model: str, temperature: float, max_tokens: int) -> str:
+        """Sinh phản hồi không stream (tiêu đề, tóm tắt...)."""
+        raise NotImplementedError
+
+    async def moderate(self, text: str) -> bool:
+        """Trả về True nếu nội dung bị hệ thống kiểm duyệt đánh dấu."""
+        raise NotImplementedError
+
+    async def generate_image(self, prompt: str, size: str = "1024x1024") -> bytes:
+        """Sinh ảnh, trả về nội dung file ảnh."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Đóng kết nối của provider (gọi ở shutdown)."""
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, api_key: str):
+        from openai import AsyncOpenAI
+        self.client = AsyncOpenAI(api_key=api_key)
+        self._download: Optional[httpx.AsyncClient] = None
+
+    @property
+    def download_client(self) -> httpx.AsyncClient:
+        """Client dùng chung để tải ảnh từ URL OpenAI trả về (giữ kết nối giữa các lần sinh ảnh)."""
+        if self._download is None or self._download.is_closed:
+            self._download = httpx.AsyncClient(timeout=30)
+        return self._download
+
+    async def close(self):
+        if self._download is not None:
+            await self._download.aclose()
+            self._download = None
+        await self.client.close()
+
+    def stream_chat(self, messages, model, temperature, max_tokens):
+        return ChatStream(self._stream_chat(messages, model, temperature, max_tokens))
+
+    async def _stream_chat(self, messages, model, temperature, max_tokens):
+        from openai import OpenAIError
+        finish_reason = None
+        try:
+            stream = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                text = choice.delta.content
+                if text:
+                    yield text
+        except OpenAIError as e:
+            raise LLMError(str(e)) from e
+        yield StreamFinish(finish_reason)
+
+    async def complete(self, messages, model, temperature, max_tokens):
+        from openai import OpenAIError
+        try:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+        except OpenAIError as e:
+            raise LLMError(str(e)) from e
+        return response.choices[0].message.content or ""
+
+    async def moderate(self, text: str) -> bool:
+        from openai import OpenAIError
+        try:
+            mod = await self.client.moderations.create(model=MODEL_MODERATION, input=text)
+        except OpenAIError as e:
+            raise LLMError(str(e)) from e
+        return bool(mod.results[0].flagged)
+
+    async def generate_image(self, prompt: str, size: str = "1024x1024") -> bytes:
+        from openai import OpenAIError
+        try:
+            response = await self.client.images.generate(model=MODEL_IMAGE, prompt=prompt, size=size, n=1)
+        except OpenAIError as e:
+            raise LLMError(str(e)) from e
+        data = response.data[0]
+        image_url = getattr(data, "url", None)
+        image_b64 = getattr(data, "b64_json", None)
+        if image_b64:
+            return base64.b64decode(image_b64)
+        if image_url:
+            res = await self.download_client.get(image_url)
+            res.raise_for_status()
+            return res.content
+        raise LLMError("OpenAI không trả về dữ liệu ảnh hợp lệ (không có URL hoặc base64).")
+
+
+_FAKE_WORDS = (
+    "hàm biến vòng lặp danh sách từ điển class đối tượng kế thừa decorator generator async await "
+    "request response database index query cache API REST HTTP JSON module package test "
+    "ví dụ giải thích cách dùng lưu ý hiệu năng bộ nhớ độ phức tạp thuật toán"
+).split()
+
+
+def _seed(messages: List[Dict[str, Any]]) -> int:
+    last = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    return int.from_bytes(hashlib.sha256(last.encode("utf-8")).digest()[:8], "big")
+
+
+def _png(width: int, height: int, rgb: bytes) -> bytes:
+    """Ảnh PNG màu đơn sắc, dựng trực tiếp bằng zlib (không cần Pillow)."""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    raw = (b"\x00" + rgb * width) * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FakeProvider(LLMProvider):
+    """
+    Backend giả lập cục bộ: nội dung xác định theo câu hỏi cuối của người dùng,
+    tốc độ token, thời gian tới token đầu (TTFT) và tỷ lệ lỗi cấu hình được qua FAKE_LLM_*.
+    """
+
+    name = "fake"
+
+    def __init__(self, tokens_per_sec: float, ttft_ms: int, error_rate: float, response_tokens: int):
+        self.token_interval = 1 / tokens_per_sec if tokens_per_sec > 0 else 0
+        self.ttft = ttft_ms / 1000
+        self.error_rate = error_rate
+        self.response_tokens = response_tokens
+        self._errors = random.Random()
+
+    def _tokens(self, messages: List[Dict[str, Any]], count: int) -> List[str]:
+        rng = random.Random(_seed(messages))
+        words = [rng.choice(_FAKE_WORDS) for _ in range(count)]
+        # Chèn một khối code để các chính sách gom frame theo code fence cũng được đo
+        middle = count // 2
+        words[middle:middle] = ["\n```python\n", "def", " f(x):\n", "    return", " x", " *", " 2\n", "```\n"]
+        return [w if w.startswith((" ", "\n")) else " " + w for w in words]
+
+    def stream_chat(self, messages, model, temperature, max_tokens):
+        return ChatStream(self._stream_chat(messages, model, temperature, max_tokens))
+
+    async def _stream_chat(self, messages, model, temperature, max_tokens):
+        await asyncio.sleep(self.ttft)
+        tokens = self._tokens(messages, min(self.response_tokens, max_tokens))
+        fail_at = self._errors.randrange(len(tokens)) if self._errors.random() < self.error_rate else -1
+        for i, token in enumerate(tokens):
+            if i == fail_at:
+                raise LLMError("Lỗi giả lập từ FakeProvider")
+            yield token
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+        yield StreamFinish("length" if self.response_tokens > max_tokens else "stop")
+
+    async def complete(self, messages, model, temperature, max_tokens):
+        await asyncio.sleep(self.ttft)
+        if self._errors.random() < self.error_rate:
+            raise LLMError("Lỗi giả lập từ FakeProvider")
+        return f"Trả lời giả lập {_seed(messages) % 10000:04d}"
+
+    async def moderate(self, text: str) -> bool:
+        return "[flag]" in text.lower()
+
+    async def generate_image(self, prompt: str, size: str = "1024x1024") -> bytes:
+        await asyncio.sleep(self.ttft)
+        if self._errors.random() < self.error_rate:
+            raise LLMError("Lỗi giả lập từ FakeProvider")
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        return _png(64, 64, digest[:3])
+
+
+def create_provider() -> LLMProvider:
+    """Tạo provider theo LLM_PROVIDER (openai | fake)."""
+    if LLM_PROVIDER == "fake":
+        logger.info(
+            f"Dùng FakeProvider: {FAKE_LLM_TOKENS_PER_SEC} tokens/s, TTFT {FAKE_LLM_TTFT_MS}ms, "
+            f"tỷ lệ lỗi {FAKE_LLM_ERROR_RATE}"
+        )
+        return FakeProvider(
+            tokens_per_sec=FAKE_LLM_TOKENS_PER_SEC,
+            ttft_ms=FAKE_LLM_TTFT_MS,
+            error_rate=FAKE_LLM_ERROR_RATE,
+            response_tokens=FAKE_LLM_RESPONSE_TOKENS,
+        )
+    return OpenAIProvider(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+llm_provider = create_provider()
@@ -0,0 +1,85 @@
+import os
+import uuid
+import logging
+import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy import insert
+from db_config import AsyncSessionLocal
+from models import ChatHistory
+from crud import to_db_datetime
+from service.batch_writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+# Chế độ ghi tin nhắn:
+# - "write_behind": trả về ngay, ghi theo lô ở nền (mặc định)
+# - "group_commit": ghi theo lô nhưng người gọi chờ tới khi lô chứa tin nhắn đã commit
+# - "sync": ghi từng tin nhắn ngay trong lời gọi (như trước đây)
+MESSAGE_SINK_MODE = os.getenv("MESSAGE_SINK_MODE", "write_behind").lower()
+# Thời gian gom lô tối đa (ms) và số dòng tối đa mỗi lô
+MESSAGE_SINK_FLUSH_MS = int(os.getenv("MESSAGE_SINK_FLUSH_MS", "50"))
+MESSAGE_SINK_BATCH_SIZE = int(os.getenv("MESSAGE_SINK_BATCH_SIZE", "200"))
+# Giới hạn hàng đợi; khi đầy người gọi phải chờ (backpressure) thay vì dồn bộ nhớ
+MESSAGE_SINK_QUEUE_SIZE = int(os.getenv("MESSAGE_SINK_QUEUE_SIZE", "10000"))
+
+
+class MessageSink(BatchWriter):
+    """
+    Ghi tin nhắn chat theo lô (write-behind).
+    Tin nhắn được sinh id/created_at ngay tại chỗ rồi đưa vào hàng đợi; một task nền gom
+    tối đa MESSAGE_SINK_BATCH_SIZE dòng hoặc chờ MESSAGE_SINK_FLUSH_MS rồi ghi bằng một câu
+    INSERT nhiều dòng trong một transaction. Nếu cả lô lỗi (ví dụ chat vừa bị xóa) thì ghi lại
+    từng dòng để chỉ bỏ các dòng hỏng.
+    """
+
+    name = "message_sink"
+
+    def __init__(self, mode: str, flush_ms: int, batch_size: int, queue_size: int):
+        super().__init__(flush_ms, batch_size, queue_size)
+        self.mode = mode
+
+    def start(self):
+        if self.mode != "sync":
+            super().start()
+
+    async def add(self, chat_id: uuid.UUID, role: str, content: str, created_at: Optional[datetime.datetime] = None) -> uuid.UUID:
+        """Đưa một tin nhắn vào hàng ghi; trả về id đã sinh cho tin nhắn."""
+        row = {
+            "id": uuid.uuid4(),
+            "chat_id": chat_id,
+            "role": role,
+            "content": content,
+            "created_at": to_db_datetime(created_at) or datetime.datetime.utcnow(),
+        }
+        if self.mode == "sync":
+            if not (await self._write([row]))[0]:
+                raise RuntimeError(f"Không thể lưu tin nhắn vào chat {chat_id}")
+            return row["id"]
+        done = await self.enqueue(row)
+        if self.mode == "group_commit" and not await done:
+            raise RuntimeError(f"Không thể lưu tin nhắn vào chat {chat_id}")
+        return row["id"]
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> List[bool]:
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(ChatHistory), rows)
+                await db.commit()
+            return [True] * len(rows)
+        except Exception as e:
+            if len(rows) == 1:
+                logger.error(f"[message_sink] Không thể lưu tin nhắn chat {rows[0]['chat_id']}: {e}")
+                return [False]
+            logger.warning(f"[message_sink] Ghi lô {len(rows)} tin nhắn thất bại, ghi lại từng dòng: {e}")
+            results: List[bool] = []
+            for row in rows:
+                results.extend(await self._write([row]))
+            return results
+
+
+message_sink = MessageSink(
+    mode=MESSAGE_SINK_MODE,
+    flush_ms=MESSAGE_SINK_FLUSH_MS,
+    batch_size=MESSAGE_SINK_BATCH_SIZE,
+    queue_size=MESSAGE_SINK_QUEUE_SIZE,
+)
@@ -0,0 +1,99 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from typing import Optional
+from service.redis_client import redis_client
+from service.llm_provider import llm_provider, MODEL_MODERATION
+from service.violation_handler import contains_violation
+
+logger = logging.getLogger(__name__)
+
+# Thời gian giữ kết quả kiểm duyệt trên Redis (giây); prompt bị chặn giữ lâu hơn
+MODERATION_CACHE_TTL = int(os.getenv("MODERATION_CACHE_TTL", "86400"))
+MODERATION_FLAGGED_TTL = int(os.getenv("MODERATION_FLAGGED_TTL", str(7 * 86400)))
+
+# Lý do bị chặn trả về từ ModerationService.check
+FLAG_KEYWORD = "keyword"
+FLAG_MODERATION = "moderation"
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Chuẩn hóa để các prompt chỉ khác hoa/thường, khoảng trắng hay dạng Unicode dùng chung cache."""
+    return _SPACES.sub(" ", unicodedata.normalize("NFC", prompt).lower()).strip()
+
+
+class ModerationService:
+    """
+    Kiểm duyệt prompt: so khớp từ khóa cục bộ và gọi moderation của provider (async) chạy song song.
+    Kết quả moderation được cache trên Redis theo sha256 của prompt đã chuẩn hóa, nên người dùng
+    thử lại cùng prompt không phải chờ thêm một round trip lên OpenAI.
+    Từ khóa bị cấm dừng ngay lời gọi moderation đang chạy; kiểm tra từ khóa thì luôn chạy xong
+    (gần như tức thì) vì nó quyết định việc tính strike.
+    """
+
+    def __init__(self, ttl: int, flagged_ttl: int):
+        self.ttl = ttl
+        self.flagged_ttl = flagged_ttl
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "keyword": 0, "moderation": 0}
+
+    def _key(self, prompt: str) -> str:
+        digest = hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()
+        return f"moderation:{MODEL_MODERATION}:{digest}"
+
+    async def _remote(self, prompt: str) -> bool:
+        key = self._key(prompt)
+        try:
+            cached = await redis_client.get(key)
+        except Exception as e:
+            logger.warning(f"Không thể đọc cache kiểm duyệt: {e}")
+            cached = None
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached == "1"
+        self.stats["cache_misses"] += 1
+        flagged = await llm_provider.moderate(prompt)
+        try:
+            await redis_client.set(key, "1" if flagged else "0", ex=self.flagged_ttl if flagged else self.ttl)
+        except Exception as e:
+            logger.warning(f"Không thể lưu cache kiểm duyệt: {e}")
+        return flagged
+
+    async def check(self, prompt: str) -> Optional[str]:
+        """
+        Trả về FLAG_KEYWORD, FLAG_MODERATION hoặc None nếu prompt hợp lệ.
+        Lỗi của từng bước kiểm tra được ghi log và bỏ qua (như trước đây).
+        """
+        keyword_task = asyncio.create_task(contains_violation(prompt))
+        remote_task = asyncio.create_task(self._remote(prompt))
+        try:
+            try:
+                has_keyword = await keyword_task
+            except Exception as e:
+                logger.warning(f"Kiểm tra từ khóa bị cấm lỗi (bỏ qua): {e}")
+                has_keyword = False
+            if has_keyword:
+                self.stats["keyword"] += 1
+                return FLAG_KEYWORD
+            try:
+                flagged = await remote_task
+            except Exception as e:
+                logger.warning(f"Moderation check lỗi (bỏ qua): {e}")
+                flagged = False
+            if flagged:
+                self.stats["moderation"] += 1
+                return FLAG_MODERATION
+            return None
+        finally:
+            for task in (keyword_task, remote_task):
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # đánh dấu đã lấy lỗi để asyncio không cảnh báo
+
+
+moderation = ModerationService(ttl=MODERATION_CACHE_TTL, flagged_ttl=MODERATION_FLAGGED_TTL)
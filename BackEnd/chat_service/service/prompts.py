@@ -2,6 +2,7 @@
 File chứa tất cả các prompt cho AI
 Tập trung vào hỗ trợ học tập và làm việc trong lập trình
 """
+import hashlib
 
 # System message chính cho chat
 SYSTEM_MESSAGE = """Bạn là một trợ lý AI chuyên về lập trình, được thiết kế để hỗ trợ học tập và làm việc trong lĩnh vực phát triển phần mềm. Nhiệm vụ của bạn là giúp đỡ lập trình viên từ cơ bản đến nâng cao.
@@ -63,3 +64,24 @@ PHONG CÁCH:
 Hãy luôn cố gắng cung cấp câu trả lời hữu ích nhất, giúp người dùng trở thành lập trình viên tốt hơn."""
 
 
+
+# Prompt tóm tắt dần các lượt hội thoại cũ không còn vừa ngân sách token
+SUMMARY_PROMPT = """Bạn đang duy trì bản tóm tắt cho một cuộc trò chuyện giữa người dùng và trợ lý lập trình.
+
+Bản tóm tắt hiện có:
+{previous_summary}
+
+Các lượt hội thoại mới cần gộp vào:
+{transcript}
+
+Hãy viết lại bản tóm tắt (tối đa khoảng {max_words} từ), giữ lại:
+- Mục tiêu và bối cảnh của người dùng
+- Các quyết định, kết luận, tên hàm/biến/file quan trọng
+- Những câu hỏi còn bỏ ngỏ
+Viết cùng ngôn ngữ với cuộc trò chuyện. Chỉ trả về bản tóm tắt."""
+
+# Tiền tố khi chèn bản tóm tắt vào context gửi cho mô hình
+SUMMARY_CONTEXT_PREFIX = "Tóm tắt phần trước của cuộc trò chuyện:\n"
+
+# Version của system prompt, tự đổi khi nội dung SYSTEM_MESSAGE thay đổi (dùng làm khóa cache phản hồi)
+SYSTEM_PROMPT_VERSION = hashlib.sha1(SYSTEM_MESSAGE.encode("utf-8")).hexdigest()[:12]
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+from service.redis_client import redis_client
+from service.prompts import SYSTEM_PROMPT_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Tắt mặc định: chỉ bật khi chấp nhận trả lại cùng một câu trả lời cho cùng một câu hỏi
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+# Chỉ cache khi context có tối đa N tin nhắn không phải system (1 = chỉ câu hỏi đầu tiên)
+RESPONSE_CACHE_MAX_DEPTH = int(os.getenv("RESPONSE_CACHE_MAX_DEPTH", "1"))
+# Số mục tối đa trong cache và kích thước tối đa (byte) của một phản hồi được cache
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", "32768"))
+# Kích thước mỗi đoạn khi phát lại phản hồi đã cache qua đường stream
+RESPONSE_CACHE_REPLAY_CHUNK = 32
+
+_KEY_PREFIX = "resp_cache:"
+_INDEX_KEY = "resp_cache:index"
+_STATS_KEY = "resp_cache:stats"
+
+
+def _normalize(content: str) -> str:
+    content = (content or "").strip()
+    # Câu hỏi một dòng: gộp khoảng trắng; nhiều dòng (thường có code) thì giữ nguyên thụt lề
+    if "\n" not in content:
+        return " ".join(content.split())
+    return content
+
+
+class ResponseCache:
+    """
+    Cache chính xác (exact match) phản hồi của mô hình cho các context ngắn.
+    Khóa là sha256 của version system prompt, model, temperature và các tin nhắn đã chuẩn hóa.
+    Số mục bị giới hạn bằng sorted set theo thời điểm lưu; mục cũ nhất bị loại trước.
+    """
+
+    def __init__(self, enabled: bool, ttl: int, max_depth: int, max_entries: int, max_bytes: int):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_depth = max_depth
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "skipped": 0}
+
+    def key_for(self, messages: List[Dict[str, Any]], model: str, temperature: float) -> Optional[str]:
+        """Trả về khóa cache, hoặc None nếu context không đủ điều kiện cache."""
+        if not self.enabled:
+            return None
+        # Bỏ system prompt chính (đại diện bởi SYSTEM_PROMPT_VERSION)
+        body = messages[1:] if messages and messages[0].get("role") == "system" else messages
+        if sum(1 for m in body if m.get("role") != "system") > self.max_depth:
+            return None
+        payload = json.dumps(
+            {
+                "v": SYSTEM_PROMPT_VERSION,
+                "model": model,
+                "temperature": temperature,
+                "messages": [[m.get("role"), _normalize(m.get("content"))] for m in body],
+            },
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return _KEY_PREFIX + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _count(self, field: str):
+        self.stats[field] += 1
+        try:
+            await redis_client.hincrby(_STATS_KEY, field, 1)
+        except Exception:
+            pass
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            cached = await redis_client.get(key)
+        except Exception as e:
+            logger.warning(f"Không thể đọc cache phản hồi: {e}")
+            cached = None
+        await self._count("hits" if cached is not None else "misses")
+        return cached
+
+    async def store(self, key: str, text: str):
+        if not text.strip() or len(text.encode("utf-8")) > self.max_bytes:
+            await self._count("skipped")
+            return
+        try:
+            pipe = redis_client.pipeline(transaction=True)
+            now = time.time()
+            pipe.set(key, text, ex=self.ttl)
+            pipe.zadd(_INDEX_KEY, {key: now})
+            # Bỏ khỏi chỉ mục các mục đã hết TTL
+            pipe.zremrangebyscore(_INDEX_KEY, 0, now - self.ttl)
+            pipe.zcard(_INDEX_KEY)
+            size = (await pipe.execute())[-1]
+            if size > self.max_entries:
+                evicted = await redis_client.zpopmin(_INDEX_KEY, size - self.max_entries)
+                if evicted:
+                    await redis_client.delete(*[k for k, _ in evicted])
+            await self._count("stores")
+        except Exception as e:
+            logger.warning(f"Không thể lưu cache phản hồi: {e}")
+
+    async def replay(self, text: str):
+        """Phát lại phản hồi đã cache dưới dạng stream để client không thấy khác biệt."""
+        for i in range(0, len(text), RESPONSE_CACHE_REPLAY_CHUNK):
+            yield text[i:i + RESPONSE_CACHE_REPLAY_CHUNK]
+
+    async def record(self, key: str, stream):
+        """
+        Chuyển tiếp stream gốc và chỉ lưu phản hồi vào cache khi mô hình kết thúc bình thường
+        (finish_reason == "stop"); phản hồi bị cắt do max_tokens hay bị bộ lọc nội dung chặn thì bỏ qua.
+        """
+        parts: List[str] = []
+        async for text in stream:
+            parts.append(text)
+            yield text
+        if getattr(stream, "finish_reason", None) != "stop":
+            await self._count("skipped")
+            return
+        await self.store(key, "".join(parts))
+
+    async def summary(self) -> Dict[str, Any]:
+        """Thống kê hit/miss toàn cụm (Redis) kèm số liệu của tiến trình hiện tại."""
+        cluster: Dict[str, int] = {}
+        entries = None
+        try:
+            cluster = {k: int(v) for k, v in (await redis_client.hgetall(_STATS_KEY)).items()}
+            entries = await redis_client.zcard(_INDEX_KEY)
+        except Exception as e:
+            logger.warning(f"Không thể đọc thống kê cache phản hồi: {e}")
+        lookups = cluster.get("hits", 0) + cluster.get("misses", 0)
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "max_depth": self.max_depth,
+            "ttl": self.ttl,
+            "hit_rate": round(cluster.get("hits", 0) / lookups, 4) if lookups else 0.0,
+            "cluster": cluster,
+            "process": dict(self.stats),
+        }
+
+
+response_cache = ResponseCache(
+    enabled=RESPONSE_CACHE_ENABLED,
+    ttl=RESPONSE_CACHE_TTL,
+    max_depth=RESPONSE_CACHE_MAX_DEPTH,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+)
@@ -0,0 +1,135 @@
+import os
+import uuid
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+from sqlalchemy import select, update, or_
+from db_config import AsyncSessionLocal
+from models import ChatSession
+from service.redis_client import redis_client
+from routers.openai_utils import generate_title
+from sockets.connection_manager import manager
+
+logger = logging.getLogger(__name__)
+
+# Số worker sinh tiêu đề song song và giới hạn hàng đợi (đầy thì bỏ qua, lượt sau thử lại)
+TITLE_WORKERS = int(os.getenv("TITLE_WORKERS", "2"))
+TITLE_QUEUE_SIZE = int(os.getenv("TITLE_QUEUE_SIZE", "1000"))
+# Thời gian giữ khóa sinh tiêu đề của một chat (giây), đủ cho một lần gọi mô hình
+TITLE_LOCK_TTL = int(os.getenv("TITLE_LOCK_TTL", "120"))
+
+DEFAULT_TITLES = ("", "New Chat", "Cuộc trò chuyện mới")
+_LOCK_KEY = "chat_title_lock:{}"
+
+
+def is_default_title(title: Optional[str]) -> bool:
+    return (title or "").strip() in DEFAULT_TITLES
+
+
+class TitleWorker:
+    """
+    Sinh tiêu đề cuộc trò chuyện ở nền, ngoài đường đi của phản hồi: handler chỉ đưa yêu cầu vào
+    hàng đợi (không chờ), worker lấy khóa Redis SET NX theo chat để nhiều kết nối/instance không
+    cùng gọi mô hình cho một chat, ghi DB có điều kiện (chỉ khi tiêu đề vẫn là mặc định) rồi
+    phát sự kiện TITLE_UPDATED tới phòng chat.
+    """
+
+    def __init__(self, workers: int, queue_size: int, lock_ttl: int):
+        self.workers = workers
+        self.lock_ttl = lock_ttl
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"submitted": 0, "updated": 0, "skipped": 0, "dropped": 0}
+
+    def start(self):
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except BaseException:
+                pass
+        self._tasks = []
+
+    def submit(self, chat_id: uuid.UUID, user_input: str, chat_session: Optional[ChatSession] = None, user_id: Optional[int] = None) -> bool:
+        """
+        Yêu cầu sinh tiêu đề cho chat từ câu hỏi đầu tiên; trả về ngay.
+        `chat_session` (nếu có) được cập nhật tiêu đề khi xong để kết nối đó không gửi lại yêu cầu.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait({"chat_id": chat_id, "user_input": user_input, "chat_session": chat_session, "user_id": user_id})
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning(f"Hàng đợi sinh tiêu đề đầy, bỏ qua chat {chat_id}")
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Lỗi khi sinh tiêu đề cho chat {job['chat_id']}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, job: Dict[str, Any]):
+        chat_id = job["chat_id"]
+        lock_key = _LOCK_KEY.format(chat_id)
+        if not await redis_client.set(lock_key, 1, nx=True, ex=self.lock_ttl):
+            # Một worker khác (có thể ở instance khác) đang hoặc vừa sinh tiêu đề cho chat này
+            self.stats["skipped"] += 1
+            return
+        title = None
+        try:
+            async with AsyncSessionLocal() as db:
+                current = await db.scalar(select(ChatSession.title).where(ChatSession.id == chat_id))
+            if not is_default_title(current):
+                self.stats["skipped"] += 1
+                self._remember(job, current)
+                return
+            title = (await generate_title([{"role": "user", "content": job["user_input"]}], job.get("user_id"))).strip()
+            if is_default_title(title):
+                return
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    update(ChatSession)
+                    .where(ChatSession.id == chat_id, or_(ChatSession.title.is_(None), ChatSession.title.in_(DEFAULT_TITLES)))
+                    .values(title=title)
+                )
+                await db.commit()
+            if not result.rowcount:
+                # Tiêu đề đã được đặt (đổi tên thủ công) trong lúc gọi mô hình
+                self.stats["skipped"] += 1
+                return
+            self._remember(job, title)
+            self.stats["updated"] += 1
+            await manager.broadcast(chat_id, {"role": "system", "event": "TITLE_UPDATED", "title": title})
+            logger.info(f"Đã cập nhật tiêu đề cho cuộc trò chuyện {chat_id} -> {title}")
+        finally:
+            if is_default_title(title):
+                # Chưa đặt được tiêu đề: nhả khóa để lượt chat sau thử lại
+                await redis_client.delete(lock_key)
+
+    @staticmethod
+    def _remember(job: Dict[str, Any], title: Optional[str]):
+        chat_session = job.get("chat_session")
+        if chat_session is not None and title:
+            chat_session.title = title
+
+
+title_worker = TitleWorker(
+    workers=TITLE_WORKERS,
+    queue_size=TITLE_QUEUE_SIZE,
+    lock_ttl=TITLE_LOCK_TTL,
+)
@@ -0,0 +1,139 @@
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from jose import jwt, JWTError, ExpiredSignatureError
+from redis.asyncio import Redis
+from service.redis_client import redis_host, redis_port
+from http_client import internal_http, decode_response, extract_user_data
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+SECRET_KEY = os.getenv("SECRET_KEY")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+# Thời gian (giây) giữ claims đã giải mã trong bộ nhớ và số token tối đa được cache
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_MAX = int(os.getenv("AUTH_CACHE_MAX", "10000"))
+# DB Redis nơi identity_service ghi "blacklist:{token}" khi đăng xuất (REDIS_DB của identity_service).
+# Bắt buộc khai báo khi AUTH_MODE=local: mỗi service đọc REDIS_DB riêng nên không thể đoán.
+AUTH_REVOCATION_REDIS_DB = os.getenv("AUTH_REVOCATION_REDIS_DB")
+# Thời gian (giây) nhớ kết quả "user còn tồn tại" từ User Service; user bị xóa bị chặn chậm nhất sau chừng này
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "60"))
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL")
+
+
+def _revocation_client() -> Optional[Redis]:
+    if AUTH_REVOCATION_REDIS_DB is None:
+        return None
+    return Redis(host=redis_host, port=redis_port, db=int(AUTH_REVOCATION_REDIS_DB), decode_responses=True)
+
+
+class TokenVerifier:
+    """
+    Xác thực access token ngay trong chat_service: kiểm tra chữ ký/hạn JWT bằng khóa dùng chung
+    với identity_service, kiểm tra token đã bị thu hồi trên Redis và user còn tồn tại ở User Service
+    (như /validate-token của identity_service).
+    Claims đã giải mã được cache theo sha256 của token trong thời gian ngắn (không quá hạn token);
+    việc kiểm tra thu hồi vẫn chạy mỗi lần để đăng xuất có hiệu lực ngay. Sự tồn tại của user được
+    cache theo user_id trong `user_ttl` giây.
+    """
+
+    def __init__(self, secret_key: str, algorithm: str, cache_ttl: float, cache_max: int,
+                 revocation: Optional[Redis], user_ttl: float, user_service_url: Optional[str]):
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.cache_ttl = cache_ttl
+        self.cache_max = cache_max
+        self.revocation = revocation
+        self.user_ttl = user_ttl
+        self.user_service_url = user_service_url
+        self._cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._users: "OrderedDict[int, Tuple[float, bool]]" = OrderedDict()
+
+    async def _user_exists(self, user_id: int) -> bool:
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        try:
+            response = await internal_http.get(f"{self.user_service_url}user/{user_id}")
+        except Exception as e:
+            logger.error(f"Không thể kiểm tra user {user_id} ở User Service: {e}")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Không thể xác thực token lúc này")
+        if response.status_code not in (200, 404):
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Không thể xác thực token lúc này")
+        exists = extract_user_data(decode_response(response)) is not None
+        self._users[user_id] = (time.time() + self.user_ttl, exists)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.cache_max:
+            self._users.popitem(last=False)
+        return exists
+
+    def _cached(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= time.time():
+            self._cache.pop(key, None)
+            return None
+        self._cache.move_to_end(key)
+        return user
+
+    def _decode(self, token: str) -> Tuple[float, Dict[str, Any]]:
+        try:
+            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+        except ExpiredSignatureError:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token đã hết hạn!")
+        except JWTError:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token không đúng")
+        user_id = payload.get("sub")
+        role = payload.get("role")
+        username = payload.get("username")
+        if not user_id or not role or not username:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token payload không hợp lệ")
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token payload không hợp lệ")
+        expires_at = min(time.time() + self.cache_ttl, float(payload.get("exp") or 0) or float("inf"))
+        return expires_at, {"user_id": user_id, "username": username, "role": role}
+
+    async def verify(self, token: str) -> Dict[str, Any]:
+        """Trả về {"user_id", "username", "role"} giống identity_service /validate-token."""
+        if not token:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token không tồn tại!!!")
+        try:
+            revoked = await self.revocation.exists(f"blacklist:{token}")
+        except Exception as e:
+            logger.error(f"Không thể kiểm tra token thu hồi trên Redis: {e}")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Không thể xác thực token lúc này")
+        if revoked:
+            self._cache.pop(hashlib.sha256(token.encode()).hexdigest(), None)
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token đã bị thu hồi")
+
+        key = hashlib.sha256(token.encode()).hexdigest()
+        user = self._cached(key)
+        if user is None:
+            expires_at, user = self._decode(token)
+            self._cache[key] = (expires_at, user)
+            while len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+        if not await self._user_exists(user["user_id"]):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại!")
+        return dict(user)
+
+
+token_verifier = TokenVerifier(
+    secret_key=SECRET_KEY,
+    algorithm=JWT_ALGORITHM,
+    cache_ttl=AUTH_CACHE_TTL,
+    cache_max=AUTH_CACHE_MAX,
+    revocation=_revocation_client(),
+    user_ttl=AUTH_USER_CACHE_TTL,
+    user_service_url=USER_SERVICE_URL,
+)
@@ -1,43 +1,57 @@
+import time
 import asyncio
 import uuid
 import logging
+from typing import Any, Dict, Optional
 from sqlalchemy import select
 from service.redis_client import redis_client
 from datetime import timezone, timedelta, datetime
 from fastapi import  WebSocket
-from db_config import db_dependency
+from db_config import AsyncSessionLocal, db_dependency
 from models import ViolationLog, ViolationStrike
-from schemas import ViolationStrikeCreate
+from service.violation_sink import violation_sink
 from connect_service import send_violation_lock_email, get_user
-from service.cache import load_keywords_from_cache
-from sockets.connection_manager import ConnectionManager
+from service.cache import get_keyword_matcher
+from sockets.connection_manager import manager
 
 logger = logging.getLogger(__name__)
 
-manager = ConnectionManager()
 VN_TIMEZONE = timezone(timedelta(hours=7))
+
+VIOLATION_LEVELS = {
+    1: {"message": "Cảnh báo: Vui lòng không sử dụng ngôn từ vi phạm.", "ban_time": 0},
+    2: {"message": "Bạn bị cấm chat 5 phút (vi phạm lần 2).", "ban_time": 300},
+    3: {"message": "Bạn bị cấm chat 1 giờ (vi phạm lần 3).", "ban_time": 3600},
+    4: {"message": "Tài khoản của bạn đã bị khóa do vi phạm nhiều lần.", "ban_time": 86400}
+}
+# Thời gian giữ bộ đếm strike trên Redis (giây)
+STRIKE_TTL = 86400
+
+# KEYS: strike, chat_ban; ARGV: TTL strike, ban_time của level 1..N
+# Trả về {strikes, level, ban_time, giây, micro giây} (thời điểm theo đồng hồ Redis)
+STRIKE_LUA = """
+local strikes = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+local level = math.min(strikes, #ARGV - 1)
+local ban_time = tonumber(ARGV[level + 1])
+if ban_time > 0 then
+    redis.call('SET', KEYS[2], 1, 'EX', ban_time)
+end
+local now = redis.call('TIME')
+return {strikes, level, ban_time, now[1], now[2]}
+"""
+_strike_script = redis_client.register_script(STRIKE_LUA)
 async def contains_violation(message: str) -> bool:
     """
     Kiểm tra xem message có chứa từ khóa bị cấm không.
     Sử dụng word boundary để tránh false positive (ví dụ: "class" không chứa "ass").
+    Bộ so khớp được biên dịch sẵn trong bộ nhớ, không truy vấn DB cho mỗi tin nhắn.
     """
-    import re
-    BANNED_KEYWORDS = await load_keywords_from_cache()
-    logger.info(f"Loaded banned keywords: {BANNED_KEYWORDS}")
-    if not BANNED_KEYWORDS:
-        logger.warning("Không có từ khóa bị cấm nào trong database")
-        return False
-    
-    message_lower = message.lower()
-    logger.info(f"Kiểm tra message: '{message_lower}' với {len(BANNED_KEYWORDS)} từ khóa bị cấm")
-    # Kiểm tra từng keyword với word boundary để tránh false positive
-    for keyword in BANNED_KEYWORDS:
-        # Sử dụng regex với word boundary để match chính xác từ
-        pattern = r'\b' + re.escape(keyword.lower()) + r'\b'
-        if re.search(pattern, message_lower):
-            logger.info(f"Phát hiện từ khóa bị cấm: '{keyword}' trong message: '{message}'")
-            return True
-    logger.info(f"Không phát hiện từ khóa bị cấm trong message: '{message}'")
+    matcher = await get_keyword_matcher()
+    keyword = matcher.find(message)
+    if keyword:
+        logger.info(f"Phát hiện từ khóa bị cấm: '{keyword}' trong message: '{message}'")
+        return True
     return False
 
 async def log_violation_to_db(user_id: int, message: str, level: int, db: db_dependency):
@@ -50,41 +64,15 @@ async def log_violation_to_db(user_id: int, message: str, level: int, db: db_dep
             created_at=datetime.utcnow()
         )
         db.add(violation)
-        db.commit()
-        db.refresh(violation)
+        await db.commit()
+        await db.refresh(violation)
         logger.info(f"Đã lưu vi phạm vào DB: user_id={user_id}, level={level}, message='{message[:50]}...'")
         return violation
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Lỗi khi lưu vi phạm vào DB: {e}", exc_info=True)
         raise
 
-async def update_strike_to_db(strikes: ViolationStrikeCreate, current_strikes: int, db: db_dependency):
-    """Cập nhật hoặc tạo mới số lần vi phạm trong database."""
-    result = db.execute(select(ViolationStrike).where(ViolationStrike.user_id == strikes.user_id))
-    strike_record = result.scalars().first()
-    if strike_record:
-        strike_record.strike_count = current_strikes
-        strike_record.last_updated = datetime.utcnow()
-    else:
-        strike_record = ViolationStrike(
-            user_id=strikes.user_id,
-            strike_count=current_strikes,
-            last_updated=datetime.utcnow()
-        )
-        db.add(strike_record)
-    db.commit()
-    db.refresh(strike_record)
-
-async def sync_strike_from_db(user_id: int, db: db_dependency):
-    """Đồng bộ số lần vi phạm từ database về Redis."""
-    strike_key = f"strike:{user_id}"
-    if not await redis_client.exists(strike_key):
-        result = db.execute(select(ViolationStrike).where(ViolationStrike.user_id == user_id))
-        strike_record = result.scalars().first()
-        if strike_record:
-            await redis_client.set(f"strike:{user_id}", strike_record.strike_count, ex=86400)  # TTL 1 ngày
-
 async def get_user_strike_count(user_id: int, db: db_dependency) -> int:
     """Lấy số lần vi phạm của user từ Redis hoặc DB."""
     strike_key = f"strike:{user_id}"
@@ -98,7 +86,7 @@ async def get_user_strike_count(user_id: int, db: db_dependency) -> int:
     
     # Nếu không có trong Redis, lấy từ DB và sync lại
     try:
-        result = db.execute(select(ViolationStrike).where(ViolationStrike.user_id == user_id))
+        result = await db.execute(select(ViolationStrike).where(ViolationStrike.user_id == user_id))
         strike_record = result.scalars().first()
         if strike_record:
             strike_count = strike_record.strike_count
@@ -122,71 +110,70 @@ async def is_user_banned_from_chat(user_id: int) -> bool:
         logger.warning(f"Lỗi khi kiểm tra ban status cho user {user_id}: {e}")
         return False
 
-async def process_violation_for_image(
-    message: str,
-    db: "db_dependency",
-    user_current: dict
-):
+async def _load_strike_from_db(user_id: int) -> int:
+    """Lấy strike từ DB khi Redis không có và ghi lại (kể cả 0) để lần sau không phải hỏi DB."""
+    strike_count = 0
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(ViolationStrike.strike_count).where(ViolationStrike.user_id == user_id))
+            strike_count = result.scalar() or 0
+    except Exception as e:
+        logger.warning(f"Lỗi khi lấy strike từ DB cho user {user_id}: {e}")
+        return 0
+    try:
+        # NX: không ghi đè nếu một vi phạm mới vừa INCR trong lúc đọc DB
+        await redis_client.set(f"strike:{user_id}", strike_count, ex=STRIKE_TTL, nx=True)
+    except Exception:
+        pass
+    return strike_count
+
+async def preflight_check(user_id: int, message: str) -> Dict[str, Any]:
     """
-    Xử lý vi phạm cho image generation (không cần websocket).
-    Trả về thông tin vi phạm để client hiển thị.
+    Kiểm tra trước khi gọi LLM: đọc trạng thái ban + strike bằng một lệnh MGET, chạy song song
+    với việc so khớp từ khóa, rồi quyết định cho gửi hay chặn.
+    Trả về {"has_violation", "banned", "strikes", "allowed", "elapsed_ms"}; "allowed" chỉ
+    xét trạng thái ban/strike, vi phạm trong chính tin nhắn do người gọi xử lý.
     """
-    user_id = user_current['user_id']
-    strike_key = f"strike:{user_id}"
-    ban_key = f"chat_ban:{user_id}"
+    started = time.perf_counter()
 
-    VIOLATION_LEVELS = {
-        1: {"message": "Cảnh báo: Vui lòng không sử dụng ngôn từ vi phạm.", "ban_time": 0},
-        2: {"message": "Bạn bị cấm chat 5 phút (vi phạm lần 2).", "ban_time": 300},
-        3: {"message": "Bạn bị cấm chat 1 giờ (vi phạm lần 3).", "ban_time": 3600},
-        4: {"message": "Tài khoản của bạn đã bị khóa do vi phạm nhiều lần.", "ban_time": 86400}
+    async def read_state():
+        try:
+            return await redis_client.mget(f"chat_ban:{user_id}", f"strike:{user_id}")
+        except Exception as e:
+            logger.warning(f"Lỗi khi đọc trạng thái ban/strike từ Redis cho user {user_id}: {e}")
+            return [None, None]
+
+    has_violation, (ban, strike) = await asyncio.gather(contains_violation(message), read_state())
+    strikes = int(strike) if strike is not None else 0
+    if strike is None and not has_violation:
+        strikes = await _load_strike_from_db(user_id)
+    banned = ban is not None
+    return {
+        "has_violation": has_violation,
+        "banned": banned,
+        "strikes": strikes,
+        "allowed": not has_violation and not banned and strikes < 2,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
     }
 
-    # --- Tăng strike trên Redis ---
-    current_strikes = int(await redis_client.incr(strike_key))
-    await redis_client.expire(strike_key, 86400)
-
-    # Xác định level
-    level = min(current_strikes, max(VIOLATION_LEVELS.keys()))
-    level_info = VIOLATION_LEVELS[level]
+async def apply_violation(user_id: int, message: str, websocket: Optional[WebSocket] = None) -> Dict[str, Any]:
+    """
+    Ghi nhận một vi phạm: tăng strike, xác định level và đặt lệnh cấm chat trong một script Lua
+    (một round trip, nguyên tử với các vi phạm đồng thời của cùng user); sau đó đưa vào hàng ghi DB
+    theo lô và gửi email khóa tài khoản ở nền. Trả về {"level", "message", "ban_time", "strikes"}.
+    """
+    strikes, level, ban_time, seconds, micros = await _strike_script(
+        keys=[f"strike:{user_id}", f"chat_ban:{user_id}"],
+        args=[STRIKE_TTL] + [VIOLATION_LEVELS[lvl]["ban_time"] for lvl in sorted(VIOLATION_LEVELS)],
+    )
+    strikes, level, ban_time = int(strikes), int(level), int(ban_time)
+    occurred_at = datetime.utcfromtimestamp(int(seconds) + int(micros) / 1_000_000)
 
-    # Nếu có ban_time > 0 thì đặt key cấm chat
-    if level_info["ban_time"] > 0:
-        await redis_client.set(ban_key, 1, ex=level_info["ban_time"])
+    # Ghi DB theo lô ở nền; chỉ chờ khi hàng đợi đầy
+    await violation_sink.add(user_id, message, level, strikes, occurred_at)
 
-    # --- Log DB và update strike ---
-    async def log_and_update():
-        from db_config import SessionLocal
-        new_db = SessionLocal()
-        try:
-            logger.info(f"[log_and_update] Bắt đầu lưu vi phạm cho user {user_id}: level={level}, strikes={current_strikes}")
-            
-            # Cập nhật strike count
-            await update_strike_to_db(ViolationStrikeCreate(user_id=user_id, strike_count=current_strikes), current_strikes, new_db)
-            logger.info(f"[log_and_update] Đã cập nhật strike count: {current_strikes}")
-            
-            # Lưu violation log
-            violation_record = await log_violation_to_db(user_id, message, level, new_db)
-            violation_id = violation_record.id if violation_record else None
-            logger.info(f"[log_and_update] Đã lưu vi phạm vào DB: violation_id={violation_id}, user_id={user_id}, level={level}")
-            
-        except Exception as e:
-            logger.error(f"[log_and_update] Lỗi khi lưu vi phạm vào DB cho user {user_id}: {e}", exc_info=True)
-        finally:
-            try:
-                new_db.close()
-            except Exception as e:
-                logger.warning(f"[log_and_update] Lỗi khi đóng DB session: {e}")
-    
-    # Chạy async task để lưu vi phạm
-    try:
-        asyncio.create_task(log_and_update())
-        logger.info(f"[process_violation_for_image] Đã tạo async task để lưu vi phạm cho user {user_id}")
-    except Exception as e:
-        logger.error(f"[process_violation_for_image] Lỗi khi tạo async task: {e}", exc_info=True)
-    
     # --- Gửi email khóa account nếu strike >= 4 ---
-    if current_strikes >= 4:
+    if strikes >= 4:
         async def send_lock_email():
             try:
                 user_info = await get_user(user_id)
@@ -196,15 +183,36 @@ async def process_violation_for_image(
                     await send_violation_lock_email(email, username, '1 ngày')
             except Exception as e:
                 logger.exception(f"Lỗi khi gửi email thông báo khóa tài khoản cho user {user_id}: {e}")
+                if websocket is not None:
+                    try:
+                        await manager.send_personal(websocket, {
+                            "type": "error",
+                            "role": "system",
+                            "message": "Không thể gửi email thông báo khóa tài khoản.",
+                            "timestamp": datetime.now(VN_TIMEZONE).isoformat()
+                        })
+                    except Exception:
+                        pass  # Nếu websocket đã đóng thì bỏ qua
         asyncio.create_task(send_lock_email())
 
-    # Trả về thông tin vi phạm
     return {
         "level": level,
-        "message": level_info["message"],
-        "ban_time": level_info["ban_time"],
-        "strikes": current_strikes
+        "message": VIOLATION_LEVELS[level]["message"],
+        "ban_time": ban_time,
+        "strikes": strikes
     }
+
+async def process_violation_for_image(
+    message: str,
+    db: "db_dependency",
+    user_current: dict
+):
+    """
+    Xử lý vi phạm cho image generation (không cần websocket).
+    Trả về thông tin vi phạm để client hiển thị.
+    """
+    return await apply_violation(user_current['user_id'], message)
+
 async def process_violation(
     websocket: WebSocket,
     message: str,
@@ -213,42 +221,22 @@ async def process_violation(
     chat_id: "uuid.UUID" = None
 ):
     user_id = user_current['user_id']
-    strike_key = f"strike:{user_id}"
-    ban_key = f"chat_ban:{user_id}"
-
-    VIOLATION_LEVELS = {
-        1: {"message": "Cảnh báo: Vui lòng không sử dụng ngôn từ vi phạm.", "ban_time": 0},
-        2: {"message": "Bạn bị cấm chat 5 phút (vi phạm lần 2).", "ban_time": 300},
-        3: {"message": "Bạn bị cấm chat 1 giờ (vi phạm lần 3).", "ban_time": 3600},
-        4: {"message": "Tài khoản của bạn đã bị khóa do vi phạm nhiều lần.", "ban_time": 86400}
-    }
-
-    # --- Tăng strike trên Redis ---
-    current_strikes = int(await redis_client.incr(strike_key))
-    await redis_client.expire(strike_key, 86400)
-
-    # Xác định level
-    level = min(current_strikes, max(VIOLATION_LEVELS.keys()))
-    level_info = VIOLATION_LEVELS[level]
-
-    # Nếu có ban_time > 0 thì đặt key cấm chat
-    if level_info["ban_time"] > 0:
-        await redis_client.set(ban_key, 1, ex=level_info["ban_time"])
+    info = await apply_violation(user_id, message, websocket)
 
     # --- Gửi payload violation ngay lập tức ---
     violation_payload = {
         "type": "violation",
         "role": "system",
         "user_id": user_id,
-        "level": level,
-        "message": level_info["message"],
-        "ban_time": level_info["ban_time"],
+        "level": info["level"],
+        "message": info["message"],
+        "ban_time": info["ban_time"],
         "violations": [message],
         "timestamp": datetime.now(VN_TIMEZONE).isoformat()
     }
     logger.info(f"Gửi violation payload: {violation_payload}")
     try:
-        await websocket.send_json(violation_payload)
+        await manager.send_personal(websocket, violation_payload)
         logger.info(f"Đã gửi violation message thành công cho user {user_id}")
     except Exception as e:
         logger.error(f"Lỗi khi gửi violation message: {e}")
@@ -259,59 +247,3 @@ async def process_violation(
             {**violation_payload, "type": "alert"},
             skip_user_id=user_id
         ))
-    # --- Log DB và update strike ---
-    # Lưu trực tiếp để đảm bảo vi phạm được lưu vào DB
-    # Tạo session mới để tránh vấn đề session bị đóng
-    async def log_and_update():
-        from db_config import SessionLocal
-        new_db = SessionLocal()
-        try:
-            logger.info(f"[log_and_update] Bắt đầu lưu vi phạm cho user {user_id}: level={level}, strikes={current_strikes}")
-            
-            # Cập nhật strike count
-            await update_strike_to_db(ViolationStrikeCreate(user_id=user_id, strike_count=current_strikes), current_strikes, new_db)
-            logger.info(f"[log_and_update] Đã cập nhật strike count: {current_strikes}")
-            
-            # Lưu violation log - Sử dụng level thay vì current_strikes
-            violation_record = await log_violation_to_db(user_id, message, level, new_db)
-            violation_id = violation_record.id if violation_record else None
-            logger.info(f"[log_and_update] Đã lưu vi phạm vào DB: violation_id={violation_id}, user_id={user_id}, level={level}")
-            
-        except Exception as e:
-            logger.error(f"[log_and_update] Lỗi khi lưu vi phạm vào DB cho user {user_id}: {e}", exc_info=True)
-            import traceback
-            logger.error(f"[log_and_update] Traceback: {traceback.format_exc()}")
-        finally:
-            try:
-                new_db.close()
-            except Exception as e:
-                logger.warning(f"[log_and_update] Lỗi khi đóng DB session: {e}")
-    
-    # Chạy async task và log để đảm bảo task được tạo
-    try:
-        task = asyncio.create_task(log_and_update())
-        logger.info(f"[process_violation] Đã tạo async task để lưu vi phạm cho user {user_id}")
-    except Exception as e:
-        logger.error(f"[process_violation] Lỗi khi tạo async task: {e}", exc_info=True)
-    # --- Gửi email khóa account nếu strike >= 4 ---
-    if current_strikes >= 4:
-        async def send_lock_email():
-            try:
-                # Lấy thông tin user để gửi email
-                user_info = await get_user(user_id)
-                if user_info:
-                    email = user_info.get("email", "")
-                    username = user_info.get("username", user_info.get("first_name", "Người dùng"))
-                    await send_violation_lock_email(email, username, '1 ngày')
-            except Exception as e:
-                logger.exception(f"Lỗi khi gửi email thông báo khóa tài khoản cho user {user_id}: {e}")
-                try:
-                    await websocket.send_json({
-                        "type": "error",
-                        "role": "system",
-                        "message": "Không thể gửi email thông báo khóa tài khoản.",
-                        "timestamp": datetime.now(VN_TIMEZONE).isoformat()
-                    })
-                except Exception:
-                    pass  # Nếu websocket đã đóng thì bỏ qua
-        asyncio.create_task(send_lock_email())
\ No newline at end of file
@@ -0,0 +1,80 @@
+import os
+import logging
+import datetime
+from typing import Any, Dict, List
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from db_config import AsyncSessionLocal
+from models import ViolationLog, ViolationStrike
+from service.batch_writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+# Thời gian gom lô tối đa (ms) và số vi phạm tối đa mỗi lô
+VIOLATION_SINK_FLUSH_MS = int(os.getenv("VIOLATION_SINK_FLUSH_MS", "100"))
+VIOLATION_SINK_BATCH_SIZE = int(os.getenv("VIOLATION_SINK_BATCH_SIZE", "200"))
+# Giới hạn hàng đợi; khi đầy người gọi phải chờ (backpressure) thay vì tạo task không giới hạn
+VIOLATION_SINK_QUEUE_SIZE = int(os.getenv("VIOLATION_SINK_QUEUE_SIZE", "5000"))
+
+
+class ViolationSink(BatchWriter):
+    """
+    Ghi vi phạm theo lô: mỗi lô là một transaction gồm một câu INSERT nhiều dòng vào
+    violation_logs và một câu upsert violation_strikes (mỗi user một dòng, lấy sự kiện mới nhất
+    trong lô). Upsert chỉ ghi đè khi sự kiện mới hơn bản ghi hiện có (thời điểm lấy từ đồng hồ
+    Redis) nên thứ tự ghi giữa các lô/instance không làm mất cập nhật.
+    """
+
+    name = "violation_sink"
+
+    async def add(self, user_id: int, message: str, level: int, strikes: int, occurred_at: datetime.datetime):
+        """Đưa một vi phạm vào hàng ghi; chỉ chờ khi hàng đợi đầy."""
+        await self.enqueue({
+            "user_id": user_id,
+            "message": message,
+            "level": level,
+            "strikes": strikes,
+            "occurred_at": occurred_at,
+        })
+
+    async def _write(self, rows: List[Dict[str, Any]]) -> List[bool]:
+        latest: Dict[int, Dict[str, Any]] = {}
+        for row in rows:
+            current = latest.get(row["user_id"])
+            if current is None or (row["occurred_at"], row["strikes"]) >= (current["occurred_at"], current["strikes"]):
+                latest[row["user_id"]] = row
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(ViolationLog), [
+                    {"user_id": r["user_id"], "message": r["message"], "level": r["level"], "created_at": r["occurred_at"]}
+                    for r in rows
+                ])
+                stmt = pg_insert(ViolationStrike).values([
+                    {"user_id": r["user_id"], "strike_count": r["strikes"], "last_updated": r["occurred_at"]}
+                    for r in latest.values()
+                ])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[ViolationStrike.user_id],
+                    set_={"strike_count": stmt.excluded.strike_count, "last_updated": stmt.excluded.last_updated},
+                    where=ViolationStrike.last_updated <= stmt.excluded.last_updated,
+                )
+                await db.execute(stmt)
+                await db.commit()
+            logger.info(f"[violation_sink] Đã lưu {len(rows)} vi phạm của {len(latest)} user")
+            return [True] * len(rows)
+        except Exception as e:
+            if len(rows) == 1:
+                logger.error(f"[violation_sink] Không thể lưu vi phạm của user {rows[0]['user_id']}: {e}", exc_info=True)
+                return [False]
+            logger.warning(f"[violation_sink] Ghi lô {len(rows)} vi phạm thất bại, ghi lại từng dòng: {e}")
+            results: List[bool] = []
+            for row in rows:
+                results.extend(await self._write([row]))
+            return results
+
+
+violation_sink = ViolationSink(
+    flush_ms=VIOLATION_SINK_FLUSH_MS,
+    batch_size=VIOLATION_SINK_BATCH_SIZE,
+    queue_size=VIOLATION_SINK_QUEUE_SIZE,
+)
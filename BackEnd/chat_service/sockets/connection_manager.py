@@ -1,22 +1,122 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 from fastapi import WebSocket
 from collections import defaultdict
+import os
+import json
 import asyncio
+import logging
 from starlette.websockets import WebSocketState
 import datetime
+from sockets.stream_coalescer import StreamCoalescer
+
+logger = logging.getLogger(__name__)
+
+# "memory": một tiến trình (mặc định) | "redis": fan-out qua Redis pub/sub cho nhiều worker/node
+WS_BACKEND = os.getenv("WS_BACKEND", "memory").lower()
+# Số message tối đa chờ gửi cho mỗi socket
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Xử lý client đọc chậm khi hàng đợi đầy: "drop" bỏ message mới | "disconnect" đóng kết nối để client kết nối lại
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect").lower()
+# Thời gian tối đa (giây) cho một lần gửi; quá hạn coi như client đọc chậm
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+
+class SocketSender:
+    """
+    Hàng đợi gửi có giới hạn cho một websocket, cùng một task writer duy nhất ghi ra socket.
+    Bên gửi chỉ đưa message vào hàng đợi nên không bao giờ bị chặn bởi một client chậm.
+    """
+
+    def __init__(self, websocket: WebSocket, queue_size: int, policy: str, send_timeout: float):
+        self.websocket = websocket
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.closed = False
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def offer(self, message: dict) -> bool:
+        """Đưa message vào hàng đợi; trả về False nếu bị bỏ do client đọc chậm."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.policy == "disconnect":
+                self.closed = True
+                logger.warning(f"Client đọc chậm (hàng đợi đầy {self.queue.maxsize}), đóng kết nối")
+                asyncio.create_task(self._abort())
+            elif self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"Client đọc chậm, đã bỏ {self.dropped} message")
+            return False
+
+    async def _write_loop(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                if self.websocket.client_state != WebSocketState.CONNECTED:
+                    break
+                try:
+                    await asyncio.wait_for(self.websocket.send_json(message), timeout=self.send_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Gửi websocket quá {self.send_timeout}s, đóng kết nối")
+                    asyncio.create_task(self._abort())
+                    break
+                except Exception:
+                    break
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.closed = True
+
+    async def _abort(self):
+        self.closed = True
+        self._writer.cancel()
+        try:
+            # 1013: Try Again Later
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def close(self, drain_timeout: float = 1.0):
+        """Dừng writer; nếu socket còn mở thì chờ gửi nốt các message đang đợi trong thời gian ngắn."""
+        if not self.closed and self.websocket.client_state == WebSocketState.CONNECTED:
+            deadline = asyncio.get_running_loop().time() + drain_timeout
+            while not self.queue.empty() and not self._writer.done():
+                if asyncio.get_running_loop().time() >= deadline:
+                    break
+                await asyncio.sleep(0.01)
+        self.closed = True
+        self._writer.cancel()
+        try:
+            await self._writer
+        except BaseException:
+            pass
+
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, queue_size: int = WS_SEND_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY, send_timeout: float = WS_SEND_TIMEOUT):
         # Cấu trúc: {chat_id: {user_id: [WebSocket, ...]}}
         self.active_connections: Dict[str, Dict[int, List[WebSocket]]] = defaultdict(lambda: defaultdict(list))
-        self.lock = asyncio.Lock()  # Lock để tránh race condition
+        self.senders: Dict[WebSocket, SocketSender] = {}
+        self.queue_size = queue_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        # Chỉ bảo vệ việc sửa registry; không giữ lock trong lúc gửi dữ liệu
+        self.lock = asyncio.Lock()
 
     async def connect(self, websocket: WebSocket, chat_id: str, user_id: int):
         async with self.lock:
             self.active_connections[str(chat_id)][user_id].append(websocket)
+            if websocket not in self.senders:
+                self.senders[websocket] = SocketSender(websocket, self.queue_size, self.policy, self.send_timeout)
 
     async def disconnect(self, websocket: WebSocket, chat_id: str, user_id: int):
         async with self.lock:
+            sender = self.senders.pop(websocket, None)
             try:
                 self.active_connections[str(chat_id)][user_id].remove(websocket)
                 if not self.active_connections[str(chat_id)][user_id]:
@@ -25,66 +125,192 @@ class ConnectionManager:
                     del self.active_connections[str(chat_id)]
             except (KeyError, ValueError):
                 pass
+        if sender is not None:
+            await sender.close()
+
+    def _snapshot(self, chat_id: str, skip_user_id: int = None) -> List[SocketSender]:
+        """Chụp danh sách sender của phòng tại thời điểm gọi (không await nên không cần lock)."""
+        room = self.active_connections.get(str(chat_id))
+        if not room:
+            return []
+        return [
+            self.senders[socket]
+            for user_id, connections in room.items() if user_id != skip_user_id
+            for socket in connections if socket in self.senders
+        ]
+
+    async def send_personal(self, websocket: WebSocket, message: dict):
+        """Gửi riêng cho một socket, qua hàng đợi của socket đó để giữ đúng thứ tự với broadcast."""
+        sender = self.senders.get(websocket)
+        if sender is not None:
+            sender.offer(message)
+        elif websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.send_json(message)
 
     async def broadcast(self, chat_id: str, message: dict, skip_user_id: int = None):
-        async with self.lock:
-            for user_id, connections in self.active_connections.get(str(chat_id), {}).items():
-                if user_id == skip_user_id:
-                    continue
-                for socket in connections:
-                    if socket.client_state == WebSocketState.CONNECTED:
-                        try:
-                            await socket.send_json(message)
-                        except Exception:
-                            pass
+        await self._deliver_local(chat_id, message, skip_user_id)
+
+    async def _deliver_local(self, chat_id: str, message: dict, skip_user_id: int = None):
+        """Đưa message vào hàng đợi của các socket trong chat đang kết nối vào tiến trình này."""
+        for sender in self._snapshot(chat_id, skip_user_id):
+            sender.offer(message)
 
     async def broadcast_stream(
-        self, chat_id: str, content_generator, skip_user_id: int = None, interval: float = 0.5
+        self, chat_id: str, content_generator, skip_user_id: int = None, coalescer: Optional[StreamCoalescer] = None
     ):
         """
-        Gửi dữ liệu dạng stream buffer từ generator (hoặc async generator) cho tất cả user
-        ngoại trừ `skip_user_id`.
+        Gửi dữ liệu dạng stream buffer từ async generator cho tất cả user ngoại trừ `skip_user_id`.
         - content_generator: yield từng đoạn text
-        - interval: gửi buffer mỗi `interval` giây nếu buffer chưa kết thúc câu
+        - coalescer: chính sách gom frame (mặc định theo cấu hình STREAM_COALESCE_*)
         """
-        buffer = ""
-        last_send_time = datetime.datetime.now()
+        coalescer = coalescer or StreamCoalescer()
         async for chunk in content_generator:
-            buffer += chunk
-            now = datetime.datetime.now()
-            if any(buffer.endswith(punct) for punct in [".", "!", "?", "…", "。", "！", "？"]) \
-               or (now - last_send_time).total_seconds() > interval \
-               or len(buffer) >= 20:
+            frame = coalescer.push(chunk)
+            if frame is not None:
                 # Gửi buffer đến tất cả user
-                async with self.lock:
-                    for user_id, connections in self.active_connections.get(str(chat_id), {}).items():
-                        if user_id == skip_user_id:
-                            continue
-                        for socket in connections:
-                            if socket.client_state == WebSocketState.CONNECTED:
-                                try:
-                                    await socket.send_json({
-                                        "role": "assistant",
-                                        "content": buffer,
-                                        "timestamp": now.isoformat()
-                                    })
-                                except Exception:
-                                    pass
-                buffer = ""
-                last_send_time = now
+                await self.broadcast(chat_id, {
+                    "role": "assistant",
+                    "content": frame,
+                    "timestamp": datetime.datetime.now().isoformat()
+                }, skip_user_id=skip_user_id)
         # Gửi buffer còn lại
-        if buffer.strip():
-            async with self.lock:
-                for user_id, connections in self.active_connections.get(str(chat_id), {}).items():
-                    if user_id == skip_user_id:
-                        continue
-                    for socket in connections:
-                        if socket.client_state == WebSocketState.CONNECTED:
-                            try:
-                                await socket.send_json({
-                                    "role": "assistant",
-                                    "content": buffer,
-                                    "timestamp": datetime.datetime.now().isoformat()
-                                })
-                            except Exception:
-                                pass
+        rest = coalescer.flush()
+        if rest and rest.strip():
+            await self.broadcast(chat_id, {
+                "role": "assistant",
+                "content": rest,
+                "timestamp": datetime.datetime.now().isoformat()
+            }, skip_user_id=skip_user_id)
+        coalescer.report(f"broadcast chat {chat_id}")
+
+    async def close(self):
+        for sender in list(self.senders.values()):
+            await sender.close(drain_timeout=0)
+        self.senders.clear()
+
+
+class RedisConnectionManager(ConnectionManager):
+    """
+    Chế độ phân tán: mỗi worker subscribe kênh Redis của các chat có socket đang kết nối vào nó.
+    broadcast() publish lên kênh `ws:chat:{chat_id}`; mọi worker đang subscribe (kể cả worker gửi)
+    nhận message và chỉ gửi tới socket cục bộ của mình, nên thứ tự message trong một chat được giữ nguyên.
+    """
+
+    CHANNEL_PREFIX = "ws:chat:"
+
+    def __init__(self, redis, poll_interval: float = 0.05):
+        super().__init__()
+        self.redis = redis
+        self.poll_interval = poll_interval
+        self._commands: asyncio.Queue = asyncio.Queue()
+        self._channels: set = set()
+        self._listener: Optional[asyncio.Task] = None
+
+    def _channel(self, chat_id) -> str:
+        return f"{self.CHANNEL_PREFIX}{chat_id}"
+
+    def _ensure_listener(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _request(self, action: str, channel: str):
+        """Gửi lệnh subscribe/unsubscribe cho coroutine đang giữ kết nối pub/sub và chờ áp dụng."""
+        self._ensure_listener()
+        done = asyncio.get_running_loop().create_future()
+        await self._commands.put((action, channel, done))
+        try:
+            await asyncio.wait_for(done, timeout=2.0)
+        except Exception as e:
+            logger.warning(f"Không thể {action} kênh {channel}: {e}")
+
+    async def connect(self, websocket: WebSocket, chat_id: str, user_id: int):
+        first = str(chat_id) not in self.active_connections
+        await super().connect(websocket, chat_id, user_id)
+        if first:
+            await self._request("subscribe", self._channel(chat_id))
+
+    async def disconnect(self, websocket: WebSocket, chat_id: str, user_id: int):
+        await super().disconnect(websocket, chat_id, user_id)
+        if str(chat_id) not in self.active_connections:
+            await self._request("unsubscribe", self._channel(chat_id))
+
+    async def broadcast(self, chat_id: str, message: dict, skip_user_id: int = None):
+        envelope = json.dumps({"message": message, "skip_user_id": skip_user_id}, ensure_ascii=False, default=str)
+        try:
+            await self.redis.publish(self._channel(chat_id), envelope)
+        except Exception as e:
+            # Redis lỗi: vẫn phục vụ các socket trong tiến trình này
+            logger.warning(f"Không thể publish broadcast chat {chat_id} lên Redis: {e}")
+            await self._deliver_local(chat_id, message, skip_user_id)
+
+    async def _apply(self, pubsub, action: str, channel: str, done: asyncio.Future):
+        try:
+            room = channel[len(self.CHANNEL_PREFIX):]
+            if action == "subscribe" and channel not in self._channels and room in self.active_connections:
+                await pubsub.subscribe(channel)
+                self._channels.add(channel)
+            elif action == "unsubscribe" and channel in self._channels and room not in self.active_connections:
+                await pubsub.unsubscribe(channel)
+                self._channels.discard(channel)
+            if not done.done():
+                done.set_result(True)
+        except Exception as e:
+            if not done.done():
+                done.set_exception(e)
+
+    async def _listen(self):
+        # Chỉ coroutine này đọc/ghi trên kết nối pub/sub để tránh đọc đồng thời
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            while True:
+                if not self._channels:
+                    await self._apply(pubsub, *(await self._commands.get()))
+                    continue
+                while not self._commands.empty():
+                    await self._apply(pubsub, *self._commands.get_nowait())
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=self.poll_interval)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Lỗi đọc Redis pub/sub, thử lại: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not message or message.get("type") != "message":
+                    continue
+                try:
+                    data = json.loads(message["data"])
+                    chat_id = message["channel"][len(self.CHANNEL_PREFIX):]
+                    await self._deliver_local(chat_id, data["message"], data.get("skip_user_id"))
+                except Exception:
+                    logger.debug("Bỏ qua message pub/sub không hợp lệ", exc_info=True)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._channels.clear()
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+    async def close(self):
+        await super().close()
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except BaseException:
+                pass
+            self._listener = None
+
+
+def create_connection_manager() -> ConnectionManager:
+    """Tạo ConnectionManager theo WS_BACKEND (memory | redis)."""
+    if WS_BACKEND == "redis":
+        from service.redis_client import redis_client
+        return RedisConnectionManager(redis_client)
+    return ConnectionManager()
+
+
+# Registry dùng chung cho toàn bộ service (router websocket, ws_helpers, xử lý vi phạm)
+manager = create_connection_manager()
@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Chính sách gom token thành frame websocket: time | bytes | word | line | code_fence
+STREAM_COALESCE_POLICY = os.getenv("STREAM_COALESCE_POLICY", "code_fence").lower()
+# Độ trễ tối đa (ms) của một đoạn text trong buffer trước khi buộc phải gửi
+STREAM_COALESCE_MAX_DELAY_MS = int(os.getenv("STREAM_COALESCE_MAX_DELAY_MS", "150"))
+# Kích thước tối đa (byte UTF-8) của một frame
+STREAM_COALESCE_MAX_BYTES = int(os.getenv("STREAM_COALESCE_MAX_BYTES", "512"))
+# Kích thước tối thiểu trước khi được phép gửi sớm tại ranh giới từ/dòng
+STREAM_COALESCE_MIN_BYTES = int(os.getenv("STREAM_COALESCE_MIN_BYTES", "48"))
+
+CODE_FENCE = "```"
+
+# Thống kê cộng dồn toàn tiến trình
+stream_metrics: Dict[str, float] = {"streams": 0, "chunks": 0, "frames": 0, "bytes": 0, "seconds": 0.0}
+
+
+class StreamCoalescer:
+    """
+    Gom các chunk token của mô hình thành ít frame websocket hơn.
+    Mọi chính sách đều gửi khi buffer quá max_delay hoặc vượt max_bytes; ngoài ra:
+    - time: chỉ theo thời gian (time-slice)
+    - bytes: chỉ theo ngân sách byte
+    - word: gửi sớm tại khoảng trắng khi buffer đã đủ min_bytes
+    - line: gửi sớm tại xuống dòng khi buffer đã đủ min_bytes
+    - code_fence: như word, nhưng bên trong khối ``` chỉ gửi theo dòng để code không bị cắt giữa dòng
+    Text được giữ dưới dạng list các phần, chỉ nối lại khi gửi frame hoặc lấy toàn bộ phản hồi.
+    push() chỉ xét max_delay khi có chunk mới; dùng coalesce() để phần đang chờ vẫn được gửi đúng hạn
+    khi mô hình dừng giữa chừng.
+    """
+
+    POLICIES = ("time", "bytes", "word", "line", "code_fence")
+
+    def __init__(
+        self,
+        policy: str = STREAM_COALESCE_POLICY,
+        max_delay_ms: int = STREAM_COALESCE_MAX_DELAY_MS,
+        max_bytes: int = STREAM_COALESCE_MAX_BYTES,
+        min_bytes: int = STREAM_COALESCE_MIN_BYTES,
+    ):
+        if policy not in self.POLICIES:
+            logger.warning(f"Chính sách coalesce không hợp lệ '{policy}', dùng 'code_fence'")
+            policy = "code_fence"
+        self.policy = policy
+        self.max_delay = max_delay_ms / 1000
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self._parts: List[str] = []
+        self._pending: List[str] = []
+        self._pending_bytes = 0
+        self._pending_since: Optional[float] = None
+        self._in_fence = False
+        self._carry = ""
+        self.started = time.monotonic()
+        self.chunks = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def _track_fence(self, text: str):
+        # Giữ 2 ký tự cuối của chunk trước để nhận ra ``` bị tách qua nhiều chunk
+        window = self._carry + text
+        if window.count(CODE_FENCE) % 2:
+            self._in_fence = not self._in_fence
+        self._carry = window[-2:]
+
+    def _at_boundary(self, text: str) -> bool:
+        if self.policy == "time" or self.policy == "bytes":
+            return False
+        if self._pending_bytes < self.min_bytes:
+            return False
+        if self.policy == "line" or (self.policy == "code_fence" and self._in_fence):
+            return text.endswith("\n")
+        return text[-1:].isspace() or text.endswith((".", "!", "?", "…", "。", "！", "？", ",", ";", ":"))
+
+    def push(self, text: str) -> Optional[str]:
+        """Thêm một chunk; trả về nội dung frame nếu đến lúc gửi, ngược lại None."""
+        if not text:
+            return None
+        now = time.monotonic()
+        self.chunks += 1
+        self._parts.append(text)
+        self._pending.append(text)
+        self._pending_bytes += len(text.encode("utf-8"))
+        if self._pending_since is None:
+            self._pending_since = now
+        if self.policy == "code_fence":
+            self._track_fence(text)
+
+        if self._pending_bytes >= self.max_bytes:
+            return self.flush()
+        if self.policy != "bytes" and now - self._pending_since >= self.max_delay:
+            return self.flush()
+        if self._at_boundary(text):
+            return self.flush()
+        return None
+
+    def remaining(self) -> Optional[float]:
+        """Số giây còn lại trước khi phần đang chờ quá max_delay; None nếu không có gì phải gửi theo thời gian."""
+        if self._pending_since is None or self.policy == "bytes":
+            return None
+        return max(self._pending_since + self.max_delay - time.monotonic(), 0.0)
+
+    async def coalesce(self, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        Đọc stream chunk của mô hình và trả về các frame cần gửi. Chờ chunk kế tiếp tối đa remaining()
+        giây, hết hạn thì flush phần đang chờ. Phần còn lại khi stream kết thúc do người gọi flush().
+        """
+        iterator = stream.__aiter__()
+        next_chunk: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if next_chunk is None:
+                    next_chunk = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait((next_chunk,), timeout=self.remaining())
+                if not done:
+                    # Chunk sau chưa tới (vẫn chờ tiếp cùng future đó): gửi phần đang chờ đúng hạn
+                    frame = self.flush()
+                    if frame is not None:
+                        yield frame
+                    continue
+                chunk, next_chunk = next_chunk, None
+                try:
+                    text = chunk.result()
+                except StopAsyncIteration:
+                    return
+                frame = self.push(text)
+                if frame is not None:
+                    yield frame
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+
+    def flush(self) -> Optional[str]:
+        """Lấy toàn bộ nội dung đang chờ thành một frame (None nếu buffer rỗng)."""
+        if not self._pending:
+            return None
+        frame = "".join(self._pending)
+        self.frames += 1
+        self.bytes += self._pending_bytes
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._pending_since = None
+        return frame
+
+    def text(self) -> str:
+        """Toàn bộ phản hồi đã nhận (kể cả phần chưa gửi)."""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def metrics(self) -> Dict[str, float]:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            "policy": self.policy,
+            "chunks": self.chunks,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "bytes_per_frame": round(self.bytes / self.frames, 1) if self.frames else 0.0,
+            "frames_per_sec": round(self.frames / elapsed, 2),
+            "seconds": round(elapsed, 3),
+        }
+
+    def report(self, label: str):
+        """Ghi log thống kê của stream và cộng vào thống kê toàn tiến trình."""
+        m = self.metrics()
+        stream_metrics["streams"] += 1
+        stream_metrics["chunks"] += m["chunks"]
+        stream_metrics["frames"] += m["frames"]
+        stream_metrics["bytes"] += m["bytes"]
+        stream_metrics["seconds"] += m["seconds"]
+        logger.info(
+            f"[stream] {label}: {m['chunks']} chunks -> {m['frames']} frames ({m['policy']}), "
+            f"{m['bytes_per_frame']} bytes/frame, {m['frames_per_sec']} frames/s"
+        )
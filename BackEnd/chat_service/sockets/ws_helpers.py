@@ -8,19 +8,20 @@ from fastapi import WebSocket
 from starlette.websockets import WebSocketState
 import httpx
 from models import ChatSession
-from service.redis_client import redis_client
 from db_config import db_dependency
-from service.violation_handler import contains_violation, process_violation, get_user_strike_count, is_user_banned_from_chat
-from routers.openai_utils import generate_response, generate_title
-from crud import add_message_to_chat, update_chat_session
-from schemas import AddMessage, ChatSessionUpdate
-from sockets.connection_manager import ConnectionManager
+from service.violation_handler import preflight_check, process_violation
+from routers.openai_utils import generate_response
+from sockets.connection_manager import ConnectionManager, manager
+from service.context_cache import context_cache
+from service.context_builder import build_context
+from service.message_sink import message_sink
+from service.title_worker import title_worker, is_default_title
+from sockets.stream_coalescer import StreamCoalescer
 
 logger = logging.getLogger("chatbot.websocket")
 
 # THời gian VN
 VN_TIMEZONE = datetime.timezone(datetime.timedelta(hours=7))
-manager = ConnectionManager()
 UPLOAD_DIR = "upload/files"
 
 def now_vn() -> datetime.datetime:
@@ -33,6 +34,17 @@ async def handle_typing(manager: ConnectionManager, chat_id: uuid.UUID, user_id:
     logger.debug(f"Gửi thông báo 'đang nhập' cho người dùng {user_id} trong cuộc trò chuyện {chat_id}.")
 
 
+async def save_assistant_reply(db: db_dependency, chat_id: uuid.UUID, assistant_reply: str) -> bool:
+    """Lưu phản hồi assistant (qua message sink) và cập nhật context cache. Không raise để không làm gián đoạn flow."""
+    try:
+        await message_sink.add(chat_id, "assistant", assistant_reply, now_vn())
+    except Exception as save_error:
+        logger.exception("Không thể lưu phản hồi assistant vào DB: %s", save_error)
+        return False
+    await context_cache.append(chat_id, "assistant", assistant_reply)
+    return True
+
+
 async def stream_ai_response(
     websocket: WebSocket,
     db: db_dependency,
@@ -40,99 +52,76 @@ async def stream_ai_response(
     chat_log: List[Dict[str, Any]],
     user_id: int,
 ) -> str:
-    """Gửi phản hồi AI theo luồng (streaming), tự buffer theo dấu câu / thời gian."""
-    assistant_reply = ""
-    buffer = ""
-    last_send_time = now_vn()
+    """Gửi phản hồi AI theo luồng (streaming), gom token thành frame theo StreamCoalescer."""
+    coalescer = StreamCoalescer()
 
-    stream = await generate_response(chat_log)
+    # Cắt lịch sử theo ngân sách token, thay các lượt cũ bằng bản tóm tắt
+    context = await build_context(chat_id, chat_log)
+    stream = await generate_response(context)
 
     async def send_payload(payload: dict):
         try:
             if websocket and getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
-                await websocket.send_json(payload)
+                await manager.send_personal(websocket, payload)
             else:
                 await manager.broadcast(chat_id, payload)
         except Exception:
             logger.debug("Không thể gửi payload tới client", exc_info=True)
 
-    try:
-        async for chunk in stream:
-            # Lấy text từ chunk stream
+    async def send_rest():
+        # Gửi phần còn lại trong buffer (nếu có nội dung)
+        rest = coalescer.flush()
+        if rest and rest.strip():
+            await send_payload({
+                "role": "assistant",
+                "content": rest,
+                "streaming": False,
+                "timestamp": now_vn().isoformat(),
+            })
+
+    async def send_done():
+        done_payload = {"event": "DONE", "timestamp": now_vn().isoformat()}
+        await manager.broadcast(chat_id, done_payload, skip_user_id=user_id)
+        if websocket and getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
             try:
-                delta = chunk.choices[0].delta
-                text = getattr(delta, "content", None)
+                await manager.send_personal(websocket, done_payload)
             except Exception:
-                continue
-
-            if not text:
-                continue
-
-            assistant_reply += text
-            buffer += text
-            now = now_vn()
-
-            # Flush khi đủ độ dài / có dấu câu / quá thời gian
-            should_flush = (
-                len(buffer) >= 40
-                or (now - last_send_time).total_seconds() > 1.5
-                or any(buffer.endswith(p) for p in [".", "!", "?", "…", "。", "！", "？"])
-            )
-
-            if should_flush:
-                await send_payload({
-                    "role": "assistant",
-                    "content": buffer,
-                    "streaming": True,
-                    "timestamp": now.isoformat(),
-                })
-                buffer = ""
-                last_send_time = now
+                pass
 
-        # Nếu còn phần đệm
-        if buffer.strip():
+    try:
+        # coalesce() còn gửi phần đang chờ khi quá max_delay mà mô hình chưa trả chunk mới
+        async for frame in coalescer.coalesce(stream):
             await send_payload({
                 "role": "assistant",
-                "content": buffer,
-                "streaming": False,
+                "content": frame,
+                "streaming": True,
                 "timestamp": now_vn().isoformat(),
             })
 
+        # Nếu còn phần đệm
+        await send_rest()
+
         # Thông báo hoàn tất
-        done_payload = {"event": "DONE", "timestamp": now_vn().isoformat()}
-        await manager.broadcast(chat_id, done_payload)
-        if websocket and getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
-            await websocket.send_json(done_payload)
-        
+        await send_done()
+
         # Lưu kết quả hoàn chỉnh (chỉ khi có nội dung)
+        assistant_reply = coalescer.text()
         if assistant_reply and assistant_reply.strip():
-            try:
-                add_message_to_chat(db, AddMessage(chat_id=chat_id, role="assistant", content=assistant_reply, timestamp=now_vn().isoformat()))
-            except Exception as save_error:
-                logger.exception("Không thể lưu phản hồi assistant vào DB: %s", save_error)
-                # Không raise để không làm gián đoạn flow, nhưng log lại để theo dõi
-        
+            await save_assistant_reply(db, chat_id, assistant_reply)
+
         return assistant_reply
     except (httpx.RemoteProtocolError, httpx.ReadTimeout, httpx.ConnectError, httpx.NetworkError) as network_error:
         # Xử lý lỗi network/protocol một cách graceful
+        assistant_reply = coalescer.text()
         logger.warning("Lỗi kết nối khi stream AI response: %s. Đã nhận được %d ký tự.", network_error, len(assistant_reply))
-        
+
         # Gửi phần buffer còn lại nếu có
-        if buffer.strip():
-            await send_payload({
-                "role": "assistant",
-                "content": buffer,
-                "streaming": False,
-                "timestamp": now_vn().isoformat(),
-            })
-        
+        await send_rest()
+
         # Nếu đã có một phần response, vẫn lưu và thông báo
         if assistant_reply and assistant_reply.strip():
-            try:
-                add_message_to_chat(db, AddMessage(chat_id=chat_id, role="assistant", content=assistant_reply, timestamp=now_vn().isoformat()))
-            except Exception as save_error:
-                logger.exception("Không thể lưu phản hồi assistant vào DB: %s", save_error)
-            
+            await save_assistant_reply(db, chat_id, assistant_reply)
+
             # Thông báo cho user biết response bị cắt
             await send_payload({
                 "role": "system",
@@ -146,54 +135,36 @@ async def stream_ai_response(
                 "content": "Lỗi kết nối khi nhận phản hồi từ AI. Vui lòng thử lại.",
                 "timestamp": now_vn().isoformat(),
             })
-        
+
         # Gửi event DONE để frontend biết stream đã kết thúc
-        done_payload = {"event": "DONE", "timestamp": now_vn().isoformat()}
-        await manager.broadcast(chat_id, done_payload)
-        if websocket and getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
-            try:
-                await websocket.send_json(done_payload)
-            except Exception:
-                pass
-        
+        await send_done()
+
         # Trả về phần đã nhận được (nếu có) thay vì raise exception
         return assistant_reply
     except Exception as e:
         logger.exception("Lỗi khi stream phản hồi AI: %s", e)
-        
+        assistant_reply = coalescer.text()
+
         # Gửi phần buffer còn lại nếu có
-        if buffer.strip():
-            await send_payload({
-                "role": "assistant",
-                "content": buffer,
-                "streaming": False,
-                "timestamp": now_vn().isoformat(),
-            })
-        
+        await send_rest()
+
         # Nếu đã có một phần response, vẫn lưu
         if assistant_reply and assistant_reply.strip():
-            try:
-                add_message_to_chat(db, AddMessage(chat_id=chat_id, role="assistant", content=assistant_reply, timestamp=now_vn().isoformat()))
-            except Exception:
-                pass
-        
+            await save_assistant_reply(db, chat_id, assistant_reply)
+
         await send_payload({
             "role": "system",
             "content": "Lỗi khi phản hồi AI. Vui lòng thử lại.",
             "timestamp": now_vn().isoformat(),
         })
-        
+
         # Gửi event DONE
-        done_payload = {"event": "DONE", "timestamp": now_vn().isoformat()}
-        await manager.broadcast(chat_id, done_payload)
-        if websocket and getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
-            try:
-                await websocket.send_json(done_payload)
-            except Exception:
-                pass
-        
+        await send_done()
+
         # Trả về phần đã nhận được thay vì raise
         return assistant_reply
+    finally:
+        coalescer.report(f"chat {chat_id}")
 async def handle_send_message(
     websocket: WebSocket,
     db: db_dependency,
@@ -206,39 +177,38 @@ async def handle_send_message(
 ) -> None:
     """
     Toàn bộ flow khi nhận action sendMessage:
-    - check ban
-    - check violation -> process_violation
+    - pre-flight: check violation + ban/strike song song -> process_violation hoặc chặn
     - save user message
     - broadcast user message
     - stream AI response (gọi stream_ai_response)
     - save assistant message
-    - update title nếu cần (chỉ khi là chat mới)
+    - sinh tiêu đề ở nền nếu là chat mới (title_worker)
     """
     timestamp = now_vn()
     # Hàm tiện ích dùng để gửi dữ liệu (payload) thông qua WebSocket hoặc broadcast.
-    async def send_to_clients(payload: str, skip_user: int = None) -> None:
+    async def send_to_clients(payload: str, skip_user: int = user_id) -> None:
         try:
             if websocket and getattr(websocket, "client_state", None) == WebSocketState.CONNECTED:
                 with contextlib.suppress(Exception):
-                    await websocket.send_json(payload)
-            # Phát đến các client khác (hoặc tất cả nếu skip_user_id là None). Lớp Manager đã hỗ trợ tham số skip_user_id.
+                    await manager.send_personal(websocket, payload)
+            # Phát đến các client khác; mặc định bỏ qua user hiện tại vì socket này đã nhận trực tiếp ở trên.
             await manager.broadcast(chat_id, payload, skip_user_id=skip_user)
         except Exception:
             logger.warning("Không thể gửi dữ liệu đến các client (qua websocket hoặc broadcast).", exc_info=True)     
-    # Kiểm tra vi phạm TRƯỚC (để tăng strike nếu có vi phạm mới)
-    has_violation = await contains_violation(user_input)
-    logger.info(f"Kiểm tra vi phạm cho message: '{user_input}' - Kết quả: {has_violation}")
-    if has_violation:
+    # Pre-flight: so khớp từ khóa song song với một lệnh MGET trạng thái ban/strike
+    preflight = await preflight_check(user_id, user_input)
+    logger.info(f"Kiểm tra vi phạm cho message: '{user_input}' - Kết quả: {preflight['has_violation']} ({preflight['elapsed_ms']}ms)")
+    if preflight["has_violation"]:
         logger.info(f"Phát hiện hành vi vi phạm của người dùng {user_id}. Message: {user_input}")
         await process_violation(websocket, user_input, db, user_data, chat_id)
         logger.info(f"Đã xử lý vi phạm và gửi violation message cho user {user_id}")
         # Return sớm để không lưu message vi phạm vào DB
         return
-    
-    # Sau khi check violation, kiểm tra ban (strike có thể đã tăng sau khi process_violation)
-    is_banned = await is_user_banned_from_chat(user_id)
-    strike_count = await get_user_strike_count(user_id, db)
-    
+
+    # Tin nhắn không vi phạm nên strike không đổi: dùng luôn trạng thái đọc ở pre-flight
+    is_banned = preflight["banned"]
+    strike_count = preflight["strikes"]
+
     # Nếu user có >= 4 lần vi phạm, chặn hoàn toàn
     if strike_count >= 4:
         await send_to_clients({
@@ -275,19 +245,20 @@ async def handle_send_message(
     # Lưu tin nhắn của người dùng (transaction-safe)
     user_message_saved = False
     try:
-        add_message_to_chat(db, AddMessage(chat_id=chat_id, role="user", content=user_input, timestamp=timestamp))
-        # add_message_to_chat đã tự commit, không cần commit lại
+        # Ghi theo lô ở nền (tùy MESSAGE_SINK_MODE), không tốn round trip DB cho mỗi tin nhắn
+        await message_sink.add(chat_id, "user", user_input, timestamp)
         user_message_saved = True
+        await context_cache.append(chat_id, "user", user_input)
         logger.debug(f"Đã lưu tin nhắn của người dùng {user_id} trong đoạn chat {chat_id}.")
     except Exception:
-        db.rollback()
         logger.exception("Không thể lưu tin nhắn user")
         # Không return ngay, vẫn broadcast để user biết message đã được gửi
         # nhưng log warning để theo dõi
 
     # Gửi phản hồi hoặc phát tin nhắn tới các client.
     # Chỉ broadcast nếu đã lưu thành công hoặc nếu muốn hiển thị ngay cả khi lưu fail
-    user_payload = {"role": "user", "content": user_input, "violations": [], "timestamp": timestamp.isoformat()}
+    # preflight_ms cho phép client tách thời gian kiểm tra khỏi thời gian chờ token đầu tiên của mô hình
+    user_payload = {"role": "user", "content": user_input, "violations": [], "timestamp": timestamp.isoformat(), "preflight_ms": preflight["elapsed_ms"]}
     await send_to_clients(user_payload, skip_user=user_id)
     
     # Nếu không lưu được, log warning nhưng vẫn tiếp tục để user có trải nghiệm tốt
@@ -297,6 +268,10 @@ async def handle_send_message(
     # Thêm tin nhắn vào nhật ký trò chuyện cục bộ để làm ngữ cảnh cho mô hình AI
     chat_log.append({"role": "user", "content": user_input})
 
+    # Chat chưa có tiêu đề: sinh tiêu đề ở nền song song với luồng phản hồi, không chờ kết quả
+    if is_default_title(getattr(chat_session, "title", None)):
+        title_worker.submit(chat_id, user_input, chat_session, user_id)
+
     # Truyền phản hồi của AI theo luồng
     assistant_reply = ""
     try:
@@ -310,54 +285,3 @@ async def handle_send_message(
         chat_log.append({"role": "assistant", "content": assistant_reply})
         logger.debug("Đã cập nhật chat_log với phản hồi của trợ lý")
 
-    # CẬP NHẬT TIÊU ĐỀ (có cache với Redis)
-    try:
-        # Nếu DB có tiêu đề mặc định hoặc rỗng -> thử generate
-        cur_title = (getattr(chat_session, "title", None) or "").strip()
-        if cur_title in ["", "New Chat", "Cuộc trò chuyện mới"]:
-            new_title = None
-            # Kiểm tra cache Redis trước
-            title_cache_key = f"chat_title:{chat_id}"
-            try:
-                cached = await redis_client.get(title_cache_key)
-                if cached:
-                    new_title = cached.decode() if isinstance(cached, (bytes, bytearray)) else str(cached)
-                    logger.debug(f"Lấy tiêu đề từ cache Redis: {new_title}")
-            except Exception as e:
-                logger.debug(f"Không thể lấy title từ Redis cache: {e}")
-                cached = None
-            
-            # Nếu không có trong cache, generate title mới
-            if not new_title:
-                try:
-                    title_context = [
-                        {"role": "user", "content": user_input}, 
-                        {"role": "assistant", "content": assistant_reply}
-                    ]
-                    new_title = await generate_title(title_context)
-                    logger.debug(f"Đã generate title mới: {new_title}")
-                    
-                    # Lưu cache (nếu hợp lệ)
-                    if new_title and new_title not in ["New Chat", "Cuộc trò chuyện mới"]:
-                        try:
-                            # Lưu cache với TTL 1 giờ để tránh cache vĩnh viễn
-                            await redis_client.setex(title_cache_key, 3600, new_title)
-                        except Exception as e:
-                            logger.warning(f"Không thể lưu title vào Redis: {e}")
-                except Exception as e:
-                    logger.error(f"Lỗi khi generate title: {e}")
-                    new_title = None
-
-            # Cập nhật DB nếu title hợp lệ
-            if new_title and new_title.strip() and new_title not in ["New Chat", "Cuộc trò chuyện mới"]:
-                try:
-                    update_chat_session(db, chat_id, ChatSessionUpdate(title=new_title.strip()))
-                    db.commit()
-                    await send_to_clients({"role": "system", "event": "TITLE_UPDATED", "title": new_title.strip()})
-                    logger.info(f"Đã cập nhật tiêu đề cho cuộc trò chuyện {chat_id} -> {new_title.strip()}")
-                except Exception as e:
-                    db.rollback()
-                    logger.exception(f"Không thể cập nhật tiêu đề trong DB: {e}")
-    except Exception as e:
-        logger.warning(f"Không thể cập nhật tiêu đề cuộc trò chuyện: {e}")
-
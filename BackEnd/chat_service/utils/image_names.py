@@ -0,0 +1,29 @@
+import re
+from typing import Optional
+
+# Tên file ảnh gốc đặt theo sha256 nội dung
+_HASHED_NAME = re.compile(r"^([0-9a-f]{64})\.(png|jpg|jpeg|webp)$")
+
+
+def is_hashed_name(filename: str) -> bool:
+    return bool(_HASHED_NAME.match(filename))
+
+
+def rendition_name(filename: str, rendition: str) -> Optional[str]:
+    """Tên file của bản thu nhỏ, hoặc None nếu file gốc không đặt tên theo hash (ảnh cũ)."""
+    match = _HASHED_NAME.match(filename)
+    if not match:
+        return None
+    return f"{match.group(1)}_{rendition}.webp"
+
+
+def rendition_url(url: str, rendition: str) -> str:
+    """
+    URL bản thu nhỏ suy ra thuần từ tên file (không đụng tới hệ thống file); ảnh cũ thì dùng URL gốc.
+    Bản thu nhỏ chưa được tạo (thiếu Pillow, lỗi khi render) do route phục vụ ảnh trả về ảnh gốc thay thế.
+    """
+    base, _, filename = url.rpartition("/")
+    name = rendition_name(filename, rendition)
+    if name is None:
+        return url
+    return f"{base}/{name}"
@@ -5,6 +5,7 @@ from fastapi import Depends, HTTPException
 from dotenv import load_dotenv
 import os
 import httpx
+from http_client import internal_http, decode_response
 USER_SERVICE_URL = os.getenv('USER_SERVICE_URL')
 SERVICE_KEY = os.getenv('SERVICE_KEY')
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -17,47 +18,43 @@ def verify_password( plain_password: str, hashed_password: str) -> bool:
     return bcrypt_context.verify(plain_password, hashed_password)
 # Lấy thông tin user từ User Service
 async def get_user(user_id: int):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f'{USER_SERVICE_URL}user/{user_id}')
-            if response.status_code == 200:
-                return response.json()
-        except httpx.RequestError as e:
-            raise Exception(f"Request error: {str(e)}")
+    try:
+        response = await internal_http.get(f'{USER_SERVICE_URL}user/{user_id}')
+        return decode_response(response)
+    except httpx.RequestError as e:
+        raise Exception(f"Request error: {str(e)}")
 async def get_user_by_email(email: str):
     headers = {"X-API-Key": SERVICE_KEY}
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f'{USER_SERVICE_URL}users/get-user-by-email/{email}', headers=headers)
-        except httpx.RequestError as e:
-            # Lỗi network / timeout
-            raise HTTPException(status_code=500, detail=f"Lỗi kết nối đến user service: {repr(e)}")
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 404:
-            # User không tồn tại → trả về 404
-            return None
-        else:
-            # Lỗi khác từ user service
-            raise HTTPException(status_code=500, detail=f"Lỗi từ user service: {response.text}")
+    try:
+        response = await internal_http.get(f'{USER_SERVICE_URL}users/get-user-by-email/{email}', headers=headers)
+    except httpx.RequestError as e:
+        # Lỗi network / timeout
+        raise HTTPException(status_code=500, detail=f"Lỗi kết nối đến user service: {repr(e)}")
+    if response.status_code == 200:
+        return response.json()
+    elif response.status_code == 404:
+        # User không tồn tại → trả về 404
+        return None
+    else:
+        # Lỗi khác từ user service
+        raise HTTPException(status_code=500, detail=f"Lỗi từ user service: {response.text}")
 
 async def generate_activation_token_for_user(user_id: int):
     """Gọi user service để tạo activation token mới"""
     headers = {"X-API-Key": SERVICE_KEY}
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f'{USER_SERVICE_URL}generate-activation-token',
-                json={"user_id": user_id},
-                headers=headers
+    try:
+        response = await internal_http.post(
+            f'{USER_SERVICE_URL}generate-activation-token',
+            json={"user_id": user_id},
+            headers=headers
+        )
+        if response.status_code == 200:
+            data = response.json()
+            return data.get("activation_token")
+        else:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Không thể tạo activation token: {response.text}"
             )
-            if response.status_code == 200:
-                data = response.json()
-                return data.get("activation_token")
-            else:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Không thể tạo activation token: {response.text}"
-                )
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=500, detail=f"Lỗi khi tạo activation token: {repr(e)}")
\ No newline at end of file
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi khi tạo activation token: {repr(e)}")
\ No newline at end of file
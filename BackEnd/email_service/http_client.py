@@ -0,0 +1,220 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+import httpx
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Giới hạn pool kết nối dùng chung cho mọi lời gọi giữa các service
+INTERNAL_HTTP_MAX_CONNECTIONS = int(os.getenv("INTERNAL_HTTP_MAX_CONNECTIONS", "100"))
+INTERNAL_HTTP_MAX_KEEPALIVE = int(os.getenv("INTERNAL_HTTP_MAX_KEEPALIVE", "20"))
+INTERNAL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("INTERNAL_HTTP_KEEPALIVE_EXPIRY", "30"))
+# Timeout mặc định (giây); từng lời gọi có thể truyền timeout riêng
+INTERNAL_HTTP_TIMEOUT = float(os.getenv("INTERNAL_HTTP_TIMEOUT", "10"))
+INTERNAL_HTTP_CONNECT_TIMEOUT = float(os.getenv("INTERNAL_HTTP_CONNECT_TIMEOUT", "3"))
+# Số lần thử lại (chỉ cho lời gọi idempotent) và thời gian chờ cơ sở giữa các lần thử
+INTERNAL_HTTP_RETRIES = int(os.getenv("INTERNAL_HTTP_RETRIES", "2"))
+INTERNAL_HTTP_BACKOFF = float(os.getenv("INTERNAL_HTTP_BACKOFF", "0.1"))
+# Circuit breaker: mở sau N lỗi liên tiếp tới cùng một service, thử lại sau COOLDOWN giây
+INTERNAL_HTTP_BREAKER_THRESHOLD = int(os.getenv("INTERNAL_HTTP_BREAKER_THRESHOLD", "5"))
+INTERNAL_HTTP_BREAKER_COOLDOWN = float(os.getenv("INTERNAL_HTTP_BREAKER_COOLDOWN", "30"))
+INTERNAL_HTTP2 = os.getenv("INTERNAL_HTTP2", "false").lower() in ("1", "true", "yes")
+
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+_RETRY_STATUS = {502, 503, 504}
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Service đích đang bị ngắt mạch; kế thừa RequestError để các nhánh except cũ vẫn bắt được."""
+
+
+class CircuitBreaker:
+    """Ngắt mạch theo từng service đích: closed -> open (sau N lỗi liên tiếp) -> half-open (cho một lời gọi thử)."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def release(self):
+        """Lời gọi kết thúc mà không có kết quả (bị hủy, lỗi không phải lỗi mạng): nhả lượt thử half-open."""
+        self.trial_running = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class InternalHTTPClient:
+    """
+    httpx.AsyncClient dùng chung cho các lời gọi nội bộ: giữ kết nối (keep-alive) giữa các request,
+    thử lại có jitter cho lời gọi idempotent và ngắt mạch theo từng service đích (host:port).
+    Tạo ở startup, đóng ở shutdown; nếu được gọi trước startup thì client được tạo khi cần.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            http2 = INTERNAL_HTTP2
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning("INTERNAL_HTTP2 bật nhưng chưa cài gói h2, dùng HTTP/1.1")
+                    http2 = False
+            self._client = httpx.AsyncClient(
+                http2=http2,
+                follow_redirects=True,
+                timeout=httpx.Timeout(INTERNAL_HTTP_TIMEOUT, connect=INTERNAL_HTTP_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=INTERNAL_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=INTERNAL_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=INTERNAL_HTTP_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
+    async def start(self):
+        _ = self.client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _breaker(self, url: str) -> CircuitBreaker:
+        target = urlsplit(url).netloc
+        breaker = self.breakers.get(target)
+        if breaker is None:
+            breaker = self.breakers[target] = CircuitBreaker(INTERNAL_HTTP_BREAKER_THRESHOLD, INTERNAL_HTTP_BREAKER_COOLDOWN)
+        return breaker
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        idempotent: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """
+        Gửi request tới service nội bộ. Lỗi kết nối/timeout và 502/503/504 được thử lại nếu lời gọi
+        idempotent (mặc định theo method; POST chỉ đọc có thể truyền idempotent=True) và cũng là
+        những lỗi duy nhất được circuit breaker tính.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in _IDEMPOTENT_METHODS
+        attempts = 1 + (INTERNAL_HTTP_RETRIES if retries is None else retries) if idempotent else 1
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=min(timeout, INTERNAL_HTTP_CONNECT_TIMEOUT))
+        breaker = self._breaker(url)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Service {urlsplit(url).netloc} tạm thời bị ngắt mạch")
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.RequestError as e:
+                breaker.failure()
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning(f"{method} {url} lỗi {e!r}, thử lại lần {attempt + 1}")
+            except BaseException:
+                # Bị hủy (client ngắt kết nối, task bị cancel...) hoặc lỗi khác: không phán xét được service
+                breaker.release()
+                raise
+            else:
+                # Chỉ lỗi tầng gateway/quá tải tính là service hỏng; 500 là lỗi của riêng endpoint đó
+                if response.status_code in _RETRY_STATUS:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                if response.status_code not in _RETRY_STATUS or attempt + 1 >= attempts:
+                    return response
+                logger.warning(f"{method} {url} trả về {response.status_code}, thử lại lần {attempt + 1}")
+            # Full jitter: chờ ngẫu nhiên trong [0, backoff * 2^attempt]
+            await asyncio.sleep(random.uniform(0, INTERNAL_HTTP_BACKOFF * (2 ** attempt)))
+        raise RuntimeError("unreachable")
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("DELETE", url, **kwargs)
+
+
+def decode_response(response: httpx.Response, ok: Tuple[int, ...] = (200,)) -> Any:
+    """Body JSON nếu status thuộc `ok`, ngược lại (hoặc body không phải JSON) trả về None."""
+    if response.status_code not in ok:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        logger.warning(f"{response.request.method} {response.request.url} trả về body không phải JSON")
+        return None
+
+
+def extract_user_data(user_response: Any) -> Optional[Dict[str, Any]]:
+    """
+    Lấy dict thông tin user từ response của User Service.
+    Xử lý cả trường hợp response là dict trực tiếp, có key "user", hoặc là Pydantic model.
+    Trả về None nếu không có dữ liệu hợp lệ.
+    """
+    if not user_response:
+        return None
+    if isinstance(user_response, dict):
+        user_data = user_response["user"] if "user" in user_response else user_response
+    elif hasattr(user_response, "model_dump"):
+        user_data = user_response.model_dump()
+    elif hasattr(user_response, "dict"):
+        user_data = user_response.dict()
+    else:
+        user_data = user_response
+    return user_data if isinstance(user_data, dict) else None
+
+
+internal_http = InternalHTTPClient()
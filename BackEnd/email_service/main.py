@@ -2,6 +2,7 @@ from fastapi import FastAPI
 from routers import send_email, otp
 from databases import Base, engine
 from fastapi.middleware.cors import CORSMiddleware
+from http_client import internal_http
 Base.metadata.create_all(bind=engine)
 app = FastAPI(title="Email Service API")
 # Cấu hình CORS
@@ -15,6 +16,14 @@ app.add_middleware(
 # Gắn router
 app.include_router(send_email.router)
 app.include_router(otp.router)
+@app.on_event("startup")
+async def startup_event():
+    await internal_http.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await internal_http.close()
+
 @app.get("/api/email_service/")
 async def root():
     return {"message": "Welcome to Email Service!"}
\ No newline at end of file
@@ -5,6 +5,7 @@ from schemas import OTPRequest, VerifyOTPRequest
 from service.otp_service import generate_otp, validate_otp
 from service.emali_templates import send_otp_login_email, send_otp_change_pass_email, send_otp_update_user_email
 from connect_service import get_user
+from http_client import extract_user_data
 
 router = APIRouter(prefix="/api/email_service", tags=["emails"])
 
@@ -16,25 +17,8 @@ async def send_otp_email_endpoint(request: OTPRequest, db: Session = Depends(get
     try:
         user_response = await get_user(request.user_id)
         
-        # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-        if isinstance(user_response, dict):
-            if "user" in user_response:
-                # Trường hợp cũ: {"user": {...}}
-                user_data = user_response["user"]
-            else:
-                # Trường hợp mới: response là dict trực tiếp chứa user data
-                user_data = user_response
-        else:
-            # Nếu là Pydantic model hoặc object khác
-            if hasattr(user_response, 'model_dump'):
-                user_data = user_response.model_dump()
-            elif hasattr(user_response, 'dict'):
-                user_data = user_response.dict()
-            else:
-                user_data = user_response
-        
-        # Đảm bảo user_data là dict
-        if not isinstance(user_data, dict):
+        user_data = extract_user_data(user_response)
+        if user_data is None:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Định dạng dữ liệu user không hợp lệ")
         
         if not user_data.get("id"):
@@ -5,6 +5,7 @@ from fastapi import APIRouter, Depends, status, HTTPException
 from sqlalchemy.orm import Session
 from databases import get_db
 from connect_service import get_user_by_email, generate_activation_token_for_user
+from http_client import extract_user_data
 from service.email_service import send_email
 from service.emali_templates import (
     send_activation_email,
@@ -56,21 +57,8 @@ async def send_activation_email_endpoint(request: ActivationEmailRequest, db: Se
         if not user_response:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại!")
         
-        # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-        if isinstance(user_response, dict):
-            if "user" in user_response:
-                user_data = user_response["user"]
-            else:
-                user_data = user_response
-        else:
-            if hasattr(user_response, 'model_dump'):
-                user_data = user_response.model_dump()
-            elif hasattr(user_response, 'dict'):
-                user_data = user_response.dict()
-            else:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại!")
-        
-        if not isinstance(user_data, dict):
+        user_data = extract_user_data(user_response)
+        if user_data is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Người dùng không tồn tại!")
         
         username = user_data.get("username")
@@ -126,24 +114,8 @@ async def resend_activation_email_endpoint(request: ResendActivationEmailRequest
                 detail="Không tìm thấy người dùng với email này!"
             )
         
-        # Xử lý response
-        if isinstance(user_response, dict):
-            if "user" in user_response:
-                user_data = user_response["user"]
-            else:
-                user_data = user_response
-        else:
-            if hasattr(user_response, 'model_dump'):
-                user_data = user_response.model_dump()
-            elif hasattr(user_response, 'dict'):
-                user_data = user_response.dict()
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Định dạng dữ liệu user không hợp lệ"
-                )
-        
-        if not isinstance(user_data, dict):
+        user_data = extract_user_data(user_response)
+        if user_data is None:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Định dạng dữ liệu user không hợp lệ"
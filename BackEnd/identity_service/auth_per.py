@@ -5,6 +5,7 @@ from sqlalchemy.orm import Session
 from models import BackListTokens
 from databases import get_db
 from connect_service import get_user
+from http_client import extract_user_data
 import os
 from dotenv import load_dotenv
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/identity_service/login")
@@ -55,23 +56,8 @@ async def get_current_user(
             detail="Người dùng không tồn tại"
         )
     
-    if isinstance(user_response, dict):
-        if "user" in user_response:
-            user_data = user_response["user"]
-        else:
-            user_data = user_response
-    else:
-        if hasattr(user_response, 'model_dump'):
-            user_data = user_response.model_dump()
-        elif hasattr(user_response, 'dict'):
-            user_data = user_response.dict()
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Định dạng dữ liệu user không hợp lệ"
-            )
-    
-    if not isinstance(user_data, dict):
+    user_data = extract_user_data(user_response)
+    if user_data is None:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Định dạng dữ liệu user không hợp lệ"
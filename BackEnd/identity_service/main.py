@@ -6,6 +6,7 @@ from routers import role, permission, role_permission, user_role, auth
 
 from rate_limiter import admin_role, role_get_user
 import models
+from http_client import internal_http
 
 # Kiểm tra kết nối cơ sở dữ liệu
 models.Base.metadata.create_all(bind=engine)
@@ -35,6 +36,11 @@ async def startup_event():
     db = SessionLocal()
     await admin_role(db)
     await role_get_user(db)
+    await internal_http.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await internal_http.close()
 
 @app.get("/")
 async def root():
@@ -23,6 +23,7 @@ from connect_service import (
     get_user_strike_count
 )
 from service.redis_client import redis_clients, cache_user, get_cached_user
+from http_client import extract_user_data
 from rate_limiter import rate_limiters
 router = APIRouter(prefix="/api/identity_service",tags=["authentication"])
 logger = logging.getLogger(__name__)
@@ -39,37 +40,6 @@ BLOCK_TIME = timedelta(minutes=5)
 
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-def extract_user_data(user_response):
-    """
-    Helper function để extract user data từ response của get_user()
-    Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-    """
-    if not user_response:
-        return None
-    
-    # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-    if isinstance(user_response, dict):
-        if "user" in user_response:
-            # Trường hợp cũ: {"user": {...}}
-            user_data = user_response["user"]
-        else:
-            # Trường hợp mới: response là dict trực tiếp chứa user data
-            user_data = user_response
-    else:
-        # Nếu là Pydantic model hoặc object khác
-        if hasattr(user_response, 'model_dump'):
-            user_data = user_response.model_dump()
-        elif hasattr(user_response, 'dict'):
-            user_data = user_response.dict()
-        else:
-            user_data = user_response
-    
-    # Đảm bảo user_data là dict
-    if not isinstance(user_data, dict):
-        return None
-    
-    return user_data
-
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     to_encode["sub"] = str(to_encode.get("sub", ""))
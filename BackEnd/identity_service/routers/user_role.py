@@ -8,6 +8,7 @@ from auth_per import get_current_user
 from databases import db_dependency
 from schemas import UserRoleRequest, AssignRoleRequest
 from connect_service import get_user, log_user_action
+from http_client import extract_user_data
 from verify_api_key import verify_api_key
 from service.redis_client import redis_clients, get_user_role_from_cache, set_user_role_in_cache
 
@@ -42,21 +43,8 @@ async def read_user_roles(user_id: int, db: db_dependency, current_user: dict =
         if not user_response:
             raise HTTPException(status_code=404, detail="Không tìm thấy người dùng")
         
-        # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-        if isinstance(user_response, dict):
-            if "user" in user_response:
-                user = user_response["user"]
-            else:
-                user = user_response
-        else:
-            if hasattr(user_response, 'model_dump'):
-                user = user_response.model_dump()
-            elif hasattr(user_response, 'dict'):
-                user = user_response.dict()
-            else:
-                raise HTTPException(status_code=404, detail="Không tìm thấy người dùng")
-        
-        if not user or not isinstance(user, dict):
+        user = extract_user_data(user_response)
+        if not user:
             raise HTTPException(status_code=404, detail="Không tìm thấy người dùng")
     except HTTPException:
         raise
@@ -90,21 +78,8 @@ async def assign_role_to_user(user_id: int, user_role_request: UserRoleRequest,
         if not user_response:
             raise HTTPException(status_code=404, detail="Người dùng không tồn tại")
         
-        # Xử lý cả trường hợp response là dict trực tiếp hoặc có key "user"
-        if isinstance(user_response, dict):
-            if "user" in user_response:
-                user = user_response["user"]
-            else:
-                user = user_response
-        else:
-            if hasattr(user_response, 'model_dump'):
-                user = user_response.model_dump()
-            elif hasattr(user_response, 'dict'):
-                user = user_response.dict()
-            else:
-                raise HTTPException(status_code=404, detail="Người dùng không tồn tại")
-        
-        if not user or not isinstance(user, dict):
+        user = extract_user_data(user_response)
+        if not user:
             raise HTTPException(status_code=404, detail="Người dùng không tồn tại")
     except HTTPException:
         raise
@@ -3,6 +3,7 @@ from routers import users, logs
 from db_config import Base, engine, SessionLocal
 from init_admins import init_admin
 from fastapi.middleware.cors import CORSMiddleware
+from http_client import internal_http
 Base.metadata.create_all(bind=engine)
 app = FastAPI(title="User Service API")
 
@@ -23,6 +24,11 @@ app.include_router(logs.router)
 async def startup_event():
     db = SessionLocal()
     await init_admin(db)
+    await internal_http.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await internal_http.close()
 
 @app.get("/api/user_service")
 async def root():
@@ -20,7 +20,7 @@ from user_schemas import (
     CreateUserRequest, AdminUpdateUserRequest, UpdateUserRequest, UserResponse, 
     UserStatus, UpdatePassword, AuthRequest, ListUserActive, 
     EditUserActive, ActivationTokenRequest, EmailResquest,
-    UpdatePasswordResquest, OTPRequest
+    UpdatePasswordResquest, OTPRequest, UserBatchRequest
 )
 router = APIRouter(prefix="/api/user_service",tags=["users"])
 load_dotenv()
@@ -88,6 +88,41 @@ async def get_user_by_id(user_id: int, db: db_dependency):
             print(f"Redis cache write error: {e}")
     
     return user_dict
+@router.post("/users/batch", status_code=status.HTTP_200_OK)
+async def get_users_batch(data: UserBatchRequest, db: db_dependency, server_connection_key: str = Depends(verify_api_key)):
+    """Lấy thông tin nhiều user trong một lần gọi: đọc cache bằng MGET, phần còn thiếu lấy bằng một truy vấn."""
+    user_ids = list(dict.fromkeys(data.user_ids))
+    users = {}
+    if redis_clients and user_ids:
+        try:
+            cached_list = redis_clients.mget([f"user_{user_id}" for user_id in user_ids])
+            for user_id, cached_data in zip(user_ids, cached_list):
+                if cached_data:
+                    users[user_id] = json.loads(cached_data)
+        except Exception as e:
+            print(f"Redis cache read error: {e}")
+
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if missing:
+        fetched = {
+            user.id: UserResponse.from_orm(user).model_dump()
+            for user in db.query(Users).filter(Users.id.in_(missing)).all()
+        }
+        users.update(fetched)
+        # Lưu vào cache (60 giây) như endpoint lấy từng user
+        if redis_clients and fetched:
+            try:
+                pipe = redis_clients.pipeline()
+                for user_id, user_dict in fetched.items():
+                    pipe.setex(f"user_{user_id}", 60, json.dumps(user_dict, default=str))
+                pipe.execute()
+            except Exception as e:
+                print(f"Redis cache write error: {e}")
+
+    return {
+        "users": [users[user_id] for user_id in user_ids if user_id in users],
+        "missing": [user_id for user_id in user_ids if user_id not in users]
+    }
 @router.post('/authenticate', status_code=status.HTTP_200_OK)
 async def authenticate_user(data: AuthRequest,db: db_dependency):
     """Xác thực tài khoản người dùng."""
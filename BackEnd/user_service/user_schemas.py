@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr, field_validator
+from pydantic import BaseModel, EmailStr, Field, field_validator
 from enum import Enum
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 import re
 # Enum UserStatus
@@ -54,6 +54,9 @@ class UserResponse(BaseModel):
     last_login: Optional[datetime] = None
     class Config:
         from_attributes  = True
+# Schema cho việc lấy nhiều user một lần (request)
+class UserBatchRequest(BaseModel):
+    user_ids: List[int] = Field(..., max_length=500)
 class AuthRequest(BaseModel):
     username: str
     password: str 
@@ -233,7 +233,7 @@ export default function ImageDetail() {
                     onClick={() => handleOpenImage(img)}
                   >
                     <img
-                      src={img.url}
+                      src={img.thumbnail_url || img.url}
                       alt={img.description}
                       className="w-full h-full object-contain transition-transform duration-500 group-hover:scale-105"
                       loading="lazy"
@@ -42,6 +42,10 @@ export default function ImageManagement() {
     description: "",
   });
   const [deletingId, setDeletingId] = useState(null);
+  // Phân trang tìm kiếm: từ khóa đang hiển thị và cursor của trang sau
+  const [searchQuery, setSearchQuery] = useState("");
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   // Load all images
   const fetchImages = async () => {
@@ -49,6 +53,8 @@ export default function ImageManagement() {
     try {
       const data = await getAllImgUsers();
       setImages(data || []);
+      setSearchQuery("");
+      setNextCursor(null);
     } catch (error) {
       toast.error("Không thể tải danh sách ảnh");
       console.error(error);
@@ -79,8 +85,10 @@ export default function ImageManagement() {
       if (!search.trim()) {
         await fetchImages();
       } else {
-        const data = await searchImages(search);
-        setImages(data || []);
+        const { items, nextCursor: cursor } = await searchImages(search);
+        setImages(items || []);
+        setSearchQuery(search);
+        setNextCursor(cursor);
       }
     } catch (error) {
       toast.error("Tìm kiếm thất bại");
@@ -90,6 +98,22 @@ export default function ImageManagement() {
     }
   };
 
+  // Tải trang kết quả tiếp theo của lần tìm kiếm hiện tại
+  const handleLoadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const { items, nextCursor: cursor } = await searchImages(searchQuery, undefined, nextCursor);
+      setImages((prev) => [...prev, ...(items || [])]);
+      setNextCursor(cursor);
+    } catch (error) {
+      toast.error("Không thể tải thêm kết quả");
+      console.error(error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleUpdate = async (e) => {
     e.preventDefault();
     if (!form.description.trim()) {
@@ -336,7 +360,7 @@ export default function ImageManagement() {
               >
                 <div className="relative aspect-square overflow-hidden bg-gradient-to-br from-gray-100 to-gray-200 dark:from-gray-800 dark:to-gray-900">
                   <img
-                    src={img.url}
+                    src={img.thumbnail_url || img.url}
                     alt={img.description}
                     className="w-full h-full object-cover transition-transform duration-500 group-hover:scale-110 cursor-pointer"
                     onClick={() => {
@@ -443,7 +467,7 @@ export default function ImageManagement() {
                   >
                     <td className="px-6 py-4">
                       <img
-                        src={img.url}
+                        src={img.thumbnail_url || img.url}
                         alt={img.description}
                         className="w-20 h-20 object-cover rounded-lg cursor-pointer hover:scale-105 transition-transform"
                         onClick={() => {
@@ -525,6 +549,20 @@ export default function ImageManagement() {
         </div>
       )}
 
+      {/* Load More */}
+      {nextCursor && images.length > 0 && (
+        <div className="flex justify-center">
+          <button
+            onClick={handleLoadMore}
+            disabled={loadingMore}
+            className="px-6 py-3 bg-white dark:bg-gray-800 border border-gray-200 dark:border-gray-700 rounded-xl font-medium text-gray-700 dark:text-gray-300 hover:bg-gray-50 dark:hover:bg-gray-700 transition-colors disabled:opacity-50 flex items-center gap-2"
+          >
+            {loadingMore && <Loader2 className="animate-spin" size={18} />}
+            Tải thêm
+          </button>
+        </div>
+      )}
+
       {/* Image Viewer Modal */}
       <AnimatePresence>
         {showImageViewer && selectedImage && (
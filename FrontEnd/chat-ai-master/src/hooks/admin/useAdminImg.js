@@ -26,13 +26,16 @@ export const useAdminImg = () => {
     return res.data;
   };
 
-  // Tìm kiếm ảnh
-  const searchImages = async (q, userId) => {
+  // Tìm kiếm ảnh (phân trang): nextCursor lấy từ header X-Next-Cursor, null nếu hết kết quả
+  const searchImages = async (q, userId, cursor) => {
     const res = await axiosAdminImg.get(
       "/api/chatbot_service/images/admin/search",
-      { params: { q, user_id: userId } }
+      { params: { q, user_id: userId, cursor } }
     );
-    return res.data;
+    return {
+      items: res.data,
+      nextCursor: res.headers["x-next-cursor"] || null,
+    };
   };
 
   // Thống kê
@@ -1,13 +1,26 @@
 import axios from "@/utils/axiosChat";
 
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 export const useChatImage = () => {
-  // 1. Generate ảnh từ prompt
+  // 1. Generate ảnh từ prompt (server trả về job_id, hỏi trạng thái tới khi xong)
   const generateImage = async (prompt) => {
     try {
       const res = await axios.post("/api/chatbot_service/images/generate", {
         prompt,
       });
-      return res.data;
+      let job = res.data;
+      let delay = 1000;
+      while (job.status === "queued" || job.status === "running") {
+        await sleep(delay);
+        delay = Math.min(delay * 1.5, 5000);
+        const poll = await axios.get(`/api/chatbot_service/images/jobs/${job.job_id}`);
+        job = poll.data;
+      }
+      if (job.status !== "done") {
+        throw new Error(job.error || "Không thể tạo ảnh. Vui lòng thử lại.");
+      }
+      return job.image;
     } catch (error) {
       console.error("Error generating image:", error);
       // Extract error message from response